@@ -0,0 +1,210 @@
+"""
+Controllo di ammissione degli append concorrenti.
+
+Senza limiti ogni append in arrivo apre (o prende dal pool) una connessione e
+attende l'advisory lock del proprio documento: un picco di richieste esaurisce
+il pool (`PoolError`) e accumula sul server transazioni ferme sullo stesso lock,
+così che il throughput crolla proprio sotto carico. `AdmissionController` fa
+entrare un append solo se:
+
+- gli append in corso sono meno di `max_in_flight`, da tenere non oltre il
+  numero massimo di connessioni del pool;
+- gli append in corso sullo stesso documento sono meno di `max_per_document`:
+  oltre, attenderebbero comunque l'advisory lock tenendo una connessione.
+
+Gli altri attendono in una coda limitata (`max_queue`) fino a `max_wait`
+secondi. Chi trova la coda piena o supera l'attesa viene respinto subito con
+`AdmissionRejected`, che il servizio traduce in 503 con Retry-After. Con un
+documento caldo le attese riguardano solo i suoi append: quelli sugli altri
+documenti vengono ammessi appena c'è capacità globale.
+"""
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+from metrics import (ADMISSION_TOTAL, ADMISSION_WAIT_SECONDS, DB_CONNECT_SECONDS, ENABLED as METRICS_ENABLED,
+                     REGISTRY, timed)
+
+
+class AdmissionRejected(Exception):
+    """
+    Append respinto dal controllo di ammissione.
+
+    Attributes:
+        reason (str): "queue_full" (coda d'attesa piena) o "timeout" (attesa massima superata).
+        document_id (str | None): Il documento dell'append.
+        waited (float): I secondi trascorsi in coda.
+    """
+
+    def __init__(self, reason: str, document_id: str | None, waited: float):
+        detail = "coda d'attesa piena" if reason == "queue_full" else f"non ammesso in {waited:.3f} s"
+        super().__init__(f"Append respinto per sovraccarico ({detail}).")
+        self.reason = reason
+        self.document_id = document_id
+        self.waited = waited
+
+
+class AdmissionController:
+    """
+    Limiti di concorrenza globale e per documento, con coda d'attesa limitata.
+    Thread-safe; pensato per essere condiviso da tutti i thread di un processo.
+
+    Args:
+        max_in_flight (int, optional): Append in corso al massimo. Defaults to 16.
+        max_per_document (int, optional): Append in corso al massimo sullo stesso documento.
+                                          Defaults to 2.
+        max_queue (int, optional): Append in attesa al massimo; 0 respinge subito chi non
+                                   può entrare. Defaults to 64.
+        max_wait (float, optional): Attesa massima in coda in secondi. Defaults to 1.0.
+    """
+
+    def __init__(self, max_in_flight: int = 16, max_per_document: int = 2, max_queue: int = 64,
+                 max_wait: float = 1.0):
+        if max_in_flight < 1 or max_per_document < 1:
+            raise ValueError("max_in_flight e max_per_document devono essere almeno 1.")
+        self.max_in_flight = max_in_flight
+        self.max_per_document = max_per_document
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._in_flight = 0
+        self._per_document = {}
+        self._queued = 0
+        self._counts = {"admitted": 0, "queue_full": 0, "timeout": 0}
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_env(cls, max_in_flight: int | None = None) -> "AdmissionController":
+        """
+        Legge i limiti da ADMISSION_MAX_IN_FLIGHT (default `max_in_flight` o 16),
+        ADMISSION_MAX_PER_DOCUMENT (2), ADMISSION_MAX_QUEUE (64) e
+        ADMISSION_MAX_WAIT_SECONDS (1).
+
+        Se `max_in_flight` è indicato (ad esempio le connessioni del pool),
+        ADMISSION_MAX_IN_FLIGHT non può superarlo: oltre quel limite getconn
+        fallirebbe per pool esaurito invece di mettere in coda la richiesta.
+        """
+        limit = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", max_in_flight or 16))
+        if max_in_flight is not None:
+            limit = min(limit, max_in_flight)
+        return cls(max_in_flight=limit,
+                   max_per_document=int(os.environ.get("ADMISSION_MAX_PER_DOCUMENT", "2")),
+                   max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", "64")),
+                   max_wait=float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", "1")))
+
+    @contextmanager
+    def admit(self, document_id: str | None = None, max_wait: float | None = None):
+        """
+        Attende l'ammissione di un append e lo conta come in corso fino all'uscita
+        dal blocco `with`.
+
+        Args:
+            document_id (str | None, optional): Il documento dell'append; None conta solo
+                                                verso il limite globale. Defaults to None.
+            max_wait (float | None, optional): Attesa massima per questa richiesta, ad esempio
+                                               la scadenza residua del chiamante.
+                                               Defaults a `self.max_wait`.
+
+        Yields:
+            float: I secondi trascorsi in coda.
+
+        Raises:
+            AdmissionRejected: Se la coda è piena o l'attesa supera il limite.
+        """
+        waited = self._acquire(document_id, self.max_wait if max_wait is None else max_wait)
+        try:
+            yield waited
+        finally:
+            self._release(document_id)
+
+    @contextmanager
+    def connection(self, pool, document_id: str | None = None, max_wait: float | None = None):
+        """
+        Come `admit`, restituendo una connessione del pool per la durata del blocco.
+        Con `max_in_flight` non superiore al massimo del pool, `getconn` non
+        fallisce per pool esaurito: il sovraccarico si ferma in coda.
+
+        Args:
+            pool: Un pool psycopg2 (`ThreadedConnectionPool`).
+            document_id (str | None, optional): Vedi `admit`. Defaults to None.
+            max_wait (float | None, optional): Vedi `admit`. Defaults to None.
+
+        Yields:
+            La connessione del pool.
+
+        Raises:
+            AdmissionRejected: Se la coda è piena o l'attesa supera il limite.
+        """
+        with self.admit(document_id, max_wait):
+            with timed(DB_CONNECT_SECONDS):
+                conn = pool.getconn()
+            try:
+                yield conn
+            finally:
+                pool.putconn(conn)
+
+    def snapshot(self) -> dict:
+        """
+        Restituisce limiti, append in corso e in coda, i documenti con più
+        append in corso e i conteggi per esito dall'avvio.
+        """
+        with self._condition:
+            busiest = sorted(self._per_document.items(), key=lambda item: item[1], reverse=True)[:10]
+            return {"max_in_flight": self.max_in_flight, "max_per_document": self.max_per_document,
+                    "max_queue": self.max_queue, "max_wait": self.max_wait,
+                    "in_flight": self._in_flight, "queued": self._queued,
+                    "busiest_documents": [{"document_id": document_id, "in_flight": count}
+                                          for document_id, count in busiest],
+                    **self._counts}
+
+    def _admissible(self, document_id: str | None) -> bool:
+        return self._in_flight < self.max_in_flight and \
+            (document_id is None or self._per_document.get(document_id, 0) < self.max_per_document)
+
+    def _acquire(self, document_id: str | None, max_wait: float) -> float:
+        start = time.perf_counter()
+        with self._condition:
+            if not self._admissible(document_id):
+                if self._queued >= self.max_queue:
+                    self._reject("queue_full", document_id, 0.0)
+                self._queued += 1
+                try:
+                    deadline = start + max_wait
+                    while not self._admissible(document_id):
+                        remaining = deadline - time.perf_counter()
+                        if remaining <= 0:
+                            self._reject("timeout", document_id, time.perf_counter() - start)
+                        self._condition.wait(remaining)
+                finally:
+                    self._queued -= 1
+
+            self._in_flight += 1
+            if document_id is not None:
+                self._per_document[document_id] = self._per_document.get(document_id, 0) + 1
+            self._counts["admitted"] += 1
+
+        waited = time.perf_counter() - start
+        if METRICS_ENABLED:
+            REGISTRY[ADMISSION_TOTAL].inc(labels=("admitted",))
+            REGISTRY[ADMISSION_WAIT_SECONDS].observe(waited)
+        return waited
+
+    def _reject(self, reason: str, document_id: str | None, waited: float) -> None:
+        # Chiamata con self._condition acquisita.
+        self._counts[reason] += 1
+        if METRICS_ENABLED:
+            REGISTRY[ADMISSION_TOTAL].inc(labels=(reason,))
+        raise AdmissionRejected(reason, document_id, waited)
+
+    def _release(self, document_id: str | None) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            if document_id is not None:
+                remaining = self._per_document[document_id] - 1
+                if remaining:
+                    self._per_document[document_id] = remaining
+                else:
+                    del self._per_document[document_id]
+            # Ogni attesa controlla il proprio documento: un documento caldo
+            # non blocca gli append sugli altri.
+            self._condition.notify_all()
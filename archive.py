@@ -0,0 +1,493 @@
+"""
+Archiviazione a freddo dei segmenti sigillati della catena.
+
+Un segmento è sigillato quando un checkpoint firmato (vedi `checkpoints.py`) ne
+registra numero di blocchi e hash. Il job di archiviazione, eseguito con il
+ruolo `archiver` (BYPASSRLS, con DELETE su `signature_chain` e nessun altro
+privilegio di scrittura sui blocchi), per ogni segmento da archiviare, dal più
+vecchio:
+
+    1. verifica la firma del checkpoint con la chiave registrata in `signer_keys`;
+    2. legge i blocchi del segmento e ne ricalcola l'hash, che deve coincidere
+       con quello firmato: un segmento manomesso non viene archiviato;
+    3. scrive i blocchi in un file JSON Lines compresso (zstd se è installato il
+       pacchetto `zstandard`, altrimenti xz) nella directory `ARCHIVE_DIR`;
+    4. nella stessa transazione registra il file in `archived_segments`,
+       aggiorna in `archived_heads` l'ultimo blocco archiviato di ogni documento
+       del segmento, copia in `archived_requests` i request_id dei suoi blocchi
+       e cancella i blocchi da `signature_chain`.
+
+Un segmento è un intervallo di ID dell'intera catena, quindi può contenere tutti
+i blocchi di un documento: gli append leggono allora la testa da
+`archived_heads` e la catena del documento prosegue invece di ripartire da un
+nuovo blocco genesi. Sui database archiviati prima di `archived_heads`,
+`backfill_archived_heads` ricostruisce la tabella dai file di archivio.
+
+I segmenti archiviati sono sempre un prefisso della catena: `ChainArchive`
+restituisce i blocchi archiviati, dopo aver controllato l'impronta del file e
+l'hash del segmento, e `verify_chain` li antepone ai blocchi ancora presenti
+nella tabella, proseguendo la verifica dei collegamenti senza interruzioni.
+
+Uso (credenziali da ARCHIVER_DB_USER e ARCHIVER_DB_PASSWORD):
+    ARCHIVE_DIR=archive ARCHIVE_KEEP_SEGMENTS=2 python archive.py
+    python archive.py --backfill-heads   # ricostruisce solo archived_heads dai file
+"""
+import hashlib
+import json
+import lzma
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+import psycopg2
+
+try:
+    import zstandard
+except ImportError:  # dipendenza opzionale: in sua assenza si comprime con xz
+    zstandard = None
+
+from checkpoints import checkpoint_signing_input, segment_hash
+from key_registry import KeyResolver
+from metrics import DB_CONNECT_SECONDS, cursor_factory, timed
+
+ARCHIVE_DIR = Path(os.environ.get("ARCHIVE_DIR", "archive"))
+
+# Colonne dei blocchi archiviati, nell'ordine delle tuple restituite da ChainArchive.
+ARCHIVE_COLUMNS = ("id", "document_id", "signer", "signed_at", "document_hash", "prev_hash", "signature", "key_id",
+                   "hash_algorithm")
+
+_EXTENSIONS = {"zstd": ".jsonl.zst", "xz": ".jsonl.xz"}
+
+
+class ArchiveError(Exception):
+    """
+    Segmento non archiviabile o file di archivio non integro.
+
+    Attributes:
+        archived (list[dict]): Se sollevata da `archive_segments`, i segmenti
+                               archiviati prima dell'errore.
+    """
+    archived = ()
+
+
+def default_compression() -> str:
+    return "zstd" if zstandard is not None else "xz"
+
+
+def _compress(data: bytes, compression: str) -> bytes:
+    if compression == "zstd":
+        if zstandard is None:
+            raise ArchiveError("Compressione zstd richiesta ma il pacchetto 'zstandard' non è installato.")
+        return zstandard.ZstdCompressor(level=19).compress(data)
+    if compression == "xz":
+        return lzma.compress(data, preset=6)
+    raise ArchiveError(f"Compressione non supportata: {compression}")
+
+
+def _decompress(data: bytes, compression: str) -> bytes:
+    if compression == "zstd":
+        if zstandard is None:
+            raise ArchiveError("Il segmento è compresso con zstd ma il pacchetto 'zstandard' non è installato.")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if compression == "xz":
+        return lzma.decompress(data)
+    raise ArchiveError(f"Compressione non supportata: {compression}")
+
+
+def _segment_rows(rows) -> list[tuple]:
+    """
+    Proietta le tuple di ARCHIVE_COLUMNS sulle colonne usate da `segment_hash`.
+    """
+    return [(r[0], r[1], r[2], r[4], r[5], r[6]) for r in rows]
+
+
+def archive_segments(conn, archive_dir: Path = ARCHIVE_DIR, keep_segments: int = 1, max_segments: int | None = None,
+                     compression: str | None = None, key_resolver: KeyResolver | None = None) -> list[dict]:
+    """
+    Archivia i segmenti sigillati più vecchi, lasciando nella tabella gli ultimi
+    `keep_segments` segmenti sigillati e i blocchi non ancora coperti da un checkpoint.
+
+    Args:
+        conn: Connessione psycopg2 come `archiver` (o un altro ruolo autorizzato al DELETE
+              su signature_chain).
+        archive_dir (Path, optional): Directory dei file di archivio. Defaults to ARCHIVE_DIR.
+        keep_segments (int, optional): Segmenti sigillati da mantenere nella tabella. Defaults to 1.
+        max_segments (int | None, optional): Numero massimo di segmenti da archiviare in
+                                             questa esecuzione. Defaults to None (nessun limite).
+        compression (str | None, optional): "zstd" o "xz". Defaults a zstd se disponibile.
+        key_resolver (KeyResolver | None, optional): Il resolver delle chiavi dei checkpoint.
+                                                     Defaults a un KeyResolver su `conn`.
+
+    Returns:
+        list[dict]: I segmenti archiviati (checkpoint, intervallo di blocchi, file, dimensione).
+
+    Raises:
+        ArchiveError: Se un segmento non supera le verifiche; i segmenti precedenti restano
+                      archiviati e sono riportati in `ArchiveError.archived`.
+    """
+    compression = compression or default_compression()
+    key_resolver = key_resolver or KeyResolver(conn)
+    archive_dir = Path(archive_dir)
+    archive_dir.mkdir(parents=True, exist_ok=True)
+
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT coalesce(max(last_block_id), 0) FROM archived_segments")
+        archived_until = cursor.fetchone()[0]
+        cursor.execute(
+            """
+            SELECT id, first_block_id, last_block_id, block_count, segment_hash, prev_signature, signer,
+                   created_at, signature
+            FROM chain_checkpoints
+            WHERE first_block_id > %s
+            ORDER BY id
+            """,
+            (archived_until,))
+        candidates = cursor.fetchall()
+    conn.rollback()
+
+    candidates = candidates[:max(0, len(candidates) - keep_segments)]
+    if max_segments is not None:
+        candidates = candidates[:max_segments]
+
+    archived = []
+    try:
+        _archive_candidates(conn, candidates, archived_until, archive_dir, compression, key_resolver, archived)
+    except ArchiveError as error:
+        error.archived = archived
+        raise
+    return archived
+
+
+def _archive_candidates(conn, candidates, archived_until, archive_dir, compression, key_resolver, archived):
+    """
+    Archivia i segmenti candidati in ordine, aggiungendo ad `archived` quelli completati.
+    """
+    for (checkpoint_id, first_id, last_id, block_count, expected_hash, prev_signature, signer,
+         created_at, signature) in candidates:
+        if first_id != archived_until + 1:
+            raise ArchiveError(f"Il checkpoint {checkpoint_id} inizia dal blocco {first_id}, "
+                               f"atteso {archived_until + 1}: l'archivio deve restare un prefisso della catena.")
+
+        public_key = key_resolver.resolve(signer, signed_at=created_at)
+        if public_key is None:
+            raise ArchiveError(f"Chiave del checkpoint {checkpoint_id} ('{signer}') non presente in signer_keys.")
+        try:
+            public_key.verify(bytes.fromhex(signature),
+                              checkpoint_signing_input(prev_signature, first_id, last_id, block_count, expected_hash),
+                              padding.PKCS1v15(), hashes.SHA256())
+        except (InvalidSignature, ValueError):
+            raise ArchiveError(f"Firma del checkpoint {checkpoint_id} non valida.") from None
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT {', '.join(ARCHIVE_COLUMNS)} FROM signature_chain_blocks WHERE id BETWEEN %s AND %s ORDER BY id",
+                    (first_id, last_id))
+                rows = cursor.fetchall()
+                if len(rows) != block_count or segment_hash(_segment_rows(rows)) != expected_hash:
+                    raise ArchiveError(f"Il segmento del checkpoint {checkpoint_id} (blocchi {first_id}-{last_id}) "
+                                       "non corrisponde all'hash firmato: archiviazione interrotta.")
+
+                payload = "".join(
+                    json.dumps({"id": r[0], "document_id": str(r[1]), "signer": r[2], "signed_at": r[3].isoformat(),
+                                "document_hash": r[4], "prev_hash": r[5], "signature": r[6], "key_id": r[7],
+                                "hash_algorithm": r[8]}) + "\n"
+                    for r in rows).encode()
+                data = _compress(payload, compression)
+                file_name = f"segment-{first_id:012d}-{last_id:012d}{_EXTENSIONS[compression]}"
+                _write_file(archive_dir / file_name, data)
+
+                cursor.execute(
+                    """
+                    INSERT INTO archived_segments
+                        (checkpoint_id, first_block_id, last_block_id, block_count, segment_hash,
+                         file_name, compression, file_sha256)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    """,
+                    (checkpoint_id, first_id, last_id, block_count, expected_hash, file_name, compression,
+                     hashlib.sha256(data).hexdigest()))
+                # La testa di ogni documento del segmento sopravvive al DELETE.
+                cursor.execute(
+                    """
+                    INSERT INTO archived_heads (document_id, block_id, signature)
+                    SELECT DISTINCT ON (document_id) document_id, id, signature
+                    FROM signature_chain
+                    WHERE id BETWEEN %s AND %s
+                    ORDER BY document_id, id DESC
+                    ON CONFLICT (document_id) DO UPDATE
+                        SET block_id = EXCLUDED.block_id, signature = EXCLUDED.signature
+                        WHERE archived_heads.block_id < EXCLUDED.block_id
+                    """,
+                    (first_id, last_id))
+                # Anche i request_id restano noti: una richiesta ripetuta non inserisce un secondo blocco.
+                cursor.execute(
+                    """
+                    INSERT INTO archived_requests
+                        (document_id, request_id, block_id, signature, signer, document_hash, hash_algorithm)
+                    SELECT sc.document_id, sc.request_id, sc.id, sc.signature, sc.signer,
+                           coalesce(sc.document_hash, d.hash), coalesce(d.algorithm, 'sha256')
+                    FROM signature_chain sc
+                    LEFT JOIN documents d ON d.id = sc.document_ref
+                    WHERE sc.id BETWEEN %s AND %s AND sc.request_id IS NOT NULL
+                    """,
+                    (first_id, last_id))
+                cursor.execute("DELETE FROM signature_chain WHERE id BETWEEN %s AND %s", (first_id, last_id))
+                if cursor.rowcount != block_count:
+                    raise ArchiveError(f"Cancellati {cursor.rowcount} blocchi invece di {block_count} "
+                                       f"per il checkpoint {checkpoint_id}.")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        archived_until = last_id
+        archived.append({"checkpoint_id": checkpoint_id, "first_block_id": first_id, "last_block_id": last_id,
+                         "blocks": block_count, "file_name": file_name, "raw_bytes": len(payload),
+                         "compressed_bytes": len(data)})
+
+
+def backfill_archived_heads(conn, archive: "ChainArchive | None" = None) -> int:
+    """
+    Ricostruisce `archived_heads` dai segmenti già archiviati, per i database
+    archiviati prima che la tabella esistesse. Un segmento non integro
+    interrompe la ricostruzione senza scrivere nulla.
+
+    Args:
+        conn: Connessione psycopg2 come `archiver`.
+        archive (ChainArchive | None, optional): L'archivio da leggere. Defaults a `ChainArchive()`.
+
+    Returns:
+        int: Il numero di documenti la cui testa è stata inserita o aggiornata.
+
+    Raises:
+        ArchiveError: Se un segmento manca o non corrisponde al suo checkpoint.
+    """
+    archive = archive or ChainArchive()
+    heads = {}
+    for segment in archive.segments(conn):
+        for row in archive.read_segment(segment):
+            heads[row[1]] = (row[0], row[6])
+
+    updated = 0
+    try:
+        with conn.cursor() as cursor:
+            for document_id, (block_id, signature) in heads.items():
+                cursor.execute(
+                    """
+                    INSERT INTO archived_heads (document_id, block_id, signature)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (document_id) DO UPDATE
+                        SET block_id = EXCLUDED.block_id, signature = EXCLUDED.signature
+                        WHERE archived_heads.block_id < EXCLUDED.block_id
+                    """,
+                    (document_id, block_id, signature))
+                updated += cursor.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return updated
+
+
+def _write_file(path: Path, data: bytes) -> None:
+    """
+    Scrive il file in modo atomico e lo rende persistente prima che i blocchi
+    vengano cancellati dalla tabella.
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as archive_file:
+        archive_file.write(data)
+        archive_file.flush()
+        os.fsync(archive_file.fileno())
+    os.replace(tmp_path, path)
+
+
+class ChainArchive:
+    """
+    Lettura dei segmenti archiviati, con controllo di integrità di ogni file.
+    """
+
+    def __init__(self, archive_dir: Path = ARCHIVE_DIR):
+        """
+        Args:
+            archive_dir (Path, optional): Directory dei file di archivio. Defaults to ARCHIVE_DIR.
+        """
+        self.archive_dir = Path(archive_dir)
+
+    def segments(self, conn, max_block_id: int | None = None) -> list[tuple]:
+        """
+        Restituisce l'indice dei segmenti archiviati, in ordine di blocco.
+        """
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT checkpoint_id, first_block_id, last_block_id, block_count, segment_hash,
+                       file_name, compression, file_sha256
+                FROM archived_segments
+                WHERE %s IS NULL OR first_block_id <= %s
+                ORDER BY first_block_id
+                """,
+                (max_block_id, max_block_id))
+            return cursor.fetchall()
+
+    def read_segment(self, segment: tuple) -> list[tuple]:
+        """
+        Legge i blocchi di un segmento archiviato.
+
+        Args:
+            segment (tuple): Una riga dell'indice restituita da `segments`.
+
+        Returns:
+            list[tuple]: I blocchi, con le colonne di ARCHIVE_COLUMNS.
+
+        Raises:
+            ArchiveError: Se il file manca, non corrisponde all'impronta registrata o
+                          i blocchi non corrispondono all'hash del segmento.
+        """
+        checkpoint_id, first_id, last_id, block_count, expected_hash, file_name, compression, file_sha256 = segment
+        path = self.archive_dir / file_name
+        try:
+            data = path.read_bytes()
+        except OSError as error:
+            raise ArchiveError(f"File del segmento {first_id}-{last_id} non leggibile: {error}") from None
+        if hashlib.sha256(data).hexdigest() != file_sha256:
+            raise ArchiveError(f"Il file {file_name} non corrisponde all'impronta registrata.")
+
+        rows = []
+        for line in _decompress(data, compression).splitlines():
+            block = json.loads(line)
+            rows.append((block["id"], block["document_id"], block["signer"],
+                         datetime.fromisoformat(block["signed_at"]), block["document_hash"], block["prev_hash"],
+                         block["signature"], block["key_id"],
+                         # Gli archivi precedenti alla colonna documents.algorithm sono tutti SHA256.
+                         block.get("hash_algorithm", "sha256")))
+        if len(rows) != block_count or segment_hash(_segment_rows(rows)) != expected_hash:
+            raise ArchiveError(f"I blocchi del file {file_name} non corrispondono all'hash del checkpoint "
+                               f"{checkpoint_id}.")
+        return rows
+
+    def load(self, conn, max_block_id: int | None = None) -> tuple[list[tuple], list[dict]]:
+        """
+        Legge tutti i segmenti archiviati (fino a `max_block_id`).
+
+        Returns:
+            tuple[list[tuple], list[dict]]: I blocchi archiviati in ordine di ID e gli
+                                            errori dei segmenti non leggibili o non integri.
+        """
+        rows, errors = [], []
+        for segment in self.segments(conn, max_block_id):
+            try:
+                rows.extend(row for row in self.read_segment(segment)
+                            if max_block_id is None or row[0] <= max_block_id)
+            except ArchiveError as error:
+                errors.append({"checkpoint_id": segment[0], "first_block_id": segment[1],
+                               "last_block_id": segment[2], "error": str(error)})
+        return rows, errors
+
+
+class ArchivedHeads:
+    """
+    Ultima firma archiviata di ogni documento e dell'intera catena, per ancorare
+    i primi blocchi rimasti in tabella dopo l'archiviazione: il loro
+    predecessore non è più in `signature_chain`.
+
+    I segmenti vengono letti (con i controlli di `ChainArchive.read_segment`)
+    solo quando serve, dal più recente, e le firme trovate restano in cache.
+    Se nel frattempo viene archiviato un nuovo segmento, la cache viene ricostruita.
+    """
+
+    def __init__(self, archive: ChainArchive | None = None):
+        """
+        Args:
+            archive (ChainArchive | None, optional): L'archivio da cui leggere i segmenti.
+                                                     Defaults a `ChainArchive()` (directory ARCHIVE_DIR).
+        """
+        self.archive = archive or ChainArchive()
+        self._boundary = None
+        self._pending = []
+        self._heads = {}
+        self._last_signature = None
+
+    def boundary(self, conn) -> int:
+        """
+        Restituisce l'ID dell'ultimo blocco archiviato (0 se l'archivio è vuoto),
+        aggiornando l'indice dei segmenti se è cambiato.
+        """
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT coalesce(max(last_block_id), 0) FROM archived_segments")
+            boundary = cursor.fetchone()[0]
+        if boundary != self._boundary:
+            self._boundary = boundary
+            self._pending = self.archive.segments(conn) if boundary else []
+            self._heads = {}
+            rows = self._read_next() if self._pending else []
+            self._last_signature = rows[-1][6] if rows else None
+        return boundary
+
+    def document_signature(self, conn, document_id) -> str | None:
+        """
+        Restituisce la firma dell'ultimo blocco archiviato del documento, se presente.
+        """
+        document_key = str(document_id)
+        self.boundary(conn)
+        while document_key not in self._heads and self._pending:
+            self._read_next()
+        return self._heads.get(document_key)
+
+    def last_signature(self, conn) -> str | None:
+        """
+        Restituisce la firma dell'ultimo blocco archiviato dell'intera catena.
+        """
+        self.boundary(conn)
+        return self._last_signature
+
+    def _read_next(self) -> list[tuple]:
+        segment = self._pending.pop()
+        try:
+            rows = self.archive.read_segment(segment)
+        except ArchiveError:
+            # Un segmento illeggibile non fornisce ancore: i blocchi che vi si
+            # collegano risultano non collegati.
+            return []
+        heads = {}
+        for row in rows:
+            heads[row[1]] = row[6]
+        # Dal segmento più recente al più vecchio: vince la firma già trovata.
+        for document_key, signature in heads.items():
+            self._heads.setdefault(document_key, signature)
+        return rows
+
+
+if __name__ == "__main__":
+    archiver_db_user = os.environ.get("ARCHIVER_DB_USER", "archiver")
+    archiver_db_password = os.environ.get("ARCHIVER_DB_PASSWORD", "archiver_password")
+    db_name = os.environ.get("DB_NAME", "signature_demo")
+    db_host = os.environ.get("DB_HOST", "localhost")
+    keep_segments = int(os.environ.get("ARCHIVE_KEEP_SEGMENTS", "1"))
+
+    with timed(DB_CONNECT_SECONDS):
+        conn = psycopg2.connect(dbname=db_name, user=archiver_db_user, password=archiver_db_password, host=db_host,
+                                cursor_factory=cursor_factory())
+    try:
+        if "--backfill-heads" in sys.argv:
+            try:
+                print(f"Teste archiviate ricostruite: {backfill_archived_heads(conn)} documenti")
+            except ArchiveError as error:
+                print(f"Ricostruzione delle teste archiviate interrotta: {error}")
+            raise SystemExit(0)
+        try:
+            archived = archive_segments(conn, keep_segments=keep_segments)
+        except ArchiveError as error:
+            archived = error.archived
+            print(f"Archiviazione interrotta: {error}")
+        for segment in archived:
+            print(f"Archiviato il segmento {segment['first_block_id']}-{segment['last_block_id']} "
+                  f"({segment['blocks']} blocchi) in {segment['file_name']}: "
+                  f"{segment['raw_bytes']} -> {segment['compressed_bytes']} byte")
+        print(f"Segmenti archiviati in questa esecuzione: {len(archived)}")
+    finally:
+        conn.close()
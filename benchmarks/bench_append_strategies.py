@@ -0,0 +1,189 @@
+"""
+Benchmark del throughput degli append concorrenti: advisory lock contro SERIALIZABLE.
+
+`--workers` thread, ognuno con la propria connessione, aggiungono blocchi a
+`--documents` catene scelte a caso: meno documenti significano più contesa.
+Ogni append legge la testa della catena, attende `--think-ms` (elaborazione o
+ritardo di rete tra lettura e INSERT), firma e inserisce il blocco:
+
+- advisory: il tutto in una transazione che tiene `pg_advisory_xact_lock` del
+  documento (`mthread_advisory_lock.py`);
+- serializable: in una transazione SERIALIZABLE senza lock, ritentata in caso
+  di SQLSTATE 40001 (`mthread_serializable.append_serializable`).
+
+Per ogni strategia si riportano append al secondo, latenza media e p99, le
+transazioni ripetute e gli append rinunciati, e si controlla che nessuna
+catena si sia biforcata. Con `--sign` i blocchi vengono firmati davvero (RSA
+2048), così che ogni tentativo ripetuto paghi anche la nuova firma.
+
+Uso (dalla radice del repository):
+
+    python -m benchmarks.bench_append_strategies --workers 8 --documents 4 --duration 10
+"""
+import argparse
+import os
+import random
+import statistics
+import threading
+import time
+from uuid import uuid4
+
+import psycopg2
+
+from mthread_advisory_lock import acquire_advisory_lock, generate_advisory_lock_key
+from mthread_serializable import RetryPolicy, SerializationRetriesExhausted, append_serializable, retry_telemetry
+from prepared_statements import HEAD_BY_DOCUMENT, INSERT_BLOCK, execute_prepared
+from signature_chain import core
+
+db_name = os.environ.get("DB_NAME", "signature_demo")
+db_user = os.environ.get("SUPER_DB_USER", "postgres")
+db_password = os.environ.get("SUPER_DB_PASSWORD", "postgres")
+db_host = os.environ.get("DB_HOST", "localhost")
+
+# Hash fittizio a lunghezza realistica (SHA256 in esadecimale).
+FAKE_DOCUMENT_HASH = "ab" * 32
+
+STRATEGIES = ("advisory", "serializable")
+
+
+def fake_sign(data: bytes) -> str:
+    """
+    Firma fittizia, lunga quanto una firma RSA 2048 in esadecimale e diversa
+    per ogni blocco, così che le catene restino verificabili per biforcazioni.
+    """
+    return core.hash_document(data) * 8
+
+
+def append_advisory(conn, document_id: str, sign, think) -> None:
+    """
+    Un append protetto dall'advisory lock del documento.
+    """
+    with conn.cursor() as cur:
+        acquire_advisory_lock(cur, generate_advisory_lock_key(document_id))
+        execute_prepared(cur, HEAD_BY_DOCUMENT, (document_id,))
+        row = cur.fetchone()
+        prev_hash = row[0] if row else None
+        think()
+        signature = sign(core.signing_input(prev_hash, FAKE_DOCUMENT_HASH))
+        execute_prepared(cur, INSERT_BLOCK, (document_id, "Benchmark", FAKE_DOCUMENT_HASH, prev_hash, signature,
+                                             "sha256"))
+        cur.fetchone()
+    conn.commit()
+
+
+def run_strategy(strategy: str, documents: list[str], workers: int, duration: float, think_ms: float,
+                 sign, retry_policy: RetryPolicy) -> dict:
+    """
+    Esegue append concorrenti con una strategia per `duration` secondi.
+
+    Args:
+        strategy (str): "advisory" o "serializable".
+        documents (list[str]): I documenti su cui distribuire gli append.
+        workers (int): I thread concorrenti, ognuno con la propria connessione.
+        duration (float): La durata della misura in secondi.
+        think_ms (float): Attesa media tra lettura della testa e INSERT, in millisecondi.
+        sign: Funzione di firma dei dati di un blocco.
+        retry_policy (RetryPolicy): La politica di ripetizione della strategia SERIALIZABLE.
+
+    Returns:
+        dict: {"appends", "elapsed", "latencies", "retries", "exhausted"}; le transazioni
+              ripetute e gli append rinunciati vengono da `retry_telemetry`.
+    """
+    retry_telemetry.clear()
+    latencies = []
+    results_lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def think():
+        if think_ms > 0:
+            time.sleep(random.uniform(0.5, 1.5) * think_ms / 1000)
+
+    def worker():
+        conn = psycopg2.connect(dbname=db_name, user=db_user, password=db_password, host=db_host)
+        local_latencies = []
+        try:
+            while time.perf_counter() < deadline:
+                document_id = random.choice(documents)
+                start = time.perf_counter()
+                if strategy == "advisory":
+                    append_advisory(conn, document_id, sign, think)
+                else:
+                    try:
+                        append_serializable(conn, document_id, "Benchmark", FAKE_DOCUMENT_HASH, sign,
+                                            retry_policy=retry_policy, think=think)
+                    except SerializationRetriesExhausted:
+                        continue
+                local_latencies.append(time.perf_counter() - start)
+        finally:
+            conn.close()
+        with results_lock:
+            latencies.extend(local_latencies)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stats = retry_telemetry.snapshot()
+    return {"appends": len(latencies), "elapsed": elapsed, "latencies": latencies, "retries": stats["retries"],
+            "exhausted": stats["exhausted"]}
+
+
+def count_forks(conn, documents: list[str]) -> int:
+    """
+    Conta i prev_hash condivisi da più blocchi nelle catene di benchmark.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT count(*) FROM (SELECT 1 FROM signature_chain WHERE document_id = ANY(%s::uuid[]) "
+            "GROUP BY document_id, prev_hash HAVING count(*) > 1) AS forks", (documents,))
+        return cur.fetchone()[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--strategies", default=",".join(STRATEGIES),
+                        help="strategie da confrontare, separate da virgola")
+    parser.add_argument("--workers", type=int, default=8, help="thread concorrenti")
+    parser.add_argument("--documents", type=int, default=4, help="catene su cui distribuire gli append")
+    parser.add_argument("--duration", type=float, default=10, help="durata di ogni misura in secondi")
+    parser.add_argument("--think-ms", type=float, default=1.0,
+                        help="attesa media tra lettura della testa e INSERT, in millisecondi")
+    parser.add_argument("--max-attempts", type=int, default=RetryPolicy().max_attempts,
+                        help="tentativi massimi per append SERIALIZABLE")
+    parser.add_argument("--sign", action="store_true", help="firma i blocchi con RSA invece di una firma fittizia")
+    args = parser.parse_args()
+
+    if args.sign:
+        private_key_pem, _ = core.generate_keys()
+        sign = lambda data: core.sign_data(data, private_key_pem)  # noqa: E731
+    else:
+        sign = fake_sign
+    retry_policy = RetryPolicy(max_attempts=args.max_attempts)
+
+    conn = psycopg2.connect(dbname=db_name, user=db_user, password=db_password, host=db_host)
+    document_ids = []
+    try:
+        print(f"{args.workers} worker, {args.documents} documenti, attesa {args.think_ms} ms, "
+              f"{'firma RSA' if args.sign else 'firma fittizia'}, {args.duration} s per strategia:")
+        for strategy in args.strategies.split(","):
+            # Catene nuove per ogni strategia, così che partano dalle stesse condizioni.
+            documents = [str(uuid4()) for _ in range(args.documents)]
+            document_ids.extend(documents)
+            result = run_strategy(strategy, documents, args.workers, args.duration, args.think_ms, sign,
+                                  retry_policy)
+
+            ordered = sorted(result["latencies"]) or [0.0]
+            p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+            print(f"{strategy:<13} {result['appends'] / result['elapsed']:9.1f} append/s  "
+                  f"media: {statistics.mean(ordered) * 1000:7.2f} ms  p99: {p99 * 1000:7.2f} ms  "
+                  f"ripetute: {result['retries']:6d}  rinunciati: {result['exhausted']:4d}  "
+                  f"biforcazioni: {count_forks(conn, documents)}")
+    finally:
+        # Rimuove i blocchi di benchmark (richiede un utente che bypassa la RLS)
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM signature_chain WHERE document_id = ANY(%s::uuid[])", (document_ids,))
+        conn.commit()
+        conn.close()
@@ -0,0 +1,134 @@
+"""
+Micro-benchmark della latenza per append con e senza prepared statement.
+
+Ogni append esegue, in una transazione, la lettura della testa della catena
+del documento e l'INSERT del nuovo blocco. La firma è precalcolata, in modo
+da misurare solo il costo lato database (invio, parsing, pianificazione ed
+esecuzione delle query).
+
+Uso (dalla radice del repository):
+
+    python -m benchmarks.bench_prepared_statements --appends 2000
+"""
+import argparse
+import os
+import statistics
+import time
+from uuid import uuid4
+
+import psycopg2
+
+from prepared_statements import HEAD_BY_DOCUMENT, INSERT_BLOCK, execute_prepared
+
+db_name = os.environ.get("DB_NAME", "signature_demo")
+db_user = os.environ.get("SUPER_DB_USER", "postgres")
+db_password = os.environ.get("SUPER_DB_PASSWORD", "postgres")
+db_host = os.environ.get("DB_HOST", "localhost")
+
+# Stessa query di HEAD_BY_DOCUMENT, senza PREPARE.
+HEAD_SQL = ("SELECT coalesce((SELECT signature FROM signature_chain WHERE document_id = %(document_id)s "
+            "ORDER BY id DESC LIMIT 1), (SELECT signature FROM archived_heads WHERE document_id = %(document_id)s))")
+INSERT_SQL = """
+    INSERT INTO signature_chain (document_id, signer, document_ref, prev_hash, signature)
+    VALUES (%s, %s, document_ref(%s, NULL, %s), %s, %s) RETURNING id;
+"""
+
+# Valori fittizi a lunghezza realistica: hash SHA256 e firma RSA 2048 in esadecimale.
+FAKE_DOCUMENT_HASH = "ab" * 32
+FAKE_SIGNATURE = "cd" * 256
+
+
+def run_appends(conn, document_id: str, appends: int, prepared: bool) -> list[float]:
+    """
+    Esegue `appends` append sulla catena di `document_id` e ne misura la latenza.
+    Il primo append di una catena vuota inserisce il blocco genesi.
+
+    Args:
+        conn: La connessione al database psycopg2.
+        document_id (str): L'ID del documento di benchmark.
+        appends (int): Il numero di append da eseguire.
+        prepared (bool): True per usare i prepared statement, False per le query testuali.
+
+    Returns:
+        list[float]: La latenza di ogni append in secondi.
+    """
+    latencies = []
+
+    with conn.cursor() as cur:
+        for _ in range(appends):
+            start = time.perf_counter()
+            if prepared:
+                execute_prepared(cur, HEAD_BY_DOCUMENT, (document_id,))
+            else:
+                cur.execute(HEAD_SQL, {"document_id": document_id})
+            row = cur.fetchone()
+            prev_hash = row[0] if row else None
+
+            if prepared:
+                execute_prepared(cur, INSERT_BLOCK,
+                                 (document_id, "Benchmark", FAKE_DOCUMENT_HASH, prev_hash, FAKE_SIGNATURE, "sha256"))
+            else:
+                cur.execute(INSERT_SQL,
+                            (document_id, "Benchmark", FAKE_DOCUMENT_HASH, "sha256", prev_hash, FAKE_SIGNATURE))
+            cur.fetchone()
+            conn.commit()
+            latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+
+def print_report(label: str, latencies: list[float]) -> None:
+    """
+    Stampa media, mediana e 99° percentile delle latenze in millisecondi.
+
+    Args:
+        label (str): L'etichetta della serie.
+        latencies (list[float]): Le latenze misurate in secondi.
+    """
+    ordered = sorted(latencies)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(f"{label:<12} media: {statistics.mean(ordered) * 1000:.3f} ms  "
+          f"mediana: {statistics.median(ordered) * 1000:.3f} ms  "
+          f"p99: {p99 * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--appends", type=int, default=1000,
+                        help="numero di append per ciascuna modalità")
+    parser.add_argument("--warmup", type=int, default=50,
+                        help="append di riscaldamento non misurati")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(dbname=db_name, user=db_user, password=db_password, host=db_host)
+    document_ids = []
+
+    try:
+        modes = (("testuali", False), ("preparate", True))
+        results = {label: [] for label, _ in modes}
+        documents = {label: str(uuid4()) for label, _ in modes}
+        document_ids.extend(documents.values())
+
+        for label, prepared in modes:
+            run_appends(conn, documents[label], args.warmup, prepared)
+
+        # Le due modalità si alternano a piccoli lotti, così che entrambe
+        # lavorino su una tabella di dimensioni confrontabili.
+        batch = 50
+        for offset in range(0, args.appends, batch):
+            for label, prepared in modes:
+                results[label].extend(run_appends(
+                    conn, documents[label], min(batch, args.appends - offset), prepared))
+
+        print(f"Latenza per append ({args.appends} append per modalità):")
+        for label, latencies in results.items():
+            print_report(label, latencies)
+
+        speedup = statistics.mean(results["testuali"]) / statistics.mean(results["preparate"])
+        print(f"Rapporto testuali/preparate: {speedup:.2f}x")
+    finally:
+        # Rimuove i blocchi di benchmark (richiede un utente che bypassa la RLS)
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM signature_chain WHERE document_id = ANY(%s::uuid[])", (document_ids,))
+        conn.commit()
+        conn.close()
@@ -0,0 +1,383 @@
+"""
+Rappresentazione compatta in memoria di un tratto della catena di firme.
+
+Come tuple di str ogni blocco costa oltre 1 KB: gli hash e le firme sono
+stringhe esadecimali (una firma RSA-2048 sono 512 caratteri) e ogni oggetto ha
+il proprio header. `ChainSegment` memorizza le stesse colonne in strutture
+contigue a passo fisso:
+
+    - ID e signed_at (microsecondi UTC) in `array('q')`;
+    - document_id (16 byte), document_hash, prev_hash e firma in `bytearray`,
+      come byte grezzi invece che esadecimali;
+    - firmatari e key_id come indici `array('I')` in una tabella di nomi (4 byte:
+      gli indici a 2 byte traboccherebbero oltre 65.535 firmatari o chiavi).
+
+Un blocco RSA-2048 con SHA256 occupa così circa 580 byte. Gli accessori `*_view`
+restituiscono `memoryview` sui buffer, senza copie: il confronto tra il
+prev_hash di un blocco e la firma del precedente avviene tra byte, senza
+creare stringhe. I valori che non rientrano nel passo fisso (ad esempio un
+hash manomesso non esadecimale o di lunghezza diversa) vengono conservati
+invariati in un dizionario di overflow, così che la ricostruzione delle righe
+sia sempre fedele al database.
+
+Esempio:
+
+    segment = ChainSegment.load(conn, document_id=document_id)
+    errors = segment.verify(KeyResolver(conn))
+"""
+from array import array
+import bisect
+from datetime import datetime, timezone
+import sys
+from uuid import UUID
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+
+COLUMNS = "id, document_id, signer, signed_at, document_hash, prev_hash, signature, key_id"
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Flag per blocco.
+_PREV_NULL = 1
+_OVERFLOW = 2
+
+
+class ChainSegment:
+    """
+    Blocchi della catena in ordine di ID crescente, in buffer a passo fisso.
+    """
+    __slots__ = ("hash_size", "signature_size", "ids", "signed_at_us", "signer_indexes", "key_indexes",
+                 "flags", "document_ids", "document_hashes", "prev_hashes", "signatures",
+                 "signers", "key_ids", "overflow", "_signer_lookup", "_key_lookup")
+
+    def __init__(self, hash_size: int | None = None, signature_size: int | None = None):
+        """
+        Args:
+            hash_size (int | None, optional): Byte di un document_hash (32 per SHA256).
+                                              Defaults alla lunghezza nel primo blocco.
+            signature_size (int | None, optional): Byte di una firma (256 per RSA-2048).
+                                                   Defaults alla lunghezza nel primo blocco.
+        """
+        self.hash_size = hash_size
+        self.signature_size = signature_size
+        self.ids = array("q")
+        self.signed_at_us = array("q")
+        self.signer_indexes = array("I")
+        self.key_indexes = array("I")
+        self.flags = bytearray()
+        self.document_ids = bytearray()
+        self.document_hashes = bytearray()
+        self.prev_hashes = bytearray()
+        self.signatures = bytearray()
+        self.signers = []
+        self.key_ids = [None]
+        self.overflow = {}
+        self._signer_lookup = {}
+        self._key_lookup = {None: 0}
+
+    @classmethod
+    def from_rows(cls, rows, **options) -> "ChainSegment":
+        """
+        Costruisce un segmento da righe nelle colonne `COLUMNS`.
+        """
+        segment = cls(**options)
+        segment.extend(rows)
+        return segment
+
+    @classmethod
+    def load(cls, conn, document_id: str | None = None, first_block_id: int | None = None,
+             last_block_id: int | None = None, batch_size: int = 10000, **options) -> "ChainSegment":
+        """
+        Carica dal database i blocchi indicati con un cursore lato server, senza
+        materializzare l'intero risultato come tuple.
+
+        Args:
+            conn: La connessione al database psycopg2.
+            document_id (str | None, optional): Solo i blocchi di questo documento.
+            first_block_id (int | None, optional): ID minimo (incluso).
+            last_block_id (int | None, optional): ID massimo (incluso).
+            batch_size (int, optional): Righe lette per round trip. Defaults to 10000.
+            **options: Passo dei buffer (`hash_size`, `signature_size`).
+        """
+        segment = cls(**options)
+        with conn.cursor(name="chain_segment_load", withhold=conn.autocommit) as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(
+                f"SELECT {COLUMNS} FROM signature_chain_blocks "
+                "WHERE (%(document_id)s::uuid IS NULL OR document_id = %(document_id)s::uuid) "
+                "AND (%(first_id)s::integer IS NULL OR id >= %(first_id)s::integer) "
+                "AND (%(last_id)s::integer IS NULL OR id <= %(last_id)s::integer) ORDER BY id",
+                {"document_id": document_id, "first_id": first_block_id, "last_id": last_block_id})
+            segment.extend(cursor)
+        return segment
+
+    def append(self, block_id: int, document_id, signer: str, signed_at: datetime, document_hash: str,
+               prev_hash: str | None, signature: str, key_id: str | None = None) -> None:
+        """
+        Aggiunge un blocco in coda al segmento.
+
+        Raises:
+            ValueError: Se l'ID non è maggiore di quello dell'ultimo blocco.
+        """
+        if self.ids and block_id <= self.ids[-1]:
+            raise ValueError(f"ID {block_id} non crescente (ultimo ID: {self.ids[-1]}).")
+        if not self.ids:
+            self.hash_size = self.hash_size or len(document_hash) // 2
+            self.signature_size = self.signature_size or len(signature) // 2
+        index = len(self.ids)
+        flags = 0
+        overflow = {}
+
+        self.ids.append(block_id)
+        delta = signed_at - _EPOCH
+        self.signed_at_us.append((delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds)
+        self.signer_indexes.append(self._intern(signer, self.signers, self._signer_lookup))
+        self.key_indexes.append(self._intern(key_id, self.key_ids, self._key_lookup))
+        self.document_ids += (document_id if isinstance(document_id, UUID) else UUID(document_id)).bytes
+
+        for name, value, buffer, size in (("document_hash", document_hash, self.document_hashes, self.hash_size),
+                                          ("prev_hash", prev_hash, self.prev_hashes, self.signature_size),
+                                          ("signature", signature, self.signatures, self.signature_size)):
+            raw = _fixed_bytes(value, size)
+            if raw is None:
+                if value is None:
+                    flags |= _PREV_NULL
+                else:
+                    overflow[name] = value
+                raw = bytes(size)
+            buffer += raw
+
+        if overflow:
+            flags |= _OVERFLOW
+            self.overflow[index] = overflow
+        self.flags.append(flags)
+
+    def extend(self, rows) -> None:
+        for row in rows:
+            self.append(*row)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self):
+        """
+        Ricostruisce le righe nelle colonne `COLUMNS`, una alla volta.
+        """
+        return (self.row(index) for index in range(len(self.ids)))
+
+    def index(self, block_id: int) -> int:
+        """
+        Restituisce la posizione di un blocco per ID (ricerca binaria).
+
+        Raises:
+            KeyError: Se il blocco non è nel segmento.
+        """
+        index = bisect.bisect_left(self.ids, block_id)
+        if index == len(self.ids) or self.ids[index] != block_id:
+            raise KeyError(block_id)
+        return index
+
+    def row(self, index: int) -> tuple:
+        return (self.ids[index], self.document_id(index), self.signer(index), self.signed_at(index),
+                self.document_hash(index), self.prev_hash(index), self.signature(index), self.key_id(index))
+
+    def block_id(self, index: int) -> int:
+        return self.ids[index]
+
+    def document_id(self, index: int) -> str:
+        return str(UUID(bytes=bytes(self.document_id_view(index))))
+
+    def document_id_view(self, index: int) -> memoryview:
+        return memoryview(self.document_ids)[index * 16:(index + 1) * 16]
+
+    def signer(self, index: int) -> str:
+        return self.signers[self.signer_indexes[index]]
+
+    def key_id(self, index: int) -> str | None:
+        return self.key_ids[self.key_indexes[index]]
+
+    def signed_at(self, index: int) -> datetime:
+        seconds, microseconds = divmod(self.signed_at_us[index], 1_000_000)
+        return datetime.fromtimestamp(seconds, timezone.utc).replace(microsecond=microseconds)
+
+    def document_hash_view(self, index: int) -> memoryview | None:
+        """
+        I byte del document_hash, oppure None se il valore è in overflow.
+        """
+        return self._view("document_hash", self.document_hashes, self.hash_size, index)
+
+    def prev_hash_view(self, index: int) -> memoryview | None:
+        """
+        I byte del prev_hash, oppure None se NULL o in overflow.
+        """
+        if self.flags[index] & _PREV_NULL:
+            return None
+        return self._view("prev_hash", self.prev_hashes, self.signature_size, index)
+
+    def signature_view(self, index: int) -> memoryview | None:
+        """
+        I byte della firma, oppure None se il valore è in overflow.
+        """
+        return self._view("signature", self.signatures, self.signature_size, index)
+
+    def document_hash(self, index: int) -> str:
+        return self._hex("document_hash", self.document_hash_view(index), index)
+
+    def prev_hash(self, index: int) -> str | None:
+        if self.flags[index] & _PREV_NULL:
+            return None
+        return self._hex("prev_hash", self.prev_hash_view(index), index)
+
+    def signature(self, index: int) -> str:
+        return self._hex("signature", self.signature_view(index), index)
+
+    def signing_input(self, index: int) -> bytes:
+        """
+        I dati firmati dal blocco: prev_hash esadecimale (vuoto per il genesi) seguito dal document_hash.
+        """
+        return (self.prev_hash(index) or '').encode() + self.document_hash(index).encode()
+
+    def heads(self) -> dict[str, int]:
+        """
+        Restituisce, per ogni documento del segmento, la posizione del suo ultimo blocco.
+        """
+        last = {}
+        for index in range(len(self.ids)):
+            last[bytes(self.document_id_view(index))] = index
+        return {str(UUID(bytes=document_id)): index for document_id, index in last.items()}
+
+    def link_errors(self, heads: dict[str, str | None] | None = None) -> list[int]:
+        """
+        Restituisce le posizioni dei blocchi il cui prev_hash non è la firma del
+        blocco precedente dello stesso documento.
+
+        Args:
+            heads (dict | None, optional): Testa (firma esadecimale o None) dei documenti prima del
+                                           segmento; il primo blocco di un documento assente da
+                                           `heads` non viene controllato. Defaults to None.
+        """
+        errors = []
+        previous = {}
+        for index in range(len(self.ids)):
+            document_id = bytes(self.document_id_view(index))
+            if document_id in previous:
+                prev_index = previous[document_id]
+                prev_view, signature_view = self.prev_hash_view(index), self.signature_view(prev_index)
+                if prev_view is not None and signature_view is not None:
+                    linked = prev_view == signature_view
+                else:
+                    linked = self.prev_hash(index) == self.signature(prev_index)
+                if not linked:
+                    errors.append(index)
+            elif heads is not None:
+                document_key = str(UUID(bytes=document_id))
+                if document_key in heads and self.prev_hash(index) != heads[document_key]:
+                    errors.append(index)
+            previous[document_id] = index
+        return errors
+
+    def verify(self, key_resolver, heads: dict[str, str | None] | None = None) -> list[dict]:
+        """
+        Verifica collegamenti e firme dei blocchi del segmento.
+
+        Args:
+            key_resolver (KeyResolver): Il resolver del registro delle chiavi.
+            heads (dict | None, optional): Vedi `link_errors`.
+
+        Returns:
+            list[dict]: Gli errori trovati ({"block_id", "error"}), in ordine di ID.
+        """
+        errors = [{"block_id": self.ids[index], "error": "prev_hash non collegato al blocco precedente"}
+                  for index in self.link_errors(heads)]
+        key_resolver.prefetch_blocks(
+            (self.signers[signer_index], self.key_ids[key_index])
+            for signer_index, key_index in set(zip(self.signer_indexes, self.key_indexes)))
+
+        for index in range(len(self.ids)):
+            public_key = key_resolver.resolve(self.signer(index), self.key_id(index), self.signed_at(index))
+            if public_key is None:
+                errors.append({"block_id": self.ids[index], "error": f"chiave pubblica assente per '{self.signer(index)}'"})
+                continue
+            signature_view = self.signature_view(index)
+            try:
+                public_key.verify(bytes(signature_view) if signature_view is not None
+                                  else bytes.fromhex(self.signature(index)),
+                                  self.signing_input(index), padding.PKCS1v15(), hashes.SHA256())
+            except (InvalidSignature, ValueError):
+                errors.append({"block_id": self.ids[index], "error": "firma non valida"})
+
+        errors.sort(key=lambda error: error["block_id"])
+        return errors
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memoria occupata dai buffer del segmento (tabelle dei nomi e overflow esclusi).
+        """
+        return (sum(buffer.itemsize * len(buffer) for buffer in (self.ids, self.signed_at_us, self.signer_indexes,
+                                                                 self.key_indexes))
+                + sum(len(buffer) for buffer in (self.flags, self.document_ids, self.document_hashes,
+                                                 self.prev_hashes, self.signatures)))
+
+    @staticmethod
+    def _intern(value, table: list, lookup: dict) -> int:
+        index = lookup.get(value)
+        if index is None:
+            index = lookup[value] = len(table)
+            table.append(value)
+        return index
+
+    def _view(self, name: str, buffer: bytearray, size: int, index: int) -> memoryview | None:
+        if self.flags[index] & _OVERFLOW and name in self.overflow[index]:
+            return None
+        return memoryview(buffer)[index * size:(index + 1) * size]
+
+    def _hex(self, name: str, view: memoryview | None, index: int) -> str:
+        if view is None:
+            return self.overflow[index][name]
+        return view.hex()
+
+
+def _fixed_bytes(value: str | None, size: int) -> bytes | None:
+    """
+    Converte un valore esadecimale in byte se ha esattamente `size` byte e la
+    conversione è reversibile (esadecimale minuscolo); altrimenti None.
+    """
+    if value is None or len(value) != 2 * size:
+        return None
+    try:
+        raw = bytes.fromhex(value)
+    except ValueError:
+        return None
+    return raw if raw.hex() == value else None
+
+
+if __name__ == "__main__":
+    import os
+
+    import psycopg2
+
+    from key_registry import KeyResolver
+
+    with psycopg2.connect(dbname=os.environ.get("DB_NAME", "signature_demo"),
+                          user=os.environ.get("APP_DB_USER", "app_user"),
+                          password=os.environ.get("APP_DB_PASSWORD", "app_password"),
+                          host=os.environ.get("DB_HOST", "localhost")) as connection:
+        with connection.cursor() as tuple_cursor:
+            tuple_cursor.execute(f"SELECT {COLUMNS} FROM signature_chain_blocks ORDER BY id LIMIT 1000")
+            sample = tuple_cursor.fetchall()
+        chain = ChainSegment.load(connection)
+        segment_errors = chain.verify(KeyResolver(connection))
+    connection.close()
+
+    if sample:
+        tuple_bytes = sum(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) for row in sample)
+        print(f"Come tuple: ~{tuple_bytes / len(sample):.0f} byte per blocco (campione di {len(sample)}).")
+    if chain:
+        print(f"ChainSegment: {len(chain)} blocchi, {chain.nbytes / len(chain):.0f} byte per blocco "
+              f"({chain.nbytes / 1_048_576:.1f} MiB), {len(chain.overflow)} blocchi con valori in overflow.")
+    print(f"Errori di verifica: {len(segment_errors)}")
+    for segment_error in segment_errors[:20]:
+        print(f"  blocco {segment_error['block_id']}: {segment_error['error']}")
@@ -0,0 +1,397 @@
+"""
+Checkpoint firmati della catena di firme.
+
+Ogni `interval` blocchi (in ordine di ID) viene registrato in `chain_checkpoints`
+un checkpoint che chiude il segmento di blocchi dal checkpoint precedente: numero
+di blocchi, hash del segmento e firma con la chiave designata per i checkpoint,
+calcolata anche sulla firma del checkpoint precedente.
+
+Con i checkpoint:
+    - l'autenticità di un blocco (o di un intervallo di blocchi o di tempo) si
+      verifica con la catena dei checkpoint e i soli segmenti che lo contengono,
+      invece di ripercorrere la catena dal blocco genesi;
+    - una manomissione si localizza confrontando gli hash dei segmenti,
+      ricalcolati lato server (`chain_segment_digest`), con quelli firmati: il
+      client elabora una riga per segmento e non una per blocco.
+
+I blocchi successivi all'ultimo checkpoint non sono coperti e vanno verificati
+con `verify_chain`.
+
+Uso:
+    CHECKPOINT_BLOCKS=1000 CHECKPOINT_INTERVAL=100 python checkpoints.py
+"""
+import hashlib
+import os
+from uuid import uuid4
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+import psycopg2
+
+from key_registry import register_key
+from main import generate_keys, hash_document, sign_data
+from metrics import DB_CONNECT_SECONDS, cursor_factory, timed
+from prepared_statements import HEAD_GLOBAL, INSERT_BLOCK, execute_prepared
+
+CHECKPOINT_SIGNER = "checkpoint"
+
+_BLOCK_COLUMNS = "id, document_id, signer, document_hash, prev_hash, signature"
+
+
+def segment_hash(rows) -> str:
+    """
+    Calcola l'hash di un segmento di blocchi con la stessa codifica della
+    funzione SQL `chain_segment_digest`.
+
+    Args:
+        rows: Le righe del segmento in ordine di ID, con le colonne
+              (id, document_id, signer, document_hash, prev_hash, signature).
+
+    Returns:
+        str: L'hash SHA256 esadecimale del segmento.
+    """
+    digest = hashlib.sha256()
+    for record_id, document_id, signer, document_hash, prev_hash, signature in rows:
+        digest.update(f"{record_id}|{document_id}|{signer}|{document_hash}|{prev_hash or ''}|{signature}\n"
+                      .encode())
+    return digest.hexdigest()
+
+
+def checkpoint_signing_input(prev_signature: str | None, first_block_id: int, last_block_id: int,
+                             block_count: int, segment_digest: str) -> bytes:
+    """
+    Restituisce i dati firmati da un checkpoint.
+    """
+    return f"{prev_signature or ''}{first_block_id}|{last_block_id}|{block_count}|{segment_digest}".encode()
+
+
+def create_checkpoint(conn, private_key_pem: bytes, interval: int, signer: str = CHECKPOINT_SIGNER) -> int | None:
+    """
+    Crea il checkpoint del prossimo segmento di `interval` blocchi, se completo.
+
+    Il segmento viene chiuso sotto `lock_chain_for_checkpoint()`, che attende gli
+    INSERT in corso e blocca i nuovi fino al commit: dopo il checkpoint nessun
+    blocco può comparire all'interno del segmento.
+
+    Args:
+        conn: La connessione al database psycopg2 (non in autocommit).
+        private_key_pem (bytes): La chiave privata dei checkpoint in formato PEM.
+        interval (int): Il numero di blocchi di un segmento.
+        signer (str, optional): Il nome del firmatario dei checkpoint. Defaults to CHECKPOINT_SIGNER.
+
+    Returns:
+        int | None: L'ID del checkpoint creato, None se i blocchi non bastano a completare un segmento.
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT lock_chain_for_checkpoint()")
+            cursor.execute("SELECT last_block_id, signature FROM chain_checkpoints ORDER BY id DESC LIMIT 1")
+            row = cursor.fetchone()
+            prev_last_block_id, prev_signature = row if row else (0, None)
+
+            cursor.execute(
+                "SELECT id FROM signature_chain WHERE id > %s ORDER BY id OFFSET %s LIMIT 1",
+                (prev_last_block_id, interval - 1))
+            row = cursor.fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+
+            first_block_id, last_block_id = prev_last_block_id + 1, row[0]
+            cursor.execute("SELECT block_count, segment_hash FROM chain_segment_digest(%s, %s)",
+                           (first_block_id, last_block_id))
+            block_count, segment_digest = cursor.fetchone()
+
+            signature = sign_data(
+                checkpoint_signing_input(prev_signature, first_block_id, last_block_id, block_count, segment_digest),
+                private_key_pem)
+            cursor.execute(
+                """
+                INSERT INTO chain_checkpoints
+                    (first_block_id, last_block_id, block_count, segment_hash, prev_signature, signer, signature)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+                """,
+                (first_block_id, last_block_id, block_count, segment_digest, prev_signature, signer, signature))
+            checkpoint_id = cursor.fetchone()[0]
+        conn.commit()
+        return checkpoint_id
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def create_pending_checkpoints(conn, private_key_pem: bytes, interval: int,
+                               signer: str = CHECKPOINT_SIGNER) -> list[int]:
+    """
+    Crea i checkpoint di tutti i segmenti completi non ancora chiusi.
+
+    Returns:
+        list[int]: Gli ID dei checkpoint creati.
+    """
+    created = []
+    while (checkpoint_id := create_checkpoint(conn, private_key_pem, interval, signer)) is not None:
+        created.append(checkpoint_id)
+    return created
+
+
+def verify_checkpoint_chain(conn, public_key_pem: bytes) -> dict:
+    """
+    Verifica la catena dei checkpoint: firma di ciascun checkpoint, collegamento
+    al precedente e contiguità dei segmenti. Costa una verifica RSA per
+    segmento e non legge i blocchi.
+
+    Args:
+        conn: La connessione al database psycopg2.
+        public_key_pem (bytes): La chiave pubblica dei checkpoint in formato PEM.
+
+    Returns:
+        dict: {"valid", "checkpoints", "last_block_id", "errors"}; `last_block_id`
+              è l'ultimo blocco coperto da un checkpoint (0 se nessuno).
+    """
+    public_key = serialization.load_pem_public_key(public_key_pem)
+    errors = []
+    prev_signature, prev_last_block_id = None, 0
+
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT id, first_block_id, last_block_id, block_count, segment_hash, prev_signature, signature
+            FROM chain_checkpoints ORDER BY id
+            """)
+        checkpoints = cursor.fetchall()
+
+    for checkpoint_id, first_id, last_id, block_count, segment_digest, stored_prev, signature in checkpoints:
+        if stored_prev != prev_signature:
+            errors.append({"checkpoint_id": checkpoint_id,
+                           "error": "prev_signature non collegata al checkpoint precedente"})
+        if first_id != prev_last_block_id + 1:
+            errors.append({"checkpoint_id": checkpoint_id,
+                           "error": f"segmento non contiguo: inizia da {first_id}, atteso {prev_last_block_id + 1}"})
+        try:
+            public_key.verify(
+                bytes.fromhex(signature),
+                checkpoint_signing_input(stored_prev, first_id, last_id, block_count, segment_digest),
+                padding.PKCS1v15(),
+                hashes.SHA256())
+        except (InvalidSignature, ValueError):
+            errors.append({"checkpoint_id": checkpoint_id, "error": "firma del checkpoint non valida"})
+        prev_signature, prev_last_block_id = signature, last_id
+
+    return {"valid": not errors, "checkpoints": len(checkpoints), "last_block_id": prev_last_block_id,
+            "errors": errors}
+
+
+def locate_tampered_segments(conn, public_key_pem: bytes) -> dict:
+    """
+    Localizza i segmenti manomessi: verifica la catena dei checkpoint e
+    confronta, per ciascun segmento, numero di blocchi e hash ricalcolati lato
+    server con quelli firmati nel checkpoint. I segmenti archiviati (vedi
+    `archive.py`) non sono più nella tabella e vengono esclusi: la loro
+    integrità si controlla con `archive.ChainArchive`.
+
+    Args:
+        conn: La connessione al database psycopg2.
+        public_key_pem (bytes): La chiave pubblica dei checkpoint in formato PEM.
+
+    Returns:
+        dict: {"valid", "checkpoint_chain", "damaged_segments"}; ogni segmento
+              danneggiato riporta checkpoint, intervallo di ID e valori attesi e trovati.
+    """
+    checkpoint_chain = verify_checkpoint_chain(conn, public_key_pem)
+    damaged = []
+
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.id, c.first_block_id, c.last_block_id, c.block_count, c.segment_hash,
+                   d.block_count, d.segment_hash
+            FROM chain_checkpoints c
+            CROSS JOIN LATERAL chain_segment_digest(c.first_block_id, c.last_block_id) d
+            WHERE NOT EXISTS (SELECT 1 FROM archived_segments a WHERE a.checkpoint_id = c.id)
+            ORDER BY c.id
+            """)
+        for checkpoint_id, first_id, last_id, expected_count, expected_hash, found_count, found_hash in cursor:
+            if found_count != expected_count or found_hash != expected_hash:
+                damaged.append({"checkpoint_id": checkpoint_id, "first_block_id": first_id,
+                                "last_block_id": last_id, "expected_blocks": expected_count,
+                                "found_blocks": found_count, "expected_hash": expected_hash,
+                                "found_hash": found_hash})
+
+    return {"valid": checkpoint_chain["valid"] and not damaged, "checkpoint_chain": checkpoint_chain,
+            "damaged_segments": damaged}
+
+
+def verify_blocks(conn, public_key_pem: bytes, firmatari_data: dict, first_block_id: int,
+                  last_block_id: int | None = None, archive=None) -> dict:
+    """
+    Verifica l'autenticità dei blocchi da `first_block_id` a `last_block_id`
+    usando solo la catena dei checkpoint e i segmenti che li contengono: per
+    ciascun segmento ricalcola l'hash dai blocchi letti e lo confronta con
+    quello firmato, quindi verifica la firma dei blocchi richiesti.
+
+    Args:
+        conn: La connessione al database psycopg2.
+        public_key_pem (bytes): La chiave pubblica dei checkpoint in formato PEM.
+        firmatari_data (dict): Mappa firmatario -> chiave pubblica PEM dei blocchi.
+        first_block_id (int): Il primo blocco da verificare.
+        last_block_id (int | None, optional): L'ultimo blocco da verificare. Defaults a first_block_id.
+        archive (ChainArchive | None, optional): L'archivio da cui leggere i segmenti archiviati.
+                                                 Defaults a `archive.ChainArchive()`.
+
+    Returns:
+        dict: {"valid", "verified_blocks", "segments", "uncovered_block_ids", "errors"};
+              i blocchi non coperti da alcun checkpoint sono riportati in `uncovered_block_ids`.
+    """
+    from archive import ArchiveError, ChainArchive
+
+    last_block_id = first_block_id if last_block_id is None else last_block_id
+    archive = archive or ChainArchive()
+    checkpoint_chain = verify_checkpoint_chain(conn, public_key_pem)
+    errors = [dict(error, scope="checkpoint") for error in checkpoint_chain["errors"]]
+    public_keys = {}
+    verified, uncovered = 0, []
+
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT id, first_block_id, last_block_id, block_count, segment_hash
+            FROM chain_checkpoints
+            WHERE last_block_id >= %s AND first_block_id <= %s
+            ORDER BY id
+            """,
+            (first_block_id, last_block_id))
+        segments = cursor.fetchall()
+        archived = {segment[0]: segment for segment in archive.segments(conn)}
+
+        for checkpoint_id, segment_first, segment_last, block_count, expected_hash in segments:
+            if checkpoint_id in archived:
+                try:
+                    rows = [(r[0], r[1], r[2], r[4], r[5], r[6]) for r in archive.read_segment(archived[checkpoint_id])]
+                except ArchiveError as error:
+                    errors.append({"checkpoint_id": checkpoint_id, "first_block_id": segment_first,
+                                   "last_block_id": segment_last, "scope": "archive", "error": str(error)})
+                    continue
+            else:
+                cursor.execute(
+                    f"SELECT {_BLOCK_COLUMNS} FROM signature_chain_blocks WHERE id BETWEEN %s AND %s ORDER BY id",
+                    (segment_first, segment_last))
+                rows = cursor.fetchall()
+            if len(rows) != block_count or segment_hash(rows) != expected_hash:
+                errors.append({"checkpoint_id": checkpoint_id, "first_block_id": segment_first,
+                               "last_block_id": segment_last, "scope": "segment",
+                               "error": "hash del segmento diverso da quello firmato nel checkpoint"})
+
+            for record_id, _, signer, document_hash, prev_hash, signature in rows:
+                if not first_block_id <= record_id <= last_block_id:
+                    continue
+                verified += 1
+                if signer not in public_keys:
+                    pem = firmatari_data.get(signer)
+                    public_keys[signer] = serialization.load_pem_public_key(pem) if pem else None
+                if public_keys[signer] is None:
+                    errors.append({"block_id": record_id, "scope": "block",
+                                   "error": f"chiave pubblica assente per '{signer}'"})
+                    continue
+                try:
+                    public_keys[signer].verify(bytes.fromhex(signature),
+                                               (prev_hash or '').encode() + document_hash.encode(),
+                                               padding.PKCS1v15(), hashes.SHA256())
+                except (InvalidSignature, ValueError):
+                    errors.append({"block_id": record_id, "scope": "block", "error": "firma non valida"})
+
+        if last_block_id > checkpoint_chain["last_block_id"]:
+            cursor.execute("SELECT id FROM signature_chain WHERE id > %s AND id BETWEEN %s AND %s ORDER BY id",
+                           (checkpoint_chain["last_block_id"], first_block_id, last_block_id))
+            uncovered = [row[0] for row in cursor]
+
+    return {"valid": not errors and not uncovered, "verified_blocks": verified, "segments": len(segments),
+            "uncovered_block_ids": uncovered, "errors": errors}
+
+
+def verify_time_range(conn, public_key_pem: bytes, firmatari_data: dict, start, end) -> dict:
+    """
+    Verifica con `verify_blocks` i blocchi con `signed_at` in [start, end).
+
+    Args:
+        start (datetime): Inizio dell'intervallo (incluso).
+        end (datetime): Fine dell'intervallo (escluso).
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT min(id), max(id) FROM signature_chain WHERE signed_at >= %s AND signed_at < %s",
+                       (start, end))
+        first_block_id, last_block_id = cursor.fetchone()
+    if first_block_id is None:
+        return {"valid": True, "verified_blocks": 0, "segments": 0, "uncovered_block_ids": [], "errors": []}
+    return verify_blocks(conn, public_key_pem, firmatari_data, first_block_id, last_block_id)
+
+
+if __name__ == "__main__":
+    app_db_user = os.environ.get("APP_DB_USER", "app_user")
+    app_db_password = os.environ.get("APP_DB_PASSWORD", "app_password")
+    super_db_user = os.environ.get("SUPER_DB_USER", "postgres")
+    super_db_password = os.environ.get("SUPER_DB_PASSWORD", "postgres")
+    key_admin_db_user = os.environ.get("KEY_ADMIN_DB_USER", "key_admin")
+    key_admin_db_password = os.environ.get("KEY_ADMIN_DB_PASSWORD", "key_admin_password")
+    db_name = os.environ.get("DB_NAME", "signature_demo")
+    db_host = os.environ.get("DB_HOST", "localhost")
+    blocks = int(os.environ.get("CHECKPOINT_BLOCKS", "500"))
+    interval = int(os.environ.get("CHECKPOINT_INTERVAL", "50"))
+
+    signer_private, signer_public = generate_keys()
+    checkpoint_private, checkpoint_public = generate_keys()
+    firmatari_data = {"Antonio": signer_public}
+
+    with timed(DB_CONNECT_SECONDS):
+        conn = psycopg2.connect(dbname=db_name, user=app_db_user, password=app_db_password, host=db_host,
+                                cursor_factory=cursor_factory())
+    try:
+        # La chiave dei checkpoint è registrata in signer_keys, da cui la legge il job di archiviazione.
+        # Le chiavi si registrano come key_admin: app_user non scrive il registro.
+        with psycopg2.connect(dbname=db_name, user=key_admin_db_user, password=key_admin_db_password,
+                              host=db_host) as conn_keys:
+            register_key(conn_keys, CHECKPOINT_SIGNER, checkpoint_public)
+            register_key(conn_keys, "Antonio", signer_public)
+        conn_keys.close()
+        print(f"Inserimento di {blocks} blocchi con un checkpoint ogni {interval}...")
+        with conn.cursor() as cursor:
+            for n in range(blocks):
+                execute_prepared(cursor, HEAD_GLOBAL)
+                row = cursor.fetchone()
+                prev_hash = row[0] if row else None
+                document_hash = hash_document(f"Documento {n}".encode())
+                signature = sign_data((prev_hash or '').encode() + document_hash.encode(), signer_private)
+                execute_prepared(cursor, INSERT_BLOCK,
+                                 (str(uuid4()), "Antonio", document_hash, prev_hash, signature, "sha256"))
+                conn.commit()
+                if (n + 1) % interval == 0:
+                    create_pending_checkpoints(conn, checkpoint_private, interval)
+
+        chain = verify_checkpoint_chain(conn, checkpoint_public)
+        print(f"Checkpoint: {chain['checkpoints']}, blocchi coperti fino all'ID {chain['last_block_id']}, "
+              f"catena dei checkpoint valida: {chain['valid']}")
+
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT min(id), max(id) FROM signature_chain")
+            min_id, max_id = cursor.fetchone()
+        target = min_id + (max_id - min_id) // 2
+        single = verify_blocks(conn, checkpoint_public, firmatari_data, target)
+        print(f"Verifica del blocco {target}: valido={single['valid']}, segmenti letti={single['segments']}")
+
+        print(f"Manomissione del blocco {target} come '{super_db_user}'...")
+        with psycopg2.connect(dbname=db_name, user=super_db_user, password=super_db_password,
+                              host=db_host) as conn_super:
+            with conn_super.cursor() as cursor:
+                cursor.execute("UPDATE signature_chain SET document_hash = %s WHERE id = %s",
+                               ("hash_manomesso", target))
+        conn_super.close()
+
+        report = locate_tampered_segments(conn, checkpoint_public)
+        for segment in report["damaged_segments"]:
+            print(f"Segmento manomesso: checkpoint {segment['checkpoint_id']}, "
+                  f"blocchi {segment['first_block_id']}-{segment['last_block_id']}")
+        if report["valid"]:
+            print("Nessun segmento manomesso.")
+    finally:
+        conn.close()
@@ -0,0 +1,174 @@
+"""
+Configurazione delle connessioni: writer (primario) e reader (replica).
+
+Le scritture usano sempre il primario; i percorsi di sola lettura per l'audit
+(`verify_chain`, `check_for_forks`) possono essere indirizzati ad una replica
+in streaming, così da non competere con gli append per I/O e buffer cache.
+
+Variabili d'ambiente:
+    DB_WRITER_DSN   DSN libpq del primario (ad esempio "host=db port=5432"); default vuoto
+    DB_READER_DSN   DSN libpq della replica; se vuoto le letture usano il primario
+    REPLICA_MAX_WAIT_SECONDS   attesa massima perché la replica raggiunga il primario (default 30)
+
+Utente, password, database e gli altri parametri passati a `connect_writer` e
+`connect_reader` si aggiungono al DSN; per il reader host e porta vengono
+sempre presi da `DB_READER_DSN`.
+
+Guardia sul ritardo di replica: prima di un audit si legge dal primario la
+posizione corrente del WAL e l'ID massimo della catena (`capture_watermark`),
+si attende che la replica abbia riapplicato il WAL fino a quella posizione
+(`wait_for_replica`) e si verifica la catena fino a quell'ID.
+"""
+from contextlib import contextmanager
+from dataclasses import dataclass
+import os
+import time
+
+import psycopg2
+
+from metrics import DB_CONNECT_SECONDS, cursor_factory, timed
+
+WRITER_DSN = os.environ.get("DB_WRITER_DSN", "")
+READER_DSN = os.environ.get("DB_READER_DSN", "")
+REPLICA_MAX_WAIT_SECONDS = float(os.environ.get("REPLICA_MAX_WAIT_SECONDS", "30"))
+
+
+class ReplicaLagError(TimeoutError):
+    """
+    La replica non ha raggiunto la posizione del WAL richiesta entro il tempo massimo.
+    """
+
+
+@dataclass(frozen=True)
+class Watermark:
+    """
+    Posizione del primario da cui parte un audit sulla replica.
+
+    Attributes:
+        lsn (str): La posizione corrente del WAL sul primario.
+        max_block_id (int): L'ID massimo della catena visibile sul primario (0 se vuota).
+    """
+    lsn: str
+    max_block_id: int
+
+
+def has_replica() -> bool:
+    return bool(READER_DSN)
+
+
+def connect_writer(**params):
+    """
+    Apre una connessione psycopg2 al primario.
+
+    Args:
+        **params: Parametri di connessione (dbname, user, password, host, ...).
+    """
+    with timed(DB_CONNECT_SECONDS):
+        return psycopg2.connect(WRITER_DSN, cursor_factory=cursor_factory(), **params)
+
+
+def connect_reader(**params):
+    """
+    Apre una connessione psycopg2 alla replica, oppure al primario se
+    `DB_READER_DSN` non è impostato.
+
+    Args:
+        **params: Parametri di connessione; host e porta sono ignorati a favore di `DB_READER_DSN`.
+    """
+    if not READER_DSN:
+        return connect_writer(**params)
+    params = {name: value for name, value in params.items() if name not in ("host", "port", "hostaddr")}
+    with timed(DB_CONNECT_SECONDS):
+        return psycopg2.connect(READER_DSN, cursor_factory=cursor_factory(), **params)
+
+
+def capture_watermark(writer_conn) -> Watermark:
+    """
+    Legge dal primario la posizione corrente del WAL e l'ID massimo della catena.
+    """
+    with writer_conn.cursor() as cursor:
+        cursor.execute("SELECT pg_current_wal_lsn()::text, coalesce(max(id), 0) FROM signature_chain")
+        lsn, max_block_id = cursor.fetchone()
+    writer_conn.rollback()
+    return Watermark(lsn, max_block_id)
+
+
+def wait_for_replica(reader_conn, lsn: str, max_wait: float = REPLICA_MAX_WAIT_SECONDS,
+                     poll_interval: float = 0.05) -> float:
+    """
+    Attende che la replica abbia riapplicato il WAL fino a `lsn`. Se la
+    connessione non è su una replica (server non in recovery) ritorna subito.
+
+    Args:
+        reader_conn: La connessione alla replica.
+        lsn (str): La posizione del WAL da raggiungere.
+        max_wait (float, optional): Attesa massima in secondi. Defaults to REPLICA_MAX_WAIT_SECONDS.
+        poll_interval (float, optional): Intervallo tra due controlli in secondi. Defaults to 0.05.
+
+    Returns:
+        float: I secondi di attesa.
+
+    Raises:
+        ReplicaLagError: Se la replica non raggiunge `lsn` entro `max_wait`.
+    """
+    start = time.perf_counter()
+    with reader_conn.cursor() as cursor:
+        while True:
+            cursor.execute(
+                "SELECT pg_is_in_recovery(), coalesce(pg_last_wal_replay_lsn() >= %s::pg_lsn, false)", (lsn,))
+            in_recovery, caught_up = cursor.fetchone()
+            reader_conn.rollback()
+            waited = time.perf_counter() - start
+            if not in_recovery or caught_up:
+                return waited
+            if waited >= max_wait:
+                raise ReplicaLagError(f"Replica non allineata alla posizione {lsn} dopo {waited:.1f} s.")
+            time.sleep(poll_interval)
+
+
+@contextmanager
+def audit_connection(fallback_to_writer: bool = True, max_wait: float = REPLICA_MAX_WAIT_SECONDS, **params):
+    """
+    Restituisce una connessione per un audit di sola lettura, allineata al primario.
+
+    Cattura il watermark sul primario, apre la connessione al reader e attende
+    che la replica lo raggiunga. Gli audit dovrebbero limitarsi ai blocchi con
+    ID non superiore a `watermark.max_block_id`.
+
+    Args:
+        fallback_to_writer (bool, optional): Se la replica resta indietro o non è raggiungibile
+                                             usa il primario invece di sollevare l'errore.
+                                             Defaults to True.
+        max_wait (float, optional): Attesa massima della replica in secondi.
+        **params: Parametri di connessione (dbname, user, password, host, ...).
+
+    Yields:
+        tuple: (connessione, Watermark).
+    """
+    writer_conn = connect_writer(**params)
+    try:
+        watermark = capture_watermark(writer_conn)
+        if not has_replica():
+            yield writer_conn, watermark
+            return
+    finally:
+        writer_conn.close()
+
+    reader_conn = None
+    try:
+        reader_conn = connect_reader(**params)
+        waited = wait_for_replica(reader_conn, watermark.lsn, max_wait)
+        print(f"Audit sulla replica (attesa allineamento: {waited * 1000:.1f} ms, "
+              f"fino al blocco {watermark.max_block_id}).")
+    except (ReplicaLagError, psycopg2.OperationalError) as error:
+        if reader_conn is not None:
+            reader_conn.close()
+        if not fallback_to_writer:
+            raise
+        print(f"Replica non utilizzabile ({error}): audit sul primario.")
+        reader_conn = connect_writer(**params)
+
+    try:
+        yield reader_conn, watermark
+    finally:
+        reader_conn.close()
@@ -0,0 +1,365 @@
+"""
+Generatore di catene sintetiche di grandi dimensioni per i test di scala.
+
+Crea `--blocks` blocchi validi distribuiti su `--documents` documenti (una
+catena per documento) e `--signers` firmatari, con eventuali anomalie inserite
+in posizioni note. La firma è distribuita su più processi: ogni worker genera
+catene complete di un gruppo di documenti, perché il `prev_hash` di un blocco
+è la firma del blocco precedente dello stesso documento.
+
+Il dataset è deterministico a parità di parametri, seed e chiavi (`--keys`):
+
+    - i blocchi dei documenti sono interlacciati a turno: il blocco k del
+      documento d ha ID `first_id + k * documents + d` (i documenti con un
+      blocco in più completano l'ultimo turno);
+    - `signed_at` cresce con l'ID di `--interval-ms` millisecondi a partire da `--start`;
+    - document_id, firmatari e posizioni delle anomalie derivano da `--seed`.
+
+Anomalie (`--faults tampered_hash=10,fork=2,...`):
+
+    tampered_hash   document_hash modificato dopo la firma (firma non valida)
+    broken_link     prev_hash diverso dalla firma del blocco precedente, firmato
+                    correttamente (solo il collegamento è rotto)
+    fork            prev_hash uguale a quello del blocco precedente, firmato
+                    correttamente (biforcazione rilevata da `check_for_forks`)
+    unknown_signer  blocco firmato da una chiave assente dal registro
+
+La catena prosegue dalla firma del blocco anomalo, quindi ogni anomalia
+riguarda un solo blocco. Le posizioni sono elencate in `manifest.json`.
+
+Uscita:
+    - `--output DIR` (default `dataset`): `keys.json` (chiavi dei firmatari),
+      `manifest.json` (parametri e anomalie) e, senza `--database`,
+      `blocks.csv`, caricabile con
+      `\\copy signature_chain (id, document_id, signer, signed_at, document_hash, prev_hash, signature, key_id) FROM 'blocks.csv' CSV`;
+    - `--database`: i blocchi vengono scritti con COPY direttamente nella
+      tabella `signature_chain` (utente privilegiato, variabili DB_* e SUPER_DB_*)
+      e le chiavi registrate in `signer_keys`.
+
+Uso:
+    python generate_dataset.py --blocks 1000000 --documents 10000 --signers 50 --faults tampered_hash=10,fork=5
+    python generate_dataset.py --blocks 100000 --documents 100 --database --keys dataset/keys.json
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from datetime import datetime, timedelta
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import random
+import time
+from uuid import UUID
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+import psycopg2
+
+from key_registry import public_key_fingerprint, register_key
+
+FAULT_TYPES = ("tampered_hash", "broken_link", "fork", "unknown_signer")
+UNKNOWN_SIGNER = "FirmatarioSconosciuto"
+COPY_COLUMNS = "id, document_id, signer, signed_at, document_hash, prev_hash, signature, key_id"
+
+# Posizione minima nel documento per ogni anomalia: una biforcazione richiede
+# due blocchi precedenti, un collegamento rotto almeno uno.
+_MIN_POSITION = {"tampered_hash": 0, "broken_link": 1, "fork": 2, "unknown_signer": 0}
+
+# Stato dei worker, popolato da _init_worker.
+_worker = {}
+
+
+def generate_signer_keys(signers: int, key_size: int = 2048) -> dict:
+    """
+    Genera le chiavi dei firmatari `Firmatario0000`, `Firmatario0001`, ... e
+    quella di `UNKNOWN_SIGNER`, che non viene registrata.
+
+    Returns:
+        dict: firmatario -> {"private": PEM, "public": PEM, "key_id": str | None}.
+    """
+    keys = {}
+    for name in [f"Firmatario{n:04d}" for n in range(signers)] + [UNKNOWN_SIGNER]:
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+        private_pem = private_key.private_bytes(encoding=serialization.Encoding.PEM,
+                                                format=serialization.PrivateFormat.PKCS8,
+                                                encryption_algorithm=serialization.NoEncryption())
+        public_pem = private_key.public_key().public_bytes(encoding=serialization.Encoding.PEM,
+                                                           format=serialization.PublicFormat.SubjectPublicKeyInfo)
+        keys[name] = {"private": private_pem.decode(), "public": public_pem.decode(),
+                      "key_id": None if name == UNKNOWN_SIGNER else public_key_fingerprint(public_pem)[:16]}
+    return keys
+
+
+def parse_faults(spec: str) -> dict[str, int]:
+    """
+    Interpreta `tampered_hash=10,fork=2` in un dizionario tipo -> numero di anomalie.
+
+    Raises:
+        ValueError: Se un tipo di anomalia non è tra `FAULT_TYPES`.
+    """
+    faults = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        fault_type, _, count = item.partition("=")
+        if fault_type not in FAULT_TYPES:
+            raise ValueError(f"Anomalia sconosciuta '{fault_type}' (valori ammessi: {', '.join(FAULT_TYPES)}).")
+        faults[fault_type] = faults.get(fault_type, 0) + int(count or 1)
+    return faults
+
+
+class DatasetPlan:
+    """
+    Disposizione deterministica dei blocchi: ID, firmatari e anomalie di ogni documento.
+    """
+
+    def __init__(self, blocks: int, documents: int, signers: list[str], seed: int, first_id: int,
+                 start: datetime, interval: timedelta):
+        if documents < 1 or blocks < documents:
+            raise ValueError("Servono almeno un documento e almeno un blocco per documento.")
+        self.blocks = blocks
+        self.documents = documents
+        self.signers = signers
+        self.seed = seed
+        self.first_id = first_id
+        self.start = start
+        self.interval = interval
+        self.rounds, self.extra = divmod(blocks, documents)
+        self.faults = {}
+
+    def chain_length(self, document: int) -> int:
+        return self.rounds + (1 if document < self.extra else 0)
+
+    def block_id(self, document: int, position: int) -> int:
+        return self.first_id + position * self.documents + document
+
+    def locate(self, block_id: int) -> tuple[int, int]:
+        """
+        Restituisce (documento, posizione nel documento) di un ID.
+        """
+        position, document = divmod(block_id - self.first_id, self.documents)
+        return document, position
+
+    def document_id(self, document: int) -> str:
+        return str(UUID(int=random.Random(f"{self.seed}:document:{document}").getrandbits(128), version=4))
+
+    def document_signers(self, document: int) -> random.Random:
+        return random.Random(f"{self.seed}:signers:{document}")
+
+    def signed_at(self, block_id: int) -> datetime:
+        return self.start + (block_id - self.first_id) * self.interval
+
+    def place_faults(self, faults: dict[str, int]) -> list[dict]:
+        """
+        Sceglie in modo deterministico le posizioni delle anomalie, una per blocco.
+
+        Returns:
+            list[dict]: Le anomalie (tipo, block_id, document_id, posizione), ordinate per ID.
+
+        Raises:
+            ValueError: Se non ci sono abbastanza blocchi idonei.
+        """
+        rng = random.Random(f"{self.seed}:faults")
+        # Prima i tipi con la posizione minima più alta: le posizioni idonee sono
+        # annidate, quindi così il controllo qui sotto rifiuta solo i piani impossibili.
+        for fault_type in sorted(FAULT_TYPES, key=lambda fault_type: -_MIN_POSITION[fault_type]):
+            requested = faults.get(fault_type, 0)
+            if not requested:
+                continue
+            # Posizioni idonee per questo tipo, escluse quelle già occupate da altre anomalie.
+            min_position = _MIN_POSITION[fault_type]
+            eligible = sum(max(0, self.chain_length(d) - min_position) for d in range(self.documents))
+            taken = sum(1 for block_id in self.faults if self.locate(block_id)[1] >= min_position)
+            if requested > eligible - taken:
+                raise ValueError(f"Blocchi insufficienti per {requested} anomalie '{fault_type}' "
+                                 f"({eligible - taken} posizioni idonee libere).")
+            placed = 0
+            while placed < requested:
+                block_id = rng.randrange(self.first_id, self.first_id + self.blocks)
+                document, position = self.locate(block_id)
+                if position >= _MIN_POSITION[fault_type] and block_id not in self.faults:
+                    self.faults[block_id] = fault_type
+                    placed += 1
+
+        manifest = []
+        for block_id, fault_type in sorted(self.faults.items()):
+            document, position = self.locate(block_id)
+            manifest.append({"type": fault_type, "block_id": block_id,
+                             "document_id": self.document_id(document), "position": position})
+        return manifest
+
+
+def _init_worker(plan: DatasetPlan, keys: dict) -> None:
+    """
+    Inizializzatore dei worker: analizza una sola volta le chiavi private.
+    """
+    _worker["plan"] = plan
+    _worker["keys"] = {signer: (serialization.load_pem_private_key(key["private"].encode(), password=None),
+                                key["key_id"])
+                       for signer, key in keys.items()}
+
+
+def _generate_documents(first_document: int, last_document: int) -> tuple[int, str]:
+    """
+    Genera nel worker le catene complete dei documenti [first_document, last_document).
+
+    Returns:
+        tuple: (numero di blocchi, righe CSV nelle colonne `COPY_COLUMNS`).
+    """
+    plan, keys = _worker["plan"], _worker["keys"]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    count = 0
+
+    for document in range(first_document, last_document):
+        document_id = plan.document_id(document)
+        signer_rng = plan.document_signers(document)
+        prev_hash = before_prev_hash = None
+
+        for position in range(plan.chain_length(document)):
+            block_id = plan.block_id(document, position)
+            fault = plan.faults.get(block_id)
+            signer = signer_rng.choice(plan.signers)
+            if fault == "unknown_signer":
+                signer = UNKNOWN_SIGNER
+            private_key, key_id = keys[signer]
+
+            document_hash = hashlib.sha256(f"Documento {document_id} blocco {position}".encode()).hexdigest()
+            link = prev_hash
+            if fault == "broken_link":
+                link = hashlib.sha512(f"{plan.seed}:broken_link:{block_id}".encode()).hexdigest()
+            elif fault == "fork":
+                link = before_prev_hash
+
+            signature = private_key.sign((link or '').encode() + document_hash.encode(),
+                                         padding.PKCS1v15(), hashes.SHA256()).hex()
+            if fault == "tampered_hash":
+                document_hash = hashlib.sha256(f"Documento {document_id} blocco {position} (manomesso)".encode()).hexdigest()
+
+            writer.writerow((block_id, document_id, signer, plan.signed_at(block_id).isoformat(), document_hash,
+                             link if link is not None else "", signature, key_id or ""))
+            before_prev_hash, prev_hash = link, signature
+            count += 1
+
+    return count, buffer.getvalue()
+
+
+def generate(plan: DatasetPlan, keys: dict, sink, workers: int | None = None, documents_per_task: int | None = None,
+             progress: bool = True) -> int:
+    """
+    Genera i blocchi del piano su più processi e li passa a `sink` man mano che
+    i gruppi di documenti sono pronti (non in ordine di ID).
+
+    Args:
+        plan (DatasetPlan): Il piano del dataset.
+        keys (dict): Le chiavi dei firmatari (vedi `generate_signer_keys`).
+        sink: Funzione chiamata con le righe CSV di ogni gruppo di documenti.
+        workers (int | None, optional): Processi di firma. Defaults al numero di CPU.
+        documents_per_task (int | None, optional): Documenti per task. Defaults a circa
+                                                   2000 blocchi per task.
+
+    Returns:
+        int: Il numero di blocchi generati.
+    """
+    documents_per_task = documents_per_task or max(1, 2000 // max(1, plan.rounds))
+    tasks = [(first, min(first + documents_per_task, plan.documents))
+             for first in range(0, plan.documents, documents_per_task)]
+    generated = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(plan, keys)) as executor:
+        futures = [executor.submit(_generate_documents, first, last) for first, last in tasks]
+        for future in futures:
+            count, rows = future.result()
+            sink(rows)
+            generated += count
+            if progress:
+                elapsed = time.perf_counter() - start
+                print(f"\r{generated}/{plan.blocks} blocchi ({generated / elapsed:.0f} blocchi/s)", end="", flush=True)
+    if progress:
+        print()
+    return generated
+
+
+def copy_to_database(conn, plan: DatasetPlan, keys: dict, **generate_options) -> int:
+    """
+    Registra le chiavi e scrive i blocchi con COPY in `signature_chain`, in una
+    sola transazione; al termine riallinea la sequenza degli ID.
+
+    Raises:
+        ValueError: Se la tabella contiene già blocchi nell'intervallo di ID del piano.
+    """
+    for signer, key in keys.items():
+        if key["key_id"] is not None:
+            register_key(conn, signer, key["public"].encode(), key["key_id"], valid_from=plan.start)
+
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM signature_chain WHERE id BETWEEN %s AND %s",
+                       (plan.first_id, plan.first_id + plan.blocks - 1))
+        if cursor.fetchone()[0]:
+            conn.rollback()
+            raise ValueError(f"La tabella contiene già blocchi con ID tra {plan.first_id} e "
+                             f"{plan.first_id + plan.blocks - 1}: usare --first-id.")
+
+        def sink(rows: str) -> None:
+            cursor.copy_expert(f"COPY signature_chain ({COPY_COLUMNS}) FROM STDIN WITH (FORMAT csv)",
+                               io.StringIO(rows))
+
+        generated = generate(plan, keys, sink, **generate_options)
+        cursor.execute("SELECT setval('signature_chain_id_seq', (SELECT max(id) FROM signature_chain))")
+    conn.commit()
+    return generated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generatore di catene sintetiche per i test di scala.")
+    parser.add_argument("--blocks", type=int, default=100_000)
+    parser.add_argument("--documents", type=int, default=1000)
+    parser.add_argument("--signers", type=int, default=10)
+    parser.add_argument("--faults", default="", help="ad esempio tampered_hash=10,broken_link=2,fork=2,unknown_signer=1")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--first-id", type=int, default=1)
+    parser.add_argument("--start", default="2024-01-01T00:00:00+00:00", help="signed_at del primo blocco")
+    parser.add_argument("--interval-ms", type=float, default=1000, help="intervallo tra i signed_at di due ID consecutivi")
+    parser.add_argument("--keys", help="file keys.json da riutilizzare; default: nuove chiavi")
+    parser.add_argument("--key-size", type=int, default=2048)
+    parser.add_argument("--workers", type=int, default=None, help="processi di firma; default: numero di CPU")
+    parser.add_argument("--output", default="dataset", help="directory per keys.json, manifest.json e blocks.csv")
+    parser.add_argument("--database", action="store_true", help="scrivi i blocchi nel database con COPY")
+    args = parser.parse_args()
+
+    output_dir = Path(args.output)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if args.keys:
+        signer_keys = json.loads(Path(args.keys).read_text(encoding="utf-8"))
+    else:
+        signer_keys = generate_signer_keys(args.signers, args.key_size)
+    (output_dir / "keys.json").write_text(json.dumps(signer_keys, indent=2), encoding="utf-8")
+
+    dataset_plan = DatasetPlan(args.blocks, args.documents, sorted(set(signer_keys) - {UNKNOWN_SIGNER}), args.seed,
+                               args.first_id, datetime.fromisoformat(args.start),
+                               timedelta(milliseconds=args.interval_ms))
+    fault_manifest = dataset_plan.place_faults(parse_faults(args.faults))
+
+    started = time.perf_counter()
+    if args.database:
+        with psycopg2.connect(dbname=os.environ.get("DB_NAME", "signature_demo"),
+                              user=os.environ.get("SUPER_DB_USER", "postgres"),
+                              password=os.environ.get("SUPER_DB_PASSWORD", "postgres"),
+                              host=os.environ.get("DB_HOST", "localhost")) as connection:
+            total = copy_to_database(connection, dataset_plan, signer_keys, workers=args.workers)
+        connection.close()
+    else:
+        with open(output_dir / "blocks.csv", "w", encoding="utf-8", newline="") as blocks_file:
+            total = generate(dataset_plan, signer_keys, blocks_file.write, workers=args.workers)
+    elapsed = time.perf_counter() - started
+
+    manifest = {
+        "blocks": args.blocks, "documents": args.documents, "signers": len(dataset_plan.signers),
+        "seed": args.seed, "first_id": args.first_id, "start": args.start, "interval_ms": args.interval_ms,
+        "destination": "database" if args.database else str(output_dir / "blocks.csv"),
+        "faults": fault_manifest,
+    }
+    (output_dir / "manifest.json").write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    print(f"{total} blocchi generati in {elapsed:.1f} s ({total / elapsed:.0f} blocchi/s), "
+          f"{len(fault_manifest)} anomalie; manifest in {output_dir / 'manifest.json'}.")
@@ -0,0 +1,138 @@
+"""
+Append idempotenti: il client assegna ad ogni richiesta di append un
+`request_id` e, se la richiesta viene ripetuta (ad esempio perché il COMMIT è
+riuscito ma la risposta è andata persa per un timeout), riceve il blocco già
+inserito invece di aggiungerne un secondo.
+
+La garanzia viene dall'indice unico `signature_chain (document_id, request_id)`
+e dal controllo che `append_block` (o il chiamante, sotto l'advisory lock del
+documento) esegue prima dell'INSERT. `RecentRequests` è una cache nel processo
+dei request_id già confermati: una ripetizione ravvicinata, il caso tipico dei
+retry dopo un timeout, non richiede alcun round trip.
+
+Un request_id identifica una sola richiesta: se viene ripetuto con un firmatario,
+un hash del documento o un algoritmo diversi da quelli del blocco già inserito
+non si tratta di un retry, e l'append fallisce con `RequestIdConflict` invece di
+restituire il blocco di un'altra richiesta.
+
+Quando il blocco viene archiviato (vedi `archive.py`) il suo request_id passa,
+nella stessa transazione, nella tabella `archived_requests`, dove
+`append_block` e `BLOCK_BY_REQUEST` lo cercano: l'idempotenza vale anche per i
+blocchi archiviati.
+"""
+from collections import OrderedDict
+import os
+import threading
+from uuid import uuid4
+
+
+class RequestIdConflict(Exception):
+    """
+    Il request_id è già stato usato, sullo stesso documento, da una richiesta
+    con firmatario, hash del documento o algoritmo diversi.
+    """
+
+    def __init__(self, document_id: str, request_id: str, block_id: int | None = None):
+        self.document_id = document_id
+        self.request_id = request_id
+        self.block_id = block_id
+        detail = f" (blocco ID {block_id})" if block_id is not None else ""
+        super().__init__(f"request_id {request_id} già usato sul documento {document_id} "
+                         f"per una richiesta diversa{detail}.")
+
+
+def check_replay(document_id: str, request_id: str, block: tuple, signer: str, document_hash: str,
+                 hash_algorithm: str) -> tuple[int, str]:
+    """
+    Confronta il blocco già inserito per la richiesta con la richiesta ripetuta.
+
+    Args:
+        document_id (str): L'ID del documento.
+        request_id (str): L'identificativo della richiesta.
+        block (tuple): (block_id, firma, firmatario, hash del documento, algoritmo) del blocco esistente.
+        signer (str): Il firmatario della richiesta ripetuta.
+        document_hash (str): L'hash del documento della richiesta ripetuta.
+        hash_algorithm (str): L'algoritmo della richiesta ripetuta.
+
+    Returns:
+        tuple[int, str]: L'ID e la firma del blocco esistente.
+
+    Raises:
+        RequestIdConflict: Se la richiesta ripetuta non coincide con quella del blocco.
+    """
+    if tuple(block[2:]) != (signer, document_hash, hash_algorithm):
+        raise RequestIdConflict(document_id, request_id, block[0])
+    return block[0], block[1]
+
+
+def new_request_id() -> str:
+    """
+    Genera un request_id casuale, da conservare per tutti i tentativi della stessa richiesta.
+    """
+    return str(uuid4())
+
+
+class RecentRequests:
+    """
+    Cache LRU, thread-safe, dei request_id il cui blocco è già stato inserito
+    e confermato (COMMIT avvenuto): (document_id, request_id) -> (block_id, firma,
+    firmatario, hash del documento, algoritmo).
+
+    Args:
+        max_entries (int, optional): Numero massimo di voci; 0 disattiva la cache. Defaults to 10000.
+    """
+
+    def __init__(self, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, document_id: str, request_id: str, signer: str, document_hash: str,
+            hash_algorithm: str) -> tuple[int, str] | None:
+        """
+        Restituisce (block_id, firma) del blocco già inserito per la richiesta, se noto.
+
+        Raises:
+            RequestIdConflict: Se il blocco noto è di una richiesta con firmatario, hash o
+                               algoritmo diversi.
+        """
+        key = (document_id, request_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return check_replay(document_id, request_id, entry, signer, document_hash, hash_algorithm)
+
+    def put(self, document_id: str, request_id: str, block_id: int, signature: str, signer: str,
+            document_hash: str, hash_algorithm: str) -> None:
+        """
+        Registra il blocco di una richiesta. Va chiamata solo dopo il COMMIT
+        dell'INSERT: una voce in cache vale come blocco esistente.
+        """
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[(document_id, request_id)] = (block_id, signature, signer, document_hash, hash_algorithm)
+            self._entries.move_to_end((document_id, request_id))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        Svuota la cache e azzera i contatori.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Cache condivisa dal processo; IDEMPOTENCY_CACHE_ENTRIES=0 la disattiva.
+recent_requests = RecentRequests(max_entries=int(os.environ.get("IDEMPOTENCY_CACHE_ENTRIES", "10000")))
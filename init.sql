@@ -13,24 +13,160 @@ BEGIN
 END
 $do$;
 
+-- Utente amministrativo del registro delle chiavi: solo lui (oltre al
+-- proprietario) registra chiavi. Le chiavi del registro sono quelle con cui
+-- vengono verificate le firme: se app_user potesse registrarle, chi ha le sue
+-- credenziali potrebbe firmare blocchi validi a nome di qualunque firmatario.
+DO
+$do$
+BEGIN
+   IF NOT EXISTS (
+      SELECT FROM pg_catalog.pg_roles
+      WHERE  rolname = 'key_admin') THEN
+
+      CREATE ROLE key_admin WITH LOGIN PASSWORD 'key_admin_password';
+   END IF;
+END
+$do$;
+
+-- Utente del job di archiviazione (archive.py): l'unico, oltre al superutente,
+-- che può cancellare blocchi. BYPASSRLS scavalca la policy no_deletes_for_public;
+-- i privilegi sulle tabelle restano limitati a quelli concessi qui sotto.
+DO
+$do$
+BEGIN
+   IF NOT EXISTS (
+      SELECT FROM pg_catalog.pg_roles
+      WHERE  rolname = 'archiver') THEN
+
+      CREATE ROLE archiver WITH LOGIN BYPASSRLS PASSWORD 'archiver_password';
+   END IF;
+END
+$do$;
+
 GRANT CONNECT ON DATABASE signature_demo TO app_user;
 GRANT USAGE ON SCHEMA public TO app_user; -- Assumendo che la tabella sia nello schema public
+GRANT CONNECT ON DATABASE signature_demo TO key_admin;
+GRANT USAGE ON SCHEMA public TO key_admin;
+GRANT CONNECT ON DATABASE signature_demo TO archiver;
+GRANT USAGE ON SCHEMA public TO archiver;
+
+-- Registro delle chiavi pubbliche dei firmatari.
+-- Un firmatario può avere più chiavi nel tempo (rotazione): ogni chiave è
+-- valida nell'intervallo [valid_from, valid_to). L'impronta è lo SHA256 della
+-- chiave pubblica in formato DER (SubjectPublicKeyInfo).
+-- Una chiave registrata dopo i blocchi che ha firmato senza key_id va
+-- retrodatata (key_registry.backfill_valid_from), altrimenti quei blocchi non
+-- trovano una chiave valida al loro signed_at.
+CREATE TABLE signer_keys (
+    key_id TEXT PRIMARY KEY,
+    signer TEXT NOT NULL,
+    fingerprint TEXT NOT NULL UNIQUE,
+    public_key TEXT NOT NULL,
+    valid_from TIMESTAMPTZ NOT NULL DEFAULT now(),
+    valid_to TIMESTAMPTZ,
+    CHECK (valid_to IS NULL OR valid_to > valid_from)
+);
+
+CREATE INDEX signer_keys_signer_idx ON signer_keys (signer, valid_from);
+
+GRANT SELECT ON signer_keys TO app_user;
+GRANT SELECT, INSERT, UPDATE (valid_from, valid_to) ON signer_keys TO key_admin;
+
+-- Documenti firmati, indirizzati per contenuto: un hash compare una sola volta
+-- anche se il documento è firmato da molti firmatari o in molti blocchi.
+-- I blocchi lo referenziano con un intero (document_ref). app_user non scrive
+-- la tabella direttamente: i documenti vengono registrati da document_ref().
+-- algorithm è l'algoritmo con cui è stato calcolato l'hash (vedi
+-- signature_chain.core.HASH_ALGORITHMS), scelto da chi crea la catena.
+CREATE TABLE documents (
+    id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    algorithm TEXT NOT NULL DEFAULT 'sha256' CHECK (algorithm IN ('sha256', 'sha512_256', 'blake2b')),
+    hash TEXT NOT NULL,
+    size BIGINT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    UNIQUE (hash, algorithm)
+);
 
+GRANT SELECT ON documents TO app_user;
+
+-- Restituisce l'ID del documento con l'hash indicato, registrandolo se non esiste.
+-- La dimensione, se nota, viene registrata alla prima occasione.
+CREATE OR REPLACE FUNCTION document_ref(p_hash TEXT, p_size BIGINT DEFAULT NULL, p_algorithm TEXT DEFAULT 'sha256')
+RETURNS BIGINT
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+    ref BIGINT;
+    known_size BIGINT;
+BEGIN
+    SELECT id, size INTO ref, known_size FROM documents WHERE hash = p_hash AND algorithm = p_algorithm;
+    IF ref IS NULL THEN
+        INSERT INTO documents (hash, size, algorithm) VALUES (p_hash, p_size, p_algorithm)
+        ON CONFLICT (hash, algorithm) DO NOTHING
+        RETURNING id INTO ref;
+        IF ref IS NULL THEN
+            -- Registrato da una transazione concorrente.
+            SELECT id, size INTO ref, known_size FROM documents WHERE hash = p_hash AND algorithm = p_algorithm;
+        ELSE
+            RETURN ref;
+        END IF;
+    END IF;
+    IF known_size IS NULL AND p_size IS NOT NULL THEN
+        UPDATE documents SET size = p_size WHERE id = ref AND size IS NULL;
+    END IF;
+    RETURN ref;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION document_ref(TEXT, BIGINT, TEXT) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION document_ref(TEXT, BIGINT, TEXT) TO app_user;
+
+-- I nuovi blocchi referenziano il documento (document_ref) e lasciano
+-- document_hash NULL. document_hash resta valorizzato solo nei blocchi
+-- registrati prima dell'introduzione di documents; i lettori usano la vista
+-- signature_chain_blocks, che restituisce l'hash in entrambi i casi.
 CREATE TABLE signature_chain (
     id SERIAL PRIMARY KEY,
     document_id UUID NOT NULL,
     signer TEXT NOT NULL,
     signed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
-    document_hash TEXT NOT NULL,
+    document_ref BIGINT REFERENCES documents (id),
+    document_hash TEXT,
     prev_hash TEXT,
-    chain_hash TEXT GENERATED ALWAYS AS ( -- Questa colonna non è usata attivamente nello script Python per la logica della catena, ma la lasciamo se serve per altri scopi
-        encode(digest(coalesce(prev_hash, '') || document_hash, 'sha256'), 'hex')
-    ) STORED,
-    signature TEXT NOT NULL
+    signature TEXT NOT NULL,
+    -- Chiave con cui è stato firmato il blocco; NULL per i blocchi che non la
+    -- registrano, la cui chiave viene risolta per firmatario e signed_at.
+    key_id TEXT REFERENCES signer_keys (key_id),
+    -- Identificativo scelto dal client per la richiesta di append: ripetere la
+    -- richiesta (ad esempio dopo un timeout) restituisce il blocco già inserito.
+    request_id TEXT CHECK (length(request_id) <= 128),
+    CHECK (document_ref IS NOT NULL OR document_hash IS NOT NULL)
 );
 
+-- Indice per la lettura della testa della catena di un documento
+-- (WHERE document_id = ... ORDER BY id DESC LIMIT 1), eseguita ad ogni append.
+CREATE INDEX signature_chain_document_id_idx ON signature_chain (document_id, id);
+
+-- Indici per gli audit su una finestra temporale (range_audit.py, verify_time_range),
+-- sull'intera catena o su un singolo documento.
+CREATE INDEX signature_chain_signed_at_idx ON signature_chain (signed_at);
+CREATE INDEX signature_chain_document_signed_at_idx ON signature_chain (document_id, signed_at);
+
+-- Blocchi di un documento firmato (join per intero su documents).
+CREATE INDEX signature_chain_document_ref_idx ON signature_chain (document_ref);
+
+-- Un request_id compare al più una volta per documento: l'indice rende
+-- l'append idempotente anche tra client che non condividono una cache.
+CREATE UNIQUE INDEX signature_chain_request_id_idx ON signature_chain (document_id, request_id)
+    WHERE request_id IS NOT NULL;
+
 -- Concedi solo i permessi necessari all'utente dell'applicazione
 GRANT SELECT, INSERT ON signature_chain TO app_user;
+-- Per retrodatare le chiavi al primo blocco firmato senza key_id.
+GRANT SELECT ON signature_chain TO key_admin;
 GRANT USAGE ON SEQUENCE signature_chain_id_seq TO app_user;
 
 ALTER TABLE signature_chain ENABLE ROW LEVEL SECURITY;
@@ -60,3 +196,303 @@ CREATE POLICY no_deletes_for_public ON signature_chain
 -- Revoca esplicita per PUBLIC (best practice, anche se RLS dovrebbe già bloccare UPDATE/DELETE)
 -- Manteniamo SELECT e INSERT per app_user come concesso sopra.
 REVOKE UPDATE, DELETE ON signature_chain FROM PUBLIC;
+
+-- Gli INSERT che indicano ancora document_hash (COPY, script esistenti)
+-- vengono normalizzati: l'hash, SHA256, viene spostato in documents.
+CREATE OR REPLACE FUNCTION normalize_block_document()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NEW.document_ref IS NULL AND NEW.document_hash IS NOT NULL THEN
+        NEW.document_ref := document_ref(NEW.document_hash);
+        NEW.document_hash := NULL;
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER signature_chain_normalize_document
+    BEFORE INSERT ON signature_chain
+    FOR EACH ROW
+    EXECUTE FUNCTION normalize_block_document();
+
+-- Vista di lettura dei blocchi con l'hash del documento risolto. La LEFT JOIN
+-- viene eliminata dal planner quando la query non usa document_hash.
+-- chain_hash è calcolato al volo (non è usato dalla logica della catena).
+-- I blocchi con document_hash in linea (precedenti a documents) usano SHA256.
+CREATE VIEW signature_chain_blocks WITH (security_invoker = true) AS
+SELECT sc.id,
+       sc.document_id,
+       sc.signer,
+       sc.signed_at,
+       coalesce(sc.document_hash, d.hash) AS document_hash,
+       sc.prev_hash,
+       encode(digest(coalesce(sc.prev_hash, '') || coalesce(sc.document_hash, d.hash), 'sha256'), 'hex') AS chain_hash,
+       sc.signature,
+       sc.key_id,
+       sc.document_ref,
+       coalesce(d.algorithm, 'sha256') AS hash_algorithm
+FROM signature_chain sc
+LEFT JOIN documents d ON d.id = sc.document_ref;
+
+GRANT SELECT ON signature_chain_blocks TO app_user;
+
+-- Append della catena in un singolo round trip.
+-- Il client legge la testa corrente del documento, firma fuori da qualsiasi lock
+-- e invoca questa funzione: l'advisory lock transazionale del documento (stessa
+-- chiave calcolata da generate_advisory_lock_key in Python), la verifica della
+-- testa attesa e l'INSERT avvengono lato server in un'unica chiamata.
+-- Restituisce l'ID del blocco inserito oppure, se la testa è cambiata nel
+-- frattempo, block_id NULL e la testa corrente, così che il client possa
+-- rifirmare e riprovare.
+-- Con p_request_id, se il documento ha già un blocco con lo stesso
+-- request_id (una richiesta ripetuta) non inserisce nulla e restituisce quel
+-- blocco e la sua firma, con replayed TRUE. Se quel blocco ha firmatario, hash
+-- del documento o algoritmo diversi, il request_id è stato riusato per un'altra
+-- richiesta: la funzione fallisce con unique_violation (SQLSTATE 23505).
+-- Il request_id di un blocco archiviato si trova in archived_requests.
+-- Se tutti i blocchi del documento sono stati archiviati, la testa è quella
+-- registrata in archived_heads.
+CREATE OR REPLACE FUNCTION append_block(
+    p_document_id UUID,
+    p_signer TEXT,
+    p_document_hash TEXT,
+    p_expected_prev TEXT,
+    p_signature TEXT,
+    p_key_id TEXT DEFAULT NULL,
+    p_hash_algorithm TEXT DEFAULT 'sha256',
+    p_request_id TEXT DEFAULT NULL,
+    OUT block_id INTEGER,
+    OUT current_head TEXT,
+    OUT replayed BOOLEAN
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_signer TEXT;
+    v_document_hash TEXT;
+    v_hash_algorithm TEXT;
+BEGIN
+    -- 15 caratteri esadecimali (60 bit) dello SHA256 del document_id, come in Python.
+    PERFORM pg_advisory_xact_lock(
+        ('x' || lpad(substr(encode(digest(p_document_id::text, 'sha256'), 'hex'), 1, 15), 16, '0'))::bit(64)::bigint);
+
+    replayed := FALSE;
+    IF p_request_id IS NOT NULL THEN
+        SELECT sc.id, sc.signature, sc.signer, coalesce(sc.document_hash, d.hash), coalesce(d.algorithm, 'sha256')
+        INTO block_id, current_head, v_signer, v_document_hash, v_hash_algorithm
+        FROM signature_chain sc
+        LEFT JOIN documents d ON d.id = sc.document_ref
+        WHERE sc.document_id = p_document_id AND sc.request_id = p_request_id;
+        IF NOT FOUND THEN
+            SELECT ar.block_id, ar.signature, ar.signer, ar.document_hash, ar.hash_algorithm
+            INTO block_id, current_head, v_signer, v_document_hash, v_hash_algorithm
+            FROM archived_requests ar
+            WHERE ar.document_id = p_document_id AND ar.request_id = p_request_id;
+        END IF;
+        IF FOUND THEN
+            IF (v_signer, v_document_hash, v_hash_algorithm)
+                    IS DISTINCT FROM (p_signer, p_document_hash, p_hash_algorithm) THEN
+                RAISE EXCEPTION 'request_id % già usato sul documento % per una richiesta diversa (blocco ID %)',
+                    p_request_id, p_document_id, block_id
+                    USING ERRCODE = 'unique_violation';
+            END IF;
+            replayed := TRUE;
+            RETURN;
+        END IF;
+    END IF;
+
+    SELECT sc.signature INTO current_head
+    FROM signature_chain sc
+    WHERE sc.document_id = p_document_id
+    ORDER BY sc.id DESC
+    LIMIT 1;
+    IF NOT FOUND THEN
+        SELECT ah.signature INTO current_head
+        FROM archived_heads ah
+        WHERE ah.document_id = p_document_id;
+    END IF;
+
+    IF current_head IS DISTINCT FROM p_expected_prev THEN
+        block_id := NULL;
+        RETURN;
+    END IF;
+
+    INSERT INTO signature_chain (document_id, signer, document_ref, prev_hash, signature, key_id, request_id)
+    VALUES (p_document_id, p_signer, document_ref(p_document_hash, NULL, p_hash_algorithm), p_expected_prev, p_signature,
+            p_key_id, p_request_id)
+    RETURNING id INTO block_id;
+
+    current_head := p_signature;
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION append_block(UUID, TEXT, TEXT, TEXT, TEXT, TEXT, TEXT, TEXT) TO app_user;
+
+-- Checkpoint firmati della catena.
+-- Ogni checkpoint chiude un segmento di blocchi consecutivi per ID
+-- (first_block_id..last_block_id, contiguo al segmento precedente) e ne
+-- registra numero di blocchi e hash; la firma, con la chiave designata per i
+-- checkpoint, copre anche la firma del checkpoint precedente, così che i
+-- checkpoint formino a loro volta una catena.
+CREATE TABLE chain_checkpoints (
+    id SERIAL PRIMARY KEY,
+    first_block_id INTEGER NOT NULL,
+    last_block_id INTEGER NOT NULL UNIQUE,
+    block_count INTEGER NOT NULL,
+    segment_hash TEXT NOT NULL,
+    prev_signature TEXT UNIQUE,
+    signer TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    signature TEXT NOT NULL,
+    CHECK (first_block_id <= last_block_id)
+);
+
+GRANT SELECT, INSERT ON chain_checkpoints TO app_user;
+GRANT USAGE ON SEQUENCE chain_checkpoints_id_seq TO app_user;
+
+ALTER TABLE chain_checkpoints ENABLE ROW LEVEL SECURITY;
+ALTER TABLE chain_checkpoints FORCE ROW LEVEL SECURITY;
+
+CREATE POLICY allow_inserts_for_public ON chain_checkpoints
+    FOR INSERT TO PUBLIC
+    WITH CHECK (true);
+
+CREATE POLICY allow_select_for_public ON chain_checkpoints
+    FOR SELECT TO PUBLIC
+    USING (true);
+
+REVOKE UPDATE, DELETE ON chain_checkpoints FROM PUBLIC;
+
+-- Hash di un segmento di blocchi, calcolato lato server: SHA256 della
+-- concatenazione, in ordine di ID, di una riga per blocco
+-- "id|document_id|signer|document_hash|prev_hash|signature\n"
+-- (stessa codifica di checkpoints.segment_hash in Python).
+CREATE OR REPLACE FUNCTION chain_segment_digest(
+    p_first_id INTEGER,
+    p_last_id INTEGER,
+    OUT block_count INTEGER,
+    OUT segment_hash TEXT
+)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT count(*)::integer,
+           encode(digest(coalesce(string_agg(
+               sc.id::text || '|' || sc.document_id::text || '|' || sc.signer || '|' ||
+               sc.document_hash || '|' || coalesce(sc.prev_hash, '') || '|' || sc.signature || E'\n',
+               '' ORDER BY sc.id), ''), 'sha256'), 'hex')
+    FROM signature_chain_blocks sc
+    WHERE sc.id BETWEEN p_first_id AND p_last_id;
+$$;
+
+GRANT EXECUTE ON FUNCTION chain_segment_digest(INTEGER, INTEGER) TO app_user;
+
+-- Lock usato da chi crea un checkpoint: attende la fine delle transazioni che
+-- stanno inserendo blocchi e blocca i nuovi INSERT fino al commit, così che
+-- nessun blocco con ID inferiore alla fine del segmento possa comparire dopo
+-- la creazione del checkpoint. La modalità è in conflitto con se stessa, quindi
+-- serializza anche più processi di checkpoint concorrenti.
+-- SECURITY DEFINER: app_user, con il solo privilegio INSERT, non potrebbe
+-- acquisire questa modalità di lock direttamente.
+CREATE OR REPLACE FUNCTION lock_chain_for_checkpoint()
+RETURNS void
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+BEGIN
+    LOCK TABLE signature_chain IN SHARE ROW EXCLUSIVE MODE;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION lock_chain_for_checkpoint() FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION lock_chain_for_checkpoint() TO app_user;
+
+-- Indice dei segmenti archiviati (archive.py).
+-- Un segmento chiuso da un checkpoint viene esportato in un file compresso e
+-- rimosso da signature_chain; qui restano l'intervallo di blocchi, l'hash del
+-- segmento firmato nel checkpoint e il file che lo contiene. Scritta solo dal
+-- job di archiviazione, che gira con il ruolo archiver.
+CREATE TABLE archived_segments (
+    checkpoint_id INTEGER PRIMARY KEY REFERENCES chain_checkpoints (id),
+    first_block_id INTEGER NOT NULL UNIQUE,
+    last_block_id INTEGER NOT NULL UNIQUE,
+    block_count INTEGER NOT NULL,
+    segment_hash TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    compression TEXT NOT NULL,
+    file_sha256 TEXT NOT NULL,
+    archived_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+GRANT SELECT ON archived_segments TO app_user;
+
+-- Il job di archiviazione legge checkpoint, chiavi e blocchi del segmento e
+-- cancella i blocchi archiviati; non può inserirne né modificarne.
+GRANT SELECT, INSERT ON archived_segments TO archiver;
+GRANT SELECT, DELETE ON signature_chain TO archiver;
+GRANT SELECT ON signature_chain_blocks, documents, chain_checkpoints, signer_keys TO archiver;
+
+-- Ultimo blocco archiviato di ogni documento (archive.py).
+-- Un segmento è un intervallo di ID dell'intera catena: un documento senza
+-- append recenti può avere tutti i blocchi archiviati. La sua testa resta qui,
+-- scritta nella stessa transazione del DELETE, e gli append la usano quando il
+-- documento non ha più blocchi in signature_chain, invece di ripartire da un
+-- nuovo blocco genesi. L'ultimo blocco archiviato dell'intera catena è la riga
+-- con block_id massimo.
+CREATE TABLE archived_heads (
+    document_id UUID PRIMARY KEY,
+    block_id INTEGER NOT NULL,
+    signature TEXT NOT NULL
+);
+
+CREATE INDEX archived_heads_block_id_idx ON archived_heads (block_id);
+
+GRANT SELECT ON archived_heads TO app_user;
+GRANT SELECT, INSERT, UPDATE ON archived_heads TO archiver;
+
+-- request_id dei blocchi archiviati (archive.py), scritti nella stessa
+-- transazione del DELETE: l'indice unico di signature_chain copre solo i
+-- blocchi in tabella, e senza questa tabella una richiesta ripetuta dopo
+-- l'archiviazione del suo blocco ne inserirebbe un secondo. Firmatario, hash
+-- e algoritmo servono a riconoscere un request_id riusato (vedi append_block).
+CREATE TABLE archived_requests (
+    document_id UUID NOT NULL,
+    request_id TEXT NOT NULL,
+    block_id INTEGER NOT NULL,
+    signature TEXT NOT NULL,
+    signer TEXT NOT NULL,
+    document_hash TEXT NOT NULL,
+    hash_algorithm TEXT NOT NULL,
+    PRIMARY KEY (document_id, request_id)
+);
+
+GRANT SELECT ON archived_requests TO app_user;
+GRANT SELECT, INSERT ON archived_requests TO archiver;
+
+-- Notifica dei nuovi blocchi per il verificatore continuo (stream_verifier.py).
+-- Trigger a livello di istruzione: una sola NOTIFY per INSERT o COPY, con
+-- l'ID massimo inserito come payload; il verificatore legge poi i nuovi blocchi
+-- per ID. Le notifiche vengono consegnate solo al commit della transazione.
+CREATE OR REPLACE FUNCTION notify_blocks_appended()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    last_block_id INTEGER;
+BEGIN
+    SELECT max(id) INTO last_block_id FROM new_blocks;
+    IF last_block_id IS NOT NULL THEN
+        PERFORM pg_notify('signature_chain_appended', last_block_id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER signature_chain_appended
+    AFTER INSERT ON signature_chain
+    REFERENCING NEW TABLE AS new_blocks
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION notify_blocks_appended();
@@ -0,0 +1,237 @@
+"""
+Registro delle chiavi pubbliche dei firmatari (tabella `signer_keys`).
+
+Ogni blocco può registrare in `key_id` la chiave con cui è stato firmato; i
+blocchi che non la registrano vengono risolti cercando la chiave del firmatario
+valida all'istante `signed_at`. `KeyResolver` carica in blocco, con una sola
+query, le chiavi necessarie ad una verifica e tiene in cache gli oggetti chiave
+già analizzati, così che ogni chiave PEM venga decodificata una sola volta
+anche con migliaia di firmatari.
+
+Solo il ruolo `key_admin` (o il proprietario delle tabelle) può registrare
+chiavi: `app_user` legge il registro ma non lo scrive, altrimenti le sue
+credenziali basterebbero a firmare blocchi validi a nome di chiunque.
+"""
+import hashlib
+import threading
+
+from cryptography.hazmat.primitives import serialization
+
+_KEY_COLUMNS = "key_id, signer, fingerprint, public_key, valid_from, valid_to"
+
+
+def public_key_fingerprint(public_key_pem: bytes) -> str:
+    """
+    Calcola l'impronta di una chiave pubblica: SHA256 esadecimale della sua
+    codifica DER (SubjectPublicKeyInfo), indipendente dalla formattazione del PEM.
+    """
+    public_key = serialization.load_pem_public_key(public_key_pem)
+    der = public_key.public_bytes(encoding=serialization.Encoding.DER,
+                                  format=serialization.PublicFormat.SubjectPublicKeyInfo)
+    return hashlib.sha256(der).hexdigest()
+
+
+def register_key(conn, signer: str, public_key_pem: bytes, key_id: str | None = None,
+                 valid_from=None, valid_to=None) -> str:
+    """
+    Registra la chiave pubblica di un firmatario; se la stessa chiave (stessa
+    impronta) è già registrata restituisce il suo key_id.
+
+    Per una chiave che ha già firmato blocchi senza key_id va indicato un
+    `valid_from` non successivo al primo di quei blocchi (o chiamato poi
+    `backfill_valid_from`): con il default now() non sarebbero verificabili.
+
+    Args:
+        conn: La connessione al database psycopg2, come `key_admin` o proprietario.
+        signer (str): Il nome del firmatario.
+        public_key_pem (bytes): La chiave pubblica in formato PEM.
+        key_id (str | None, optional): L'identificativo della chiave. Defaults ai primi
+                                       16 caratteri dell'impronta.
+        valid_from (datetime | None, optional): Inizio di validità. Defaults a now() lato server.
+        valid_to (datetime | None, optional): Fine di validità (esclusa). Defaults a None (nessuna scadenza).
+
+    Returns:
+        str: Il key_id della chiave.
+    """
+    fingerprint = public_key_fingerprint(public_key_pem)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO signer_keys (key_id, signer, fingerprint, public_key, valid_from, valid_to)
+            VALUES (%s, %s, %s, %s, coalesce(%s, now()), %s)
+            ON CONFLICT (fingerprint) DO NOTHING
+            """,
+            (key_id or fingerprint[:16], signer, fingerprint, public_key_pem.decode(), valid_from, valid_to))
+        cursor.execute("SELECT key_id FROM signer_keys WHERE fingerprint = %s", (fingerprint,))
+        registered_key_id = cursor.fetchone()[0]
+    conn.commit()
+    return registered_key_id
+
+
+def backfill_valid_from(conn, key_id: str | None = None) -> int:
+    """
+    Retrodata `valid_from` delle chiavi al `signed_at` del primo blocco del
+    firmatario senza key_id, se precedente. Serve per le chiavi registrate dopo
+    i blocchi che hanno firmato, ad esempio all'introduzione del registro.
+    Va usata solo se il firmatario non ha ruotato chiave prima della
+    registrazione: quei blocchi vengono attribuiti alla chiave indicata.
+
+    Args:
+        conn: La connessione al database psycopg2, come `key_admin` o proprietario.
+        key_id (str | None, optional): La chiave da retrodatare. Defaults a tutte le chiavi
+                                       che sono le uniche del proprio firmatario.
+
+    Returns:
+        int: Il numero di chiavi retrodatate.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE signer_keys k SET valid_from = first_block.signed_at
+            FROM (SELECT signer, min(signed_at) AS signed_at FROM signature_chain
+                  WHERE key_id IS NULL GROUP BY signer) AS first_block
+            WHERE first_block.signer = k.signer AND first_block.signed_at < k.valid_from
+              AND (%(key_id)s::text IS NOT NULL AND k.key_id = %(key_id)s
+                   OR %(key_id)s::text IS NULL
+                      AND NOT EXISTS (SELECT 1 FROM signer_keys other
+                                      WHERE other.signer = k.signer AND other.key_id <> k.key_id))
+            """,
+            {"key_id": key_id})
+        updated = cursor.rowcount
+    conn.commit()
+    return updated
+
+
+class SignerKey:
+    """
+    Chiave pubblica del registro, già analizzata.
+    """
+    __slots__ = ("key_id", "signer", "fingerprint", "public_key", "valid_from", "valid_to")
+
+    def __init__(self, key_id, signer, fingerprint, public_key_pem, valid_from, valid_to):
+        self.key_id = key_id
+        self.signer = signer
+        self.fingerprint = fingerprint
+        self.public_key = serialization.load_pem_public_key(public_key_pem.encode())
+        self.valid_from = valid_from
+        self.valid_to = valid_to
+
+    def is_valid_at(self, instant) -> bool:
+        return self.valid_from <= instant and (self.valid_to is None or instant < self.valid_to)
+
+
+class KeyResolver:
+    """
+    Risolve le chiavi pubbliche dei blocchi dal registro `signer_keys`.
+
+    Le chiavi vengono caricate in blocco con `prefetch` (o alla prima richiesta)
+    e restano in cache per tutta la vita del resolver; il resolver può quindi
+    essere riutilizzato tra più verifiche sulla stessa connessione.
+    """
+
+    def __init__(self, conn):
+        """
+        Args:
+            conn: La connessione al database psycopg2 da cui leggere il registro.
+        """
+        self.conn = conn
+        self._by_key_id = {}
+        self._by_signer = {}
+        self._by_fingerprint = {}
+        self._loaded_signers = set()
+        self._lock = threading.Lock()
+
+    def prefetch(self, key_ids=(), signers=()) -> None:
+        """
+        Carica con una sola query le chiavi indicate per key_id e tutte le chiavi
+        dei firmatari indicati non ancora in cache.
+
+        Args:
+            key_ids (Iterable[str]): Le chiavi da caricare.
+            signers (Iterable[str]): I firmatari di cui caricare tutte le chiavi.
+        """
+        with self._lock:
+            missing_key_ids = sorted({key_id for key_id in key_ids if key_id and key_id not in self._by_key_id})
+            missing_signers = sorted({signer for signer in signers if signer not in self._loaded_signers})
+        if not missing_key_ids and not missing_signers:
+            return
+
+        with self.conn.cursor() as cursor:
+            cursor.execute(
+                f"SELECT {_KEY_COLUMNS} FROM signer_keys WHERE key_id = ANY(%s) OR signer = ANY(%s)",
+                (missing_key_ids, missing_signers))
+            rows = cursor.fetchall()
+
+        with self._lock:
+            for row in rows:
+                if self._by_key_id.get(row[0]) is None:
+                    self._add(SignerKey(*row))
+            # Le chiavi assenti dal registro restano in cache come None, senza nuove query.
+            for key_id in missing_key_ids:
+                self._by_key_id.setdefault(key_id, None)
+            self._loaded_signers.update(missing_signers)
+
+    def prefetch_blocks(self, rows) -> None:
+        """
+        Carica le chiavi necessarie a verificare i blocchi indicati.
+
+        Args:
+            rows: Coppie (signer, key_id) dei blocchi; key_id può essere None.
+        """
+        key_ids, signers = set(), set()
+        for signer, key_id in rows:
+            if key_id:
+                key_ids.add(key_id)
+            else:
+                signers.add(signer)
+        self.prefetch(key_ids, signers)
+
+    def resolve(self, signer: str, key_id: str | None = None, signed_at=None):
+        """
+        Restituisce la chiave pubblica (oggetto `cryptography`) di un blocco.
+
+        Args:
+            signer (str): Il firmatario del blocco.
+            key_id (str | None, optional): La chiave registrata nel blocco. Defaults to None.
+            signed_at (datetime | None, optional): L'istante di firma, usato quando key_id è None
+                                                   per scegliere la chiave valida in quel momento.
+
+        Returns:
+            La chiave pubblica, oppure None se non risolvibile o se la chiave appartiene
+            ad un altro firmatario o non era valida all'istante di firma.
+        """
+        if key_id:
+            if key_id not in self._by_key_id:
+                self.prefetch(key_ids=(key_id,))
+            key = self._by_key_id.get(key_id)
+            if key is None or key.signer != signer or (signed_at is not None and not key.is_valid_at(signed_at)):
+                return None
+            return key.public_key
+
+        if signer not in self._loaded_signers:
+            self.prefetch(signers=(signer,))
+        candidates = self._by_signer.get(signer, ())
+        if signed_at is not None:
+            candidates = [key for key in candidates if key.is_valid_at(signed_at)]
+        # In caso di più chiavi valide vince la più recente.
+        return max(candidates, key=lambda key: key.valid_from).public_key if candidates else None
+
+    def by_fingerprint(self, fingerprint: str) -> SignerKey | None:
+        """
+        Cerca una chiave per impronta, prima in cache e poi nel registro.
+        """
+        key = self._by_fingerprint.get(fingerprint)
+        if key is None:
+            with self.conn.cursor() as cursor:
+                cursor.execute(f"SELECT {_KEY_COLUMNS} FROM signer_keys WHERE fingerprint = %s", (fingerprint,))
+                row = cursor.fetchone()
+            if row is not None:
+                with self._lock:
+                    key = self._by_key_id.get(row[0]) or self._add(SignerKey(*row))
+        return key
+
+    def _add(self, key: SignerKey) -> SignerKey:
+        self._by_key_id[key.key_id] = key
+        self._by_fingerprint[key.fingerprint] = key
+        self._by_signer.setdefault(key.signer, []).append(key)
+        return key
@@ -0,0 +1,158 @@
+"""
+Generatore di carico per il servizio HTTP della catena di firme (`service.py`).
+
+Rigioca un file JSON Lines di richieste, una per riga:
+
+    {"method": "POST", "path": "/documents/<uuid>/signatures", "body": {"signer": "Antonio", "document": "..."}}
+    {"method": "GET", "path": "/documents/<uuid>/verify"}
+
+con un numero configurabile di client concorrenti, ciascuno con una propria
+connessione HTTP persistente, e riporta throughput, latenze e codici di stato.
+
+Uso:
+    python loadgen.py generate --documents 50 --appends 5 --signers Antonio,Marianna > requests.jsonl
+    python loadgen.py run requests.jsonl --url http://127.0.0.1:8000 --concurrency 8
+"""
+import argparse
+from collections import Counter
+import http.client
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+from uuid import UUID
+
+
+def generate_requests(documents: int, appends: int, signers: list[str], verify_every: int, seed: int):
+    """
+    Genera le richieste di un carico sintetico: per ogni documento `appends`
+    append con firmatari a rotazione e una verifica ogni `verify_every` append.
+
+    Yields:
+        dict: Una richiesta nel formato del file JSON Lines.
+    """
+    rng = random.Random(seed)
+    # Anche gli ID dei documenti vengono da `rng`: lo stesso seed riproduce lo stesso file.
+    document_ids = [str(UUID(int=rng.getrandbits(128), version=4)) for _ in range(documents)]
+    steps = [(document_id, n) for document_id in document_ids for n in range(appends)]
+    # Gli append di documenti diversi vengono mescolati; quelli di uno stesso
+    # documento mantengono l'ordine relativo.
+    rng.shuffle(steps)
+    counters = Counter()
+
+    for document_id, _ in steps:
+        n = counters[document_id]
+        counters[document_id] += 1
+        yield {"method": "POST", "path": f"/documents/{document_id}/signatures",
+               "body": {"signer": signers[n % len(signers)], "document": f"Documento {document_id}"}}
+        if verify_every and (n + 1) % verify_every == 0:
+            yield {"method": "GET", "path": f"/documents/{document_id}/verify"}
+
+
+def replay(requests: list[dict], url: str, concurrency: int) -> dict:
+    """
+    Rigioca le richieste con `concurrency` client concorrenti.
+
+    Returns:
+        dict: Latenze per metodo, codici di stato e durata complessiva.
+    """
+    target = urlsplit(url)
+    next_index = iter(range(len(requests)))
+    index_lock = threading.Lock()
+    latencies = {"GET": [], "POST": []}
+    statuses = Counter()
+    results_lock = threading.Lock()
+
+    def client():
+        connection = http.client.HTTPConnection(target.hostname, target.port or 80)
+        try:
+            while True:
+                with index_lock:
+                    index = next(next_index, None)
+                if index is None:
+                    return
+
+                request = requests[index]
+                body = json.dumps(request["body"]).encode() if "body" in request else None
+                headers = {"Content-Type": "application/json"} if body else {}
+
+                start = time.perf_counter()
+                try:
+                    connection.request(request["method"], request["path"], body=body, headers=headers)
+                    response = connection.getresponse()
+                    response.read()
+                    status = response.status
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    connection = http.client.HTTPConnection(target.hostname, target.port or 80)
+                    status = "errore"
+                elapsed = time.perf_counter() - start
+
+                with results_lock:
+                    latencies.setdefault(request["method"], []).append(elapsed)
+                    statuses[status] += 1
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {"latencies": latencies, "statuses": statuses, "elapsed": time.perf_counter() - start}
+
+
+def print_report(report: dict) -> None:
+    """
+    Stampa throughput, percentili di latenza per metodo e codici di stato.
+    """
+    total = sum(report["statuses"].values())
+    print(f"Richieste: {total} in {report['elapsed']:.2f} s ({total / report['elapsed']:.1f} req/s)")
+
+    for method, values in report["latencies"].items():
+        if not values:
+            continue
+        ordered = sorted(values)
+
+        def percentile(p):
+            return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+
+        print(f"  {method:<5} n={len(ordered):<7} media: {statistics.mean(ordered) * 1000:.2f} ms  "
+              f"p50: {percentile(0.50):.2f} ms  p95: {percentile(0.95):.2f} ms  p99: {percentile(0.99):.2f} ms")
+
+    print("  Codici di stato: " + ", ".join(f"{status}={count}" for status, count in sorted(
+        report["statuses"].items(), key=lambda item: str(item[0]))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generatore di carico per service.py.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="scrive su stdout un file JSON Lines di richieste")
+    generate_parser.add_argument("--documents", type=int, default=10)
+    generate_parser.add_argument("--appends", type=int, default=3, help="append per documento")
+    generate_parser.add_argument("--signers", default="Antonio,Marianna,Claudio")
+    generate_parser.add_argument("--verify-every", type=int, default=0,
+                                 help="una verifica ogni N append di un documento (0 = nessuna)")
+    generate_parser.add_argument("--seed", type=int, default=0)
+
+    run_parser = subparsers.add_parser("run", help="rigioca un file JSON Lines di richieste")
+    run_parser.add_argument("requests_file")
+    run_parser.add_argument("--url", default="http://127.0.0.1:8000")
+    run_parser.add_argument("--concurrency", type=int, default=4)
+
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        signers = [name.strip() for name in args.signers.split(",") if name.strip()]
+        for request in generate_requests(args.documents, args.appends, signers, args.verify_every, args.seed):
+            sys.stdout.write(json.dumps(request) + "\n")
+    else:
+        with open(args.requests_file, encoding="utf-8") as requests_file:
+            requests = [json.loads(line) for line in requests_file if line.strip()]
+        print_report(replay(requests, args.url, args.concurrency))
@@ -1,12 +1,19 @@
-import hashlib
 import psycopg2
 from uuid import uuid4
 from datetime import datetime
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import padding, rsa
-from cryptography.exceptions import InvalidSignature
 import os
 
+from metrics import (DB_CONNECT_SECONDS, HASH_SECONDS, SIGN_SECONDS, VERIFY_SECONDS,
+                     cursor_factory, instrumented, timed)
+from db_config import audit_connection
+from key_registry import KeyResolver, register_key
+from prepared_statements import HEAD_GLOBAL, INSERT_BLOCK_WITH_KEY, execute_prepared
+from profiling import configure_from_argv, profiled
+from signature_chain import core
+from signature_chain.hash_cache import document_hash_cache
+from snapshot_audit import read_only_snapshot
+from spot_check import SpotCheck
+
 
 class Colors:
     """
@@ -44,36 +51,27 @@ def generate_keys():
         tuple: Una tupla contenente la chiave privata PEM e la chiave pubblica PEM.
                (pem_private, pem_public)
     """
-    private_key = rsa.generate_private_key(
-        public_exponent=65537, key_size=2048)
-
-    pem_private = private_key.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.TraditionalOpenSSL,
-        encryption_algorithm=serialization.NoEncryption()
-    )
-
-    pem_public = private_key.public_key().public_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo
-    )
-
-    return pem_private, pem_public
+    return core.generate_keys()
 
 
-def hash_document(doc_bytes: bytes) -> str:
+@instrumented(HASH_SECONDS)
+def hash_document(doc_bytes: bytes, algorithm: str = core.DEFAULT_HASH_ALGORITHM) -> str:
     """
-    Calcola l'hash SHA256 di un documento.
+    Calcola l'hash di un documento. L'hash dello stesso oggetto viene calcolato
+    una sola volta per processo (vedi `signature_chain.hash_cache`).
 
     Args:
         doc_bytes (bytes): Il contenuto del documento come bytes.
+        algorithm (str, optional): L'algoritmo di hash (vedi `core.HASH_ALGORITHMS`).
+                                   Defaults to "sha256".
 
     Returns:
-        str: La rappresentazione esadecimale dell'hash SHA256.
+        str: La rappresentazione esadecimale dell'hash.
     """
-    return hashlib.sha256(doc_bytes).hexdigest()
+    return document_hash_cache.hash_document(doc_bytes, algorithm)
 
 
+@instrumented(SIGN_SECONDS)
 def sign_data(data: bytes, private_key_pem: bytes) -> str:
     """
     Firma i dati forniti utilizzando una chiave privata RSA.
@@ -85,52 +83,31 @@ def sign_data(data: bytes, private_key_pem: bytes) -> str:
     Returns:
         str: La firma digitale come stringa esadecimale.
     """
-    private_key = serialization.load_pem_private_key(
-        private_key_pem, password=None)
-
-    signature = private_key.sign(
-        data,
-        padding.PKCS1v15(),
-        hashes.SHA256()
-    )
-
-    return signature.hex()
+    return core.sign_data(data, private_key_pem)
 
 
+@instrumented(VERIFY_SECONDS)
 def verify_signature(data: bytes, signature_hex: str,
-                     public_key_pem: bytes) -> bool:
+                     public_key_pem) -> bool:
     """
     Verifica una firma digitale utilizzando una chiave pubblica RSA.
 
     Args:
         data (bytes): I dati originali che sono stati firmati.
         signature_hex (str): La firma digitale come stringa esadecimale.
-        public_key_pem (bytes): La chiave pubblica in formato PEM.
+        public_key_pem (bytes | RSAPublicKey): La chiave pubblica in formato PEM,
+                                               oppure già caricata (ad esempio da `KeyResolver`).
 
     Returns:
         bool: True se la firma è valida, False altrimenti.
     """
-    public_key = serialization.load_pem_public_key(public_key_pem)
-
-    try:
-        signature_bytes = bytes.fromhex(signature_hex)
-        public_key.verify(
-            signature_bytes,
-            data,
-            padding.PKCS1v15(),
-            hashes.SHA256()
-        )
-        return True
-    except InvalidSignature:
-        return False
-    except Exception as e:
-        print(
-            f"{Colors.FAIL}{EMOJI_FAIL} Errore durante la verifica della firma: {e}{Colors.ENDC}")
-        return False
+    return core.verify_signature(data, signature_hex, public_key_pem)
 
 
+@profiled("main.insert_signature_chain")
 def insert_signature_chain(document: bytes, signer: str, conn, private_key_pem: bytes, is_first_call: bool,
-                           original_doc_content: str):
+                           original_doc_content: str, signing_pool=None, key_id: str | None = None,
+                           hash_algorithm: str = core.DEFAULT_HASH_ALGORITHM):
     """
     Crea un nuovo blocco nella catena di firme e lo inserisce nel database.
 
@@ -146,7 +123,16 @@ def insert_signature_chain(document: bytes, signer: str, conn, private_key_pem:
                               per stampare un'intestazione generale.
         original_doc_content (str): Il contenuto originale del documento come stringa,
                                     per la stampa.
+        signing_pool (SigningPool | None, optional): Pool di processi con cui firmare;
+                                                     deve contenere la chiave di `signer`.
+                                                     Defaults to None (firma nel processo corrente).
+        key_id (str | None, optional): La chiave del registro `signer_keys` corrispondente a
+                                       `private_key_pem`, registrata nel blocco. Defaults to None.
+        hash_algorithm (str, optional): L'algoritmo di hash del documento, registrato in
+                                        documents.algorithm. Defaults to "sha256".
     """
+    document_hash = hash_document(document, hash_algorithm)
+
     if is_first_call:
         print(
             f"\n{
@@ -156,29 +142,26 @@ def insert_signature_chain(document: bytes, signer: str, conn, private_key_pem:
             f"{Colors.OKCYAN}Documento Originale: \"{original_doc_content}\"{Colors.ENDC}")
         print(
             f"{
-                Colors.OKCYAN}Hash Documento Originale: {
-                hash_document(document)}{
+                Colors.OKCYAN}Hash Documento Originale: {document_hash}{
                 Colors.ENDC}")
         print(Colors.OKCYAN + "-" * 70 + Colors.ENDC)
-
-    document_hash = hash_document(document)
     cursor = conn.cursor()
 
-    cursor.execute(
-        "SELECT signature FROM signature_chain ORDER BY id DESC LIMIT 1")
+    execute_prepared(cursor, HEAD_GLOBAL)
     row = cursor.fetchone()
     prev_hash = row[0] if row else None
 
     chain_input = (prev_hash or '').encode() + document_hash.encode()
-    signature = sign_data(chain_input, private_key_pem)
+    if signing_pool is not None:
+        signature = signing_pool.sign(chain_input, signer)
+    else:
+        signature = sign_data(chain_input, private_key_pem)
 
     document_id = str(uuid4())
 
-    cursor.execute("""
-        INSERT INTO signature_chain (document_id, signer, document_hash, prev_hash, signature)
-        VALUES (%s, %s, %s, %s, %s)
-        RETURNING id
-    """, (document_id, signer, document_hash, prev_hash, signature))
+    execute_prepared(
+        cursor, INSERT_BLOCK_WITH_KEY, (document_id, signer, document_hash, prev_hash, signature, key_id, len(document),
+                                          hash_algorithm))
 
     inserted_id = cursor.fetchone()[0]
     conn.commit()
@@ -199,7 +182,10 @@ def insert_signature_chain(document: bytes, signer: str, conn, private_key_pem:
     print(Colors.OKCYAN + "-" * 70 + Colors.ENDC)
 
 
-def verify_chain(conn, firmatari_data: dict, user_context: str = ""):
+@profiled("main.verify_chain")
+def verify_chain(conn, firmatari_data: dict | None, user_context: str = "", spot_check: SpotCheck | None = None,
+                 key_resolver: KeyResolver | None = None, max_block_id: int | None = None, archive=None,
+                 document: bytes | None = None):
     """
     Verifica l'integrità dell'intera catena di firme memorizzata nel database.
 
@@ -207,44 +193,125 @@ def verify_chain(conn, firmatari_data: dict, user_context: str = ""):
     la firma di ogni blocco sia valida rispetto ai dati firmati e alla chiave
     pubblica del firmatario.
 
+    In modalità spot check i collegamenti vengono comunque verificati su tutti
+    i blocchi, mentre le firme solo su un campione casuale riproducibile (vedi
+    `spot_check.py`); il report del campione è disponibile in `spot_check.report`.
+
+    Con `key_resolver` le chiavi pubbliche vengono risolte dal registro
+    `signer_keys` (per `key_id` del blocco o, in sua assenza, per firmatario e
+    `signed_at`) invece che da `firmatari_data`.
+
+    Se parte della catena è stata archiviata (vedi `archive.py`), i blocchi dei
+    segmenti archiviati vengono letti dai file di archivio, dopo averne
+    controllato l'integrità, e preceduti ai blocchi ancora nella tabella.
+
+    Con `document` si verifica anche che ogni blocco firmi proprio quel
+    documento: l'hash viene ricalcolato con l'algoritmo registrato nel blocco.
+
+    La verifica avviene in una transazione REPEATABLE READ READ ONLY (vedi
+    `snapshot_audit.py`), sui blocchi fino all'ID massimo visibile alla sua
+    apertura: la connessione non deve avere transazioni aperte.
+
     Args:
         conn: La connessione al database psycopg2.
-        firmatari_data (dict): Un dizionario che mappa i nomi dei firmatari
-                               alle loro chiavi pubbliche PEM.
+        firmatari_data (dict | None): Un dizionario che mappa i nomi dei firmatari
+                                      alle loro chiavi pubbliche PEM; può essere None
+                                      se si usa `key_resolver`.
         user_context (str, optional): Una stringa per descrivere il contesto
                                       della verifica (es. nome utente).
                                       Defaults to "".
+        spot_check (SpotCheck | None, optional): Se indicato, verifica le firme solo
+                                                 del campione pianificato da `spot_check`.
+                                                 Defaults to None (verifica completa).
+        key_resolver (KeyResolver | None, optional): Il resolver del registro delle chiavi.
+                                                     Defaults to None (usa `firmatari_data`).
+        max_block_id (int | None, optional): Verifica solo i blocchi con ID non superiore,
+                                             ad esempio il watermark di un audit su replica.
+                                             Defaults to None (tutti i blocchi).
+        archive (ChainArchive | None, optional): L'archivio dei segmenti archiviati.
+                                                 Defaults a `archive.ChainArchive()` (directory ARCHIVE_DIR).
+        document (bytes | None, optional): Il contenuto del documento firmato da tutti i blocchi.
+                                           Defaults to None (hash non ricalcolato).
 
     Returns:
-        bool: True se l'intera catena è valida, False altrimenti.
+        bool: True se l'intera catena è valida, False altrimenti. In modalità spot
+              check, True significa che non sono emersi errori nel campione.
     """
     print(
         f"\n{
             Colors.HEADER}{EMOJI_CHAIN}==== Verifica Integrità Catena Firme (Contesto: {user_context}) ===={
             Colors.ENDC}")
 
+    # Segmenti archiviati, blocchi e chiavi vengono letti dallo stesso snapshot:
+    # gli append e le archiviazioni concorrenti non alterano la catena verificata.
+    with read_only_snapshot(conn) as snapshot:
+        if max_block_id is None or max_block_id > snapshot.high_water_id:
+            max_block_id = snapshot.high_water_id
+        print(f"{Colors.OKCYAN}{EMOJI_INFO} Snapshot della verifica: blocchi fino all'ID {max_block_id}.{Colors.ENDC}")
+        return _verify_chain_in_snapshot(conn, firmatari_data, user_context, spot_check, key_resolver,
+                                         max_block_id, archive, document)
+
+
+def _verify_chain_in_snapshot(conn, firmatari_data, user_context, spot_check, key_resolver, max_block_id, archive,
+                              document) -> bool:
+    """
+    Corpo di `verify_chain`, eseguito nella transazione di `read_only_snapshot`.
+    """
+    # Import locale: archive.py dipende (tramite checkpoints.py) da questo modulo.
+    from archive import ChainArchive
+
+    archived_rows, archive_errors = (archive or ChainArchive()).load(conn, max_block_id)
+    # Stesse colonne della query sotto: id, signer, document_hash, prev_hash, signature, key_id, signed_at,
+    # hash_algorithm.
+    records = [(r[0], r[2], r[4], r[5], r[6], r[7], r[3], r[8]) for r in archived_rows]
+    for error in archive_errors:
+        print(
+            f"{Colors.FAIL}{EMOJI_FAIL} ERRORE: Segmento archiviato {error['first_block_id']}-{error['last_block_id']} "
+            f"non verificabile: {error['error']}{Colors.ENDC}")
+
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT id, signer, document_hash, prev_hash, signature FROM signature_chain ORDER BY id ASC")
-    records = cursor.fetchall()
+        "SELECT id, signer, document_hash, prev_hash, signature, key_id, signed_at, hash_algorithm "
+        "FROM signature_chain_blocks "
+        "WHERE (%s IS NULL OR id <= %s) AND id > %s ORDER BY id ASC",
+        (max_block_id, max_block_id, records[-1][0] if records else 0))
+    records.extend(cursor.fetchall())
 
-    if not records:
+    if not records and not archive_errors:
         print(
             f"{
                 Colors.WARNING}{EMOJI_INFO} Nessuna firma trovata nella catena per la verifica.{
                 Colors.ENDC}")
         return True
 
-    is_chain_valid = True
+    if key_resolver is not None:
+        key_resolver.prefetch_blocks((row[1], row[5]) for row in records)
+
+    sampled_ids = None
+    if spot_check is not None:
+        report = spot_check.plan([row[0] for row in records])
+        sampled_ids = set(report.sampled_ids)
+        print(
+            f"{Colors.OKCYAN}{EMOJI_INFO} Spot check: verifica delle firme di {len(report.sampled_ids)} blocchi su "
+            f"{report.population} (seme: {report.seed}, confidenza di rilevare il "
+            f"{report.tamper_rate:.2%} di blocchi manomessi: {report.confidence:.4%}).{Colors.ENDC}")
+
+    is_chain_valid = not archive_errors
     last_block_signature = None
+    # Hash di `document` per algoritmo, calcolati una sola volta.
+    document_hashes = {}
 
     for i, row_data in enumerate(records):
-        record_id, signer_name, doc_hash_stored, prev_hash_stored, current_signature_stored = row_data
+        (record_id, signer_name, doc_hash_stored, prev_hash_stored, current_signature_stored,
+         key_id_stored, signed_at, hash_algorithm) = row_data
+        # In modalità spot check si stampano solo i blocchi campionati e gli errori.
+        verbose = sampled_ids is None or record_id in sampled_ids
 
-        print(
-            f"\n{
-                Colors.OKCYAN}Verifica Blocco ID: {record_id} (Firmatario: {signer_name}){
-                Colors.ENDC}")
+        if verbose:
+            print(
+                f"\n{
+                    Colors.OKCYAN}Verifica Blocco ID: {record_id} (Firmatario: {signer_name}){
+                    Colors.ENDC}")
 
         if i == 0:
             if prev_hash_stored is not None:
@@ -262,7 +329,7 @@ def verify_chain(conn, firmatari_data: dict, user_context: str = ""):
                             :10]}...').{
                         Colors.ENDC}")
                 is_chain_valid = False
-            else:
+            elif verbose:
                 print(
                     f"  {
                         Colors.OKGREEN}{EMOJI_SUCCESS} OK: prev_hash ('{
@@ -270,7 +337,21 @@ def verify_chain(conn, firmatari_data: dict, user_context: str = ""):
                             :10]}...') corrisponde alla signature del blocco precedente.{
                         Colors.ENDC}")
 
-        public_key_pem = firmatari_data.get(signer_name)
+        if document is not None:
+            if hash_algorithm not in document_hashes:
+                document_hashes[hash_algorithm] = hash_document(document, hash_algorithm)
+            if doc_hash_stored != document_hashes[hash_algorithm]:
+                print(
+                    f"  {
+                        Colors.FAIL}{EMOJI_FAIL} ERRORE: document_hash del blocco {record_id} non corrisponde all'hash "
+                    f"{hash_algorithm} del documento.{
+                        Colors.ENDC}")
+                is_chain_valid = False
+
+        if key_resolver is not None:
+            public_key_pem = key_resolver.resolve(signer_name, key_id_stored, signed_at)
+        else:
+            public_key_pem = firmatari_data.get(signer_name)
 
         if not public_key_pem:
             print(
@@ -281,6 +362,10 @@ def verify_chain(conn, firmatari_data: dict, user_context: str = ""):
             last_block_signature = current_signature_stored
             continue
 
+        if not verbose:
+            last_block_signature = current_signature_stored
+            continue
+
         chain_input_to_verify = (
             prev_hash_stored or '').encode() + doc_hash_stored.encode()
 
@@ -302,7 +387,14 @@ def verify_chain(conn, firmatari_data: dict, user_context: str = ""):
     cursor.close()
     print(Colors.HEADER + "-" * 70 + Colors.ENDC)
 
-    if is_chain_valid:
+    if sampled_ids is not None:
+        print(
+            f"{Colors.OKCYAN}{EMOJI_INFO} Spot check (seme {spot_check.report.seed}): firme verificate per i blocchi "
+            f"{spot_check.report.sampled_ids}; confidenza {spot_check.report.confidence:.4%}.{Colors.ENDC}")
+
+    if is_chain_valid and sampled_ids is not None:
+        print(f"{Colors.OKGREEN}{EMOJI_SUCCESS} RISULTATO VERIFICA ({user_context}): collegamenti VALIDI e nessuna firma NON valida nel campione.{Colors.ENDC}")
+    elif is_chain_valid:
         print(f"{Colors.OKGREEN}{EMOJI_SUCCESS} RISULTATO VERIFICA ({user_context}): L'intera catena di firme è VALIDA.{Colors.ENDC}")
     else:
         print(f"{Colors.FAIL}{EMOJI_FAIL} RISULTATO VERIFICA ({user_context}): L'intera catena di firme NON È VALIDA. Controllare gli errori sopra.{Colors.ENDC}")
@@ -312,10 +404,37 @@ def verify_chain(conn, firmatari_data: dict, user_context: str = ""):
     return is_chain_valid
 
 
+def audit_chain(connection_params: dict, firmatari_data: dict | None, user_context: str = "",
+                spot_check: SpotCheck | None = None, document: bytes | None = None) -> bool:
+    """
+    Esegue `verify_chain` su una connessione di audit: sulla replica, se
+    configurata (vedi `db_config.py`), dopo averne atteso l'allineamento con il
+    primario, e fino all'ultimo blocco visibile sul primario in quel momento.
+    Le chiavi pubbliche vengono risolte dal registro `signer_keys`.
+
+    Args:
+        connection_params (dict): Parametri di connessione (dbname, user, password, host).
+        firmatari_data (dict | None): Vedi `verify_chain`.
+        user_context (str, optional): Il contesto della verifica. Defaults to "".
+        spot_check (SpotCheck | None, optional): Vedi `verify_chain`. Defaults to None.
+        document (bytes | None, optional): Vedi `verify_chain`. Defaults to None.
+
+    Returns:
+        bool: L'esito di `verify_chain`.
+    """
+    with audit_connection(**connection_params) as (audit_conn, watermark):
+        return verify_chain(audit_conn, firmatari_data, user_context, spot_check=spot_check,
+                            key_resolver=KeyResolver(audit_conn), max_block_id=watermark.max_block_id,
+                            document=document)
+
+
 def clear_signature_table(db_name_param, super_user_param,
                           super_password_param, db_host_param):
     """
-    Pulisce la tabella 'signature_chain' nel database.
+    Pulisce la tabella 'signature_chain' nel database, insieme ai checkpoint,
+    all'indice dei segmenti archiviati, alle teste e ai request_id archiviati
+    e ai file in ARCHIVE_DIR, così che un'esecuzione successiva non trovi
+    segmenti di una catena precedente.
     Questa funzione richiede privilegi di superutente per eseguire DELETE.
 
     Args:
@@ -324,6 +443,9 @@ def clear_signature_table(db_name_param, super_user_param,
         super_password_param (str): Password del superutente del database.
         db_host_param (str): Host del database.
     """
+    # Import locale: archive.py dipende (tramite checkpoints.py) da questo modulo.
+    from archive import ARCHIVE_DIR
+
     conn_super_clear = None
 
     try:
@@ -331,14 +453,24 @@ def clear_signature_table(db_name_param, super_user_param,
             f"\n{
                 Colors.WARNING}{EMOJI_DB} Tentativo di pulire la tabella signature_chain come utente '{super_user_param}'...{
                 Colors.ENDC}")
-        conn_super_clear = psycopg2.connect(
-            dbname=db_name_param,
-            user=super_user_param,
-            password=super_password_param,
-            host=db_host_param)
+        with timed(DB_CONNECT_SECONDS):
+            conn_super_clear = psycopg2.connect(
+                dbname=db_name_param,
+                user=super_user_param,
+                password=super_password_param,
+                host=db_host_param,
+                cursor_factory=cursor_factory())
         with conn_super_clear.cursor() as cursor:
+            cursor.execute("DELETE FROM archived_segments RETURNING file_name;")
+            archive_files = [row[0] for row in cursor.fetchall()]
+            cursor.execute("DELETE FROM archived_heads;")
+            cursor.execute("DELETE FROM archived_requests;")
+            cursor.execute("DELETE FROM chain_checkpoints;")
             cursor.execute("DELETE FROM signature_chain;")
         conn_super_clear.commit()
+        # I file si rimuovono solo dopo il COMMIT: se la pulizia fallisce restano leggibili.
+        for file_name in archive_files:
+            (ARCHIVE_DIR / file_name).unlink(missing_ok=True)
         print(
             f"{
                 Colors.OKGREEN}{EMOJI_SUCCESS} Tabella signature_chain pulita con successo.{
@@ -353,17 +485,33 @@ def clear_signature_table(db_name_param, super_user_param,
 
 
 if __name__ == "__main__":
+    # --profile, --profile-dir DIR, --profile-perf (vedi profiling.py)
+    configure_from_argv()
+
     # Variabili di connessione al DB, configurabili tramite ENV o con valori
     # di default
     app_db_user = os.environ.get("APP_DB_USER", "app_user")
     app_db_password = os.environ.get("APP_DB_PASSWORD", "app_password")
     super_db_user = os.environ.get("SUPER_DB_USER", "postgres")
     super_db_password = os.environ.get("SUPER_DB_PASSWORD", "postgres")
+    key_admin_db_user = os.environ.get("KEY_ADMIN_DB_USER", "key_admin")
+    key_admin_db_password = os.environ.get("KEY_ADMIN_DB_PASSWORD", "key_admin_password")
     db_name = os.environ.get("DB_NAME", "signature_demo")
     db_host = os.environ.get("DB_HOST", "localhost")
 
+    # Spot check delle firme in verify_chain (vedi spot_check.py): abilitato
+    # impostando la probabilità di rilevazione richiesta.
+    spot_check = None
+    if os.environ.get("SPOT_CHECK_DETECTION_PROBABILITY"):
+        spot_check = SpotCheck(
+            detection_probability=float(os.environ["SPOT_CHECK_DETECTION_PROBABILITY"]),
+            tamper_rate=float(os.environ.get("SPOT_CHECK_TAMPER_RATE", "0.01")),
+            seed=int(os.environ["SPOT_CHECK_SEED"]) if os.environ.get("SPOT_CHECK_SEED") else None)
+
     doc_content = "Contenuto documento firmato da più persone"
     doc_bytes = doc_content.encode("utf-8")
+    # Algoritmo di hash del documento per questa catena (sha256, sha512_256, blake2b).
+    hash_algorithm = os.environ.get("DOCUMENT_HASH_ALGORITHM", core.DEFAULT_HASH_ALGORITHM)
 
     firmatari_list = []
     nomi_firmatari = ["Antonio", "Marianna", "Claudio"]
@@ -374,6 +522,11 @@ if __name__ == "__main__":
 
     firmatari_pub_keys = {f["nome"]: f["pub"] for f in firmatari_list}
 
+    # Le verifiche vengono eseguite sulla replica se DB_READER_DSN è impostato.
+    app_connection_params = {"dbname": db_name, "user": app_db_user, "password": app_db_password, "host": db_host}
+    super_connection_params = {"dbname": db_name, "user": super_db_user, "password": super_db_password,
+                               "host": db_host}
+
     clear_signature_table(db_name, super_db_user, super_db_password, db_host)
 
     print(
@@ -390,15 +543,27 @@ if __name__ == "__main__":
                 Colors.OKBLUE}{app_db_user}{
                 Colors.ENDC}'...")
 
-        conn_app = psycopg2.connect(
-            dbname=db_name,
-            user=app_db_user,
-            password=app_db_password,
-            host=db_host)
+        with timed(DB_CONNECT_SECONDS):
+            conn_app = psycopg2.connect(
+                dbname=db_name,
+                user=app_db_user,
+                password=app_db_password,
+                host=db_host,
+                cursor_factory=cursor_factory())
 
         print(
             f"{Colors.OKGREEN}{EMOJI_SUCCESS} Connessione come {app_db_user} riuscita.{Colors.ENDC}")
 
+        # Registra le chiavi pubbliche dei firmatari in signer_keys: la verifica
+        # le risolve dal registro tramite il key_id salvato in ogni blocco.
+        # La registrazione passa da key_admin: app_user legge il registro ma non lo scrive.
+        conn_keys = psycopg2.connect(dbname=db_name, user=key_admin_db_user, password=key_admin_db_password,
+                                     host=db_host)
+        try:
+            key_ids = {f["nome"]: register_key(conn_keys, f["nome"], f["pub"]) for f in firmatari_list}
+        finally:
+            conn_keys.close()
+
         for i, firmatario_info in enumerate(firmatari_list):
             insert_signature_chain(
                 doc_bytes,
@@ -406,12 +571,16 @@ if __name__ == "__main__":
                 conn_app,
                 firmatario_info["priv"],
                 i == 0,
-                doc_content)
+                doc_content,
+                key_id=key_ids[firmatario_info["nome"]],
+                hash_algorithm=hash_algorithm)
 
-        verify_chain(
-            conn_app,
+        audit_chain(
+            app_connection_params,
             firmatari_pub_keys,
-            f"{app_db_user} - Post Inserimento")
+            f"{app_db_user} - Post Inserimento",
+            spot_check=spot_check,
+            document=doc_bytes)
 
         print(
             f"\n{
@@ -464,10 +633,12 @@ if __name__ == "__main__":
                     Colors.WARNING}{EMOJI_WARN} Non ci sono abbastanza firmatari per testare la manomissione.{
                     Colors.ENDC}")
 
-        verify_chain(
-            conn_app,
+        audit_chain(
+            app_connection_params,
             firmatari_pub_keys,
-            f"{app_db_user} - Post Tentativo UPDATE Bloccato")
+            f"{app_db_user} - Post Tentativo UPDATE Bloccato",
+            spot_check=spot_check,
+            document=doc_bytes)
 
     except psycopg2.OperationalError as e:
         print(
@@ -504,16 +675,22 @@ if __name__ == "__main__":
             f"{EMOJI_DB} Tentativo di connessione al database '{db_name}' come utente '{
                 Colors.WARNING}{super_db_user}{
                 Colors.ENDC}'...")
-        conn_super_scenario = psycopg2.connect(
-            dbname=db_name,
-            user=super_db_user,
-            password=super_db_password,
-            host=db_host)
+        with timed(DB_CONNECT_SECONDS):
+            conn_super_scenario = psycopg2.connect(
+                dbname=db_name,
+                user=super_db_user,
+                password=super_db_password,
+                host=db_host,
+                cursor_factory=cursor_factory())
         print(
             f"{
                 Colors.OKGREEN}{EMOJI_SUCCESS} Connessione come '{super_db_user}' riuscita.{
                 Colors.ENDC}")
 
+        # Registra le chiavi pubbliche dei firmatari in signer_keys: la verifica
+        # le risolve dal registro tramite il key_id salvato in ogni blocco.
+        key_ids = {f["nome"]: register_key(conn_super_scenario, f["nome"], f["pub"]) for f in firmatari_list}
+
         for i, firmatario_info in enumerate(firmatari_list):
             insert_signature_chain(
                 doc_bytes,
@@ -521,12 +698,16 @@ if __name__ == "__main__":
                 conn_super_scenario,
                 firmatario_info["priv"],
                 i == 0,
-                doc_content)
+                doc_content,
+                key_id=key_ids[firmatario_info["nome"]],
+                hash_algorithm=hash_algorithm)
 
-        verify_chain(
-            conn_super_scenario,
+        audit_chain(
+            super_connection_params,
             firmatari_pub_keys,
-            f"{super_db_user} - Post Inserimento")
+            f"{super_db_user} - Post Inserimento",
+            spot_check=spot_check,
+            document=doc_bytes)
 
         print(
             f"\n{
@@ -575,8 +756,12 @@ if __name__ == "__main__":
                     Colors.WARNING}{EMOJI_WARN} Non ci sono abbastanza firmatari per testare la manomissione.{
                     Colors.ENDC}")
 
-        verify_chain(conn_super_scenario, firmatari_pub_keys,
-                     f"{super_db_user} - Post Manomissione DB")
+        audit_chain(
+            super_connection_params,
+            firmatari_pub_keys,
+            f"{super_db_user} - Post Manomissione DB",
+            spot_check=spot_check,
+            document=doc_bytes)
 
     except psycopg2.OperationalError as e:
         print(
@@ -0,0 +1,318 @@
+"""
+Metriche dei percorsi caldi della catena di firme in formato Prometheus.
+
+Contatori e istogrammi di latenza per hashing, firma, verifica, singole
+istruzioni SQL, acquisizione delle connessioni e attesa degli advisory lock.
+
+Le metriche si abilitano all'avvio con la variabile d'ambiente
+`SIGNATURE_CHAIN_METRICS=1`. Se disabilitate il costo è praticamente nullo:
+`instrumented` restituisce la funzione originale senza wrapper, `timed`
+restituisce un context manager vuoto condiviso e `cursor_factory` restituisce
+None, cioè il cursore standard di psycopg2.
+
+Esposizione:
+    - `render_prometheus()` restituisce il testo in formato di esposizione Prometheus;
+    - `SIGNATURE_CHAIN_METRICS_FILE=<percorso>` scrive il file all'uscita del processo;
+    - `start_http_server(porta)` espone `/metrics` su HTTP (il servizio `service.py`
+      espone già `GET /metrics`).
+"""
+import atexit
+import bisect
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("SIGNATURE_CHAIN_METRICS", "").lower() in ("1", "true", "yes", "on")
+
+HASH_SECONDS = "signature_chain_hash_seconds"
+SIGN_SECONDS = "signature_chain_sign_seconds"
+VERIFY_SECONDS = "signature_chain_verify_seconds"
+DB_STATEMENT_SECONDS = "signature_chain_db_statement_seconds"
+DB_CONNECT_SECONDS = "signature_chain_db_connect_seconds"
+LOCK_WAIT_SECONDS = "signature_chain_lock_wait_seconds"
+LOCK_ACQUISITIONS_TOTAL = "signature_chain_lock_acquisitions_total"
+SERIALIZATION_FAILURES_TOTAL = "signature_chain_serialization_failures_total"
+ADMISSION_WAIT_SECONDS = "signature_chain_admission_wait_seconds"
+ADMISSION_TOTAL = "signature_chain_admission_total"
+DB_ERRORS_TOTAL = "signature_chain_db_errors_total"
+STREAM_BLOCKS_TOTAL = "signature_chain_stream_blocks_total"
+STREAM_LAG_SECONDS = "signature_chain_stream_lag_seconds"
+
+# Da 50µs a 10s: copre sia hashing di piccoli documenti sia attese di lock sotto contesa.
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Istogramma cumulativo con etichette, nel formato atteso da Prometheus.
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {labels: ([*counts], total, count) for labels, (counts, total, count) in self._series.items()}
+        for labels, (counts, total, count) in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, ('le', repr(bound)))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+class Counter:
+    """
+    Contatore monotono con etichette.
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, labels: tuple = ()) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = dict(self._values)
+        for labels, value in sorted(snapshot.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+def _labels(names: tuple, values: tuple, extra: tuple | None = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+REGISTRY = {
+    metric.name: metric for metric in (
+        Histogram(HASH_SECONDS, "Durata del calcolo dell'hash di un documento."),
+        Histogram(SIGN_SECONDS, "Durata della firma RSA di un blocco."),
+        Histogram(VERIFY_SECONDS, "Durata della verifica RSA della firma di un blocco."),
+        Histogram(DB_STATEMENT_SECONDS, "Durata di un'istruzione SQL (round trip incluso).", ("statement",)),
+        Histogram(DB_CONNECT_SECONDS, "Durata dell'acquisizione di una connessione al database."),
+        Histogram(LOCK_WAIT_SECONDS, "Attesa per l'acquisizione dell'advisory lock di un documento."),
+        Counter(LOCK_ACQUISITIONS_TOTAL, "Tentativi di acquisizione dell'advisory lock di un documento, "
+                "per politica ed esito (acquired, busy).", ("policy", "result")),
+        Counter(SERIALIZATION_FAILURES_TOTAL, "Append SERIALIZABLE annullati per conflitto di serializzazione "
+                "(SQLSTATE 40001), per esito (retried, exhausted).", ("result",)),
+        Histogram(ADMISSION_WAIT_SECONDS, "Attesa in coda prima dell'ammissione di un append."),
+        Counter(ADMISSION_TOTAL, "Richieste al controllo di ammissione, per esito "
+                "(admitted, queue_full, timeout).", ("result",)),
+        Counter(DB_ERRORS_TOTAL, "Istruzioni SQL terminate con errore.", ("statement",)),
+        Counter(STREAM_BLOCKS_TOTAL, "Blocchi verificati dal verificatore continuo, per esito.", ("result",)),
+        Histogram(STREAM_LAG_SECONDS, "Ritardo tra signed_at di un blocco e la sua verifica continua."),
+    )
+}
+
+
+class _NullTimer:
+    """
+    Context manager vuoto usato quando le metriche sono disabilitate.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+        return False
+
+
+def timed(name: str, *labels):
+    """
+    Context manager che registra la durata del blocco nell'istogramma `name`.
+
+    Args:
+        name (str): Il nome dell'istogramma.
+        *labels: I valori delle etichette dell'istogramma, nell'ordine dichiarato.
+    """
+    if not ENABLED:
+        return _NULL_TIMER
+    return _Timer(REGISTRY[name], labels)
+
+
+def instrumented(name: str):
+    """
+    Decoratore che registra la durata di ogni chiamata nell'istogramma `name`.
+    Se le metriche sono disabilitate restituisce la funzione invariata.
+
+    Args:
+        name (str): Il nome dell'istogramma.
+    """
+    def decorator(func):
+        if not ENABLED:
+            return func
+        histogram = REGISTRY[name]
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def statement_label(query) -> str:
+    """
+    Ricava un'etichetta a bassa cardinalità da un'istruzione SQL: il nome del
+    prepared statement per `EXECUTE`, le funzioni note della catena, altrimenti
+    la prima parola chiave.
+    """
+    text = query.decode() if isinstance(query, bytes) else str(query)
+    words = text.split(None, 2)
+    if not words:
+        return "empty"
+    keyword = words[0].upper()
+    if keyword == "EXECUTE" and len(words) > 1:
+        return words[1].split("(")[0]
+    for function in ("append_block", "pg_advisory_xact_lock", "pg_try_advisory_xact_lock"):
+        if function + "(" in text:
+            return function
+    return keyword.lower()
+
+
+def cursor_factory():
+    """
+    Restituisce la classe di cursore psycopg2 che misura ogni istruzione SQL,
+    da passare a `psycopg2.connect(..., cursor_factory=...)`; None se le
+    metriche sono disabilitate.
+    """
+    if not ENABLED:
+        return None
+    return _instrumented_cursor_class()
+
+
+@functools.cache
+def _instrumented_cursor_class():
+    import psycopg2
+    import psycopg2.extensions
+
+    histogram = REGISTRY[DB_STATEMENT_SECONDS]
+    errors = REGISTRY[DB_ERRORS_TOTAL]
+
+    class InstrumentedCursor(psycopg2.extensions.cursor):
+        """
+        Cursore psycopg2 che registra la durata di ogni `execute`.
+        """
+
+        def execute(self, query, vars=None):
+            labels = (statement_label(query),)
+            start = time.perf_counter()
+            try:
+                return super().execute(query, vars)
+            except psycopg2.Error:
+                errors.inc(labels=labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start, labels)
+
+    return InstrumentedCursor
+
+
+def render_prometheus() -> str:
+    """
+    Restituisce tutte le metriche nel formato di esposizione testuale di Prometheus.
+    """
+    lines = []
+    for metric in REGISTRY.values():
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_file(path: str) -> None:
+    """
+    Scrive le metriche su file in formato Prometheus (ad esempio per il
+    textfile collector di node_exporter), tramite rinomina atomica.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as metrics_file:
+        metrics_file.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Avvia in un thread daemon un server HTTP che espone `/metrics`.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            payload = render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if ENABLED and os.environ.get("SIGNATURE_CHAIN_METRICS_FILE"):
+    atexit.register(write_prometheus_file, os.environ["SIGNATURE_CHAIN_METRICS_FILE"])
@@ -0,0 +1,213 @@
+-- Migrazione: porta un database creato dall'init.sql originale (tabella
+-- signature_chain, ruolo app_user e policy RLS) allo schema su cui si basano
+-- le migrazioni successive: registro delle chiavi (signer_keys, colonna
+-- signature_chain.key_id), indici della testa e degli audit per finestra,
+-- append_block, checkpoint firmati, indice dei segmenti archiviati e notifica
+-- dei nuovi blocchi. Da eseguire per prima, come proprietario delle tabelle,
+-- in una transazione:
+--   psql -v ON_ERROR_STOP=1 -1 -d signature_demo -f migrations/000_chain_schema.sql
+-- e poi, in ordine, 001_documents.sql ... 008_archived_requests.sql.
+-- I database creati da un init.sql che contiene già signer_keys partono da 001.
+
+-- Registro delle chiavi pubbliche dei firmatari.
+-- Un firmatario può avere più chiavi nel tempo (rotazione): ogni chiave è
+-- valida nell'intervallo [valid_from, valid_to). L'impronta è lo SHA256 della
+-- chiave pubblica in formato DER (SubjectPublicKeyInfo).
+CREATE TABLE signer_keys (
+    key_id TEXT PRIMARY KEY,
+    signer TEXT NOT NULL,
+    fingerprint TEXT NOT NULL UNIQUE,
+    public_key TEXT NOT NULL,
+    valid_from TIMESTAMPTZ NOT NULL DEFAULT now(),
+    valid_to TIMESTAMPTZ,
+    CHECK (valid_to IS NULL OR valid_to > valid_from)
+);
+
+CREATE INDEX signer_keys_signer_idx ON signer_keys (signer, valid_from);
+
+-- app_user legge il registro; la registrazione delle chiavi è riservata al
+-- ruolo key_admin creato da 004_key_admin.sql.
+GRANT SELECT ON signer_keys TO app_user;
+
+-- Chiave con cui è stato firmato il blocco; NULL per i blocchi che non la
+-- registrano, la cui chiave viene risolta per firmatario e signed_at.
+ALTER TABLE signature_chain ADD COLUMN key_id TEXT REFERENCES signer_keys (key_id);
+
+-- Indice per la lettura della testa della catena di un documento
+-- (WHERE document_id = ... ORDER BY id DESC LIMIT 1), eseguita ad ogni append.
+CREATE INDEX signature_chain_document_id_idx ON signature_chain (document_id, id);
+
+-- Indici per gli audit su una finestra temporale (range_audit.py, verify_time_range),
+-- sull'intera catena o su un singolo documento.
+CREATE INDEX signature_chain_signed_at_idx ON signature_chain (signed_at);
+CREATE INDEX signature_chain_document_signed_at_idx ON signature_chain (document_id, signed_at);
+
+-- Append della catena in un singolo round trip.
+-- Il client legge la testa corrente del documento, firma fuori da qualsiasi lock
+-- e invoca questa funzione: l'advisory lock transazionale del documento (stessa
+-- chiave calcolata da generate_advisory_lock_key in Python), la verifica della
+-- testa attesa e l'INSERT avvengono lato server in un'unica chiamata.
+-- Restituisce l'ID del blocco inserito oppure, se la testa è cambiata nel
+-- frattempo, block_id NULL e la testa corrente, così che il client possa
+-- rifirmare e riprovare.
+CREATE OR REPLACE FUNCTION append_block(
+    p_document_id UUID,
+    p_signer TEXT,
+    p_document_hash TEXT,
+    p_expected_prev TEXT,
+    p_signature TEXT,
+    p_key_id TEXT DEFAULT NULL,
+    OUT block_id INTEGER,
+    OUT current_head TEXT
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- 15 caratteri esadecimali (60 bit) dello SHA256 del document_id, come in Python.
+    PERFORM pg_advisory_xact_lock(
+        ('x' || lpad(substr(encode(digest(p_document_id::text, 'sha256'), 'hex'), 1, 15), 16, '0'))::bit(64)::bigint);
+
+    SELECT sc.signature INTO current_head
+    FROM signature_chain sc
+    WHERE sc.document_id = p_document_id
+    ORDER BY sc.id DESC
+    LIMIT 1;
+
+    IF current_head IS DISTINCT FROM p_expected_prev THEN
+        block_id := NULL;
+        RETURN;
+    END IF;
+
+    INSERT INTO signature_chain (document_id, signer, document_hash, prev_hash, signature, key_id)
+    VALUES (p_document_id, p_signer, p_document_hash, p_expected_prev, p_signature, p_key_id)
+    RETURNING id INTO block_id;
+
+    current_head := p_signature;
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION append_block(UUID, TEXT, TEXT, TEXT, TEXT, TEXT) TO app_user;
+
+-- Checkpoint firmati della catena.
+-- Ogni checkpoint chiude un segmento di blocchi consecutivi per ID
+-- (first_block_id..last_block_id, contiguo al segmento precedente) e ne
+-- registra numero di blocchi e hash; la firma, con la chiave designata per i
+-- checkpoint, copre anche la firma del checkpoint precedente, così che i
+-- checkpoint formino a loro volta una catena.
+CREATE TABLE chain_checkpoints (
+    id SERIAL PRIMARY KEY,
+    first_block_id INTEGER NOT NULL,
+    last_block_id INTEGER NOT NULL UNIQUE,
+    block_count INTEGER NOT NULL,
+    segment_hash TEXT NOT NULL,
+    prev_signature TEXT UNIQUE,
+    signer TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    signature TEXT NOT NULL,
+    CHECK (first_block_id <= last_block_id)
+);
+
+GRANT SELECT, INSERT ON chain_checkpoints TO app_user;
+GRANT USAGE ON SEQUENCE chain_checkpoints_id_seq TO app_user;
+
+ALTER TABLE chain_checkpoints ENABLE ROW LEVEL SECURITY;
+ALTER TABLE chain_checkpoints FORCE ROW LEVEL SECURITY;
+
+CREATE POLICY allow_inserts_for_public ON chain_checkpoints
+    FOR INSERT TO PUBLIC
+    WITH CHECK (true);
+
+CREATE POLICY allow_select_for_public ON chain_checkpoints
+    FOR SELECT TO PUBLIC
+    USING (true);
+
+REVOKE UPDATE, DELETE ON chain_checkpoints FROM PUBLIC;
+
+-- Hash di un segmento di blocchi, calcolato lato server: SHA256 della
+-- concatenazione, in ordine di ID, di una riga per blocco
+-- "id|document_id|signer|document_hash|prev_hash|signature\n"
+-- (stessa codifica di checkpoints.segment_hash in Python).
+CREATE OR REPLACE FUNCTION chain_segment_digest(
+    p_first_id INTEGER,
+    p_last_id INTEGER,
+    OUT block_count INTEGER,
+    OUT segment_hash TEXT
+)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT count(*)::integer,
+           encode(digest(coalesce(string_agg(
+               sc.id::text || '|' || sc.document_id::text || '|' || sc.signer || '|' ||
+               sc.document_hash || '|' || coalesce(sc.prev_hash, '') || '|' || sc.signature || E'\n',
+               '' ORDER BY sc.id), ''), 'sha256'), 'hex')
+    FROM signature_chain sc
+    WHERE sc.id BETWEEN p_first_id AND p_last_id;
+$$;
+
+GRANT EXECUTE ON FUNCTION chain_segment_digest(INTEGER, INTEGER) TO app_user;
+
+-- Lock usato da chi crea un checkpoint: attende la fine delle transazioni che
+-- stanno inserendo blocchi e blocca i nuovi INSERT fino al commit, così che
+-- nessun blocco con ID inferiore alla fine del segmento possa comparire dopo
+-- la creazione del checkpoint. La modalità è in conflitto con se stessa, quindi
+-- serializza anche più processi di checkpoint concorrenti.
+-- SECURITY DEFINER: app_user, con il solo privilegio INSERT, non potrebbe
+-- acquisire questa modalità di lock direttamente.
+CREATE OR REPLACE FUNCTION lock_chain_for_checkpoint()
+RETURNS void
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+BEGIN
+    LOCK TABLE signature_chain IN SHARE ROW EXCLUSIVE MODE;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION lock_chain_for_checkpoint() FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION lock_chain_for_checkpoint() TO app_user;
+
+-- Indice dei segmenti archiviati (archive.py).
+-- Un segmento chiuso da un checkpoint viene esportato in un file compresso e
+-- rimosso da signature_chain; qui restano l'intervallo di blocchi, l'hash del
+-- segmento firmato nel checkpoint e il file che lo contiene. Scritta solo dal
+-- job di archiviazione, che gira con un ruolo privilegiato.
+CREATE TABLE archived_segments (
+    checkpoint_id INTEGER PRIMARY KEY REFERENCES chain_checkpoints (id),
+    first_block_id INTEGER NOT NULL UNIQUE,
+    last_block_id INTEGER NOT NULL UNIQUE,
+    block_count INTEGER NOT NULL,
+    segment_hash TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    compression TEXT NOT NULL,
+    file_sha256 TEXT NOT NULL,
+    archived_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+GRANT SELECT ON archived_segments TO app_user;
+
+-- Notifica dei nuovi blocchi per il verificatore continuo (stream_verifier.py).
+-- Trigger a livello di istruzione: una sola NOTIFY per INSERT o COPY, con
+-- l'ID massimo inserito come payload; il verificatore legge poi i nuovi blocchi
+-- per ID. Le notifiche vengono consegnate solo al commit della transazione.
+CREATE OR REPLACE FUNCTION notify_blocks_appended()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    last_block_id INTEGER;
+BEGIN
+    SELECT max(id) INTO last_block_id FROM new_blocks;
+    IF last_block_id IS NOT NULL THEN
+        PERFORM pg_notify('signature_chain_appended', last_block_id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER signature_chain_appended
+    AFTER INSERT ON signature_chain
+    REFERENCING NEW TABLE AS new_blocks
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION notify_blocks_appended();
@@ -0,0 +1,156 @@
+-- Migrazione di un database esistente alla tabella documents.
+-- I blocchi già presenti conservano document_hash e restano verificabili: la
+-- vista signature_chain_blocks restituisce document_hash quando è valorizzato
+-- e l'hash del documento referenziato altrimenti. Richiede lo schema creato da
+-- 000_chain_schema.sql (signer_keys, key_id, append_block a sei argomenti,
+-- chain_checkpoints, archived_segments). Da eseguire dopo 000, come
+-- proprietario delle tabelle, in una transazione:
+--   psql -v ON_ERROR_STOP=1 -1 -d signature_demo -f migrations/001_documents.sql
+
+CREATE TABLE documents (
+    id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE,
+    size BIGINT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+GRANT SELECT ON documents TO app_user;
+
+-- Restituisce l'ID del documento con l'hash indicato, registrandolo se non esiste.
+-- La dimensione, se nota, viene registrata alla prima occasione.
+CREATE OR REPLACE FUNCTION document_ref(p_hash TEXT, p_size BIGINT DEFAULT NULL)
+RETURNS BIGINT
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+    ref BIGINT;
+    known_size BIGINT;
+BEGIN
+    SELECT id, size INTO ref, known_size FROM documents WHERE hash = p_hash;
+    IF ref IS NULL THEN
+        INSERT INTO documents (hash, size) VALUES (p_hash, p_size)
+        ON CONFLICT (hash) DO NOTHING
+        RETURNING id INTO ref;
+        IF ref IS NULL THEN
+            -- Registrato da una transazione concorrente.
+            SELECT id, size INTO ref, known_size FROM documents WHERE hash = p_hash;
+        ELSE
+            RETURN ref;
+        END IF;
+    END IF;
+    IF known_size IS NULL AND p_size IS NOT NULL THEN
+        UPDATE documents SET size = p_size WHERE id = ref AND size IS NULL;
+    END IF;
+    RETURN ref;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION document_ref(TEXT, BIGINT) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION document_ref(TEXT, BIGINT) TO app_user;
+
+ALTER TABLE signature_chain
+    DROP COLUMN chain_hash,
+    ADD COLUMN document_ref BIGINT REFERENCES documents (id),
+    ALTER COLUMN document_hash DROP NOT NULL,
+    ADD CHECK (document_ref IS NOT NULL OR document_hash IS NOT NULL);
+
+CREATE INDEX signature_chain_document_ref_idx ON signature_chain (document_ref);
+
+-- Gli INSERT che indicano ancora document_hash (COPY, script esistenti)
+-- vengono normalizzati: l'hash viene spostato in documents.
+CREATE OR REPLACE FUNCTION normalize_block_document()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NEW.document_ref IS NULL AND NEW.document_hash IS NOT NULL THEN
+        NEW.document_ref := document_ref(NEW.document_hash);
+        NEW.document_hash := NULL;
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER signature_chain_normalize_document
+    BEFORE INSERT ON signature_chain
+    FOR EACH ROW
+    EXECUTE FUNCTION normalize_block_document();
+
+-- Vista di lettura dei blocchi con l'hash del documento risolto. La LEFT JOIN
+-- viene eliminata dal planner quando la query non usa document_hash.
+-- chain_hash è calcolato al volo (non è usato dalla logica della catena).
+CREATE VIEW signature_chain_blocks WITH (security_invoker = true) AS
+SELECT sc.id,
+       sc.document_id,
+       sc.signer,
+       sc.signed_at,
+       coalesce(sc.document_hash, d.hash) AS document_hash,
+       sc.prev_hash,
+       encode(digest(coalesce(sc.prev_hash, '') || coalesce(sc.document_hash, d.hash), 'sha256'), 'hex') AS chain_hash,
+       sc.signature,
+       sc.key_id,
+       sc.document_ref
+FROM signature_chain sc
+LEFT JOIN documents d ON d.id = sc.document_ref;
+
+GRANT SELECT ON signature_chain_blocks TO app_user;
+
+CREATE OR REPLACE FUNCTION append_block(
+    p_document_id UUID,
+    p_signer TEXT,
+    p_document_hash TEXT,
+    p_expected_prev TEXT,
+    p_signature TEXT,
+    p_key_id TEXT DEFAULT NULL,
+    OUT block_id INTEGER,
+    OUT current_head TEXT
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- 15 caratteri esadecimali (60 bit) dello SHA256 del document_id, come in Python.
+    PERFORM pg_advisory_xact_lock(
+        ('x' || lpad(substr(encode(digest(p_document_id::text, 'sha256'), 'hex'), 1, 15), 16, '0'))::bit(64)::bigint);
+
+    SELECT sc.signature INTO current_head
+    FROM signature_chain sc
+    WHERE sc.document_id = p_document_id
+    ORDER BY sc.id DESC
+    LIMIT 1;
+
+    IF current_head IS DISTINCT FROM p_expected_prev THEN
+        block_id := NULL;
+        RETURN;
+    END IF;
+
+    INSERT INTO signature_chain (document_id, signer, document_ref, prev_hash, signature, key_id)
+    VALUES (p_document_id, p_signer, document_ref(p_document_hash), p_expected_prev, p_signature, p_key_id)
+    RETURNING id INTO block_id;
+
+    current_head := p_signature;
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION append_block(UUID, TEXT, TEXT, TEXT, TEXT, TEXT) TO app_user;
+
+CREATE OR REPLACE FUNCTION chain_segment_digest(
+    p_first_id INTEGER,
+    p_last_id INTEGER,
+    OUT block_count INTEGER,
+    OUT segment_hash TEXT
+)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT count(*)::integer,
+           encode(digest(coalesce(string_agg(
+               sc.id::text || '|' || sc.document_id::text || '|' || sc.signer || '|' ||
+               sc.document_hash || '|' || coalesce(sc.prev_hash, '') || '|' || sc.signature || E'\n',
+               '' ORDER BY sc.id), ''), 'sha256'), 'hex')
+    FROM signature_chain_blocks sc
+    WHERE sc.id BETWEEN p_first_id AND p_last_id;
+$$;
+
+GRANT EXECUTE ON FUNCTION chain_segment_digest(INTEGER, INTEGER) TO app_user;
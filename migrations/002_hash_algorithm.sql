@@ -0,0 +1,106 @@
+-- Migrazione: algoritmo di hash dei documenti (documents.algorithm).
+-- I documenti già registrati sono SHA256. Da eseguire dopo 001_documents.sql,
+-- come proprietario delle tabelle, in una transazione:
+--   psql -v ON_ERROR_STOP=1 -1 -d signature_demo -f migrations/002_hash_algorithm.sql
+
+ALTER TABLE documents
+    ADD COLUMN algorithm TEXT NOT NULL DEFAULT 'sha256' CHECK (algorithm IN ('sha256', 'sha512_256', 'blake2b')),
+    DROP CONSTRAINT documents_hash_key,
+    ADD UNIQUE (hash, algorithm);
+
+DROP FUNCTION document_ref(TEXT, BIGINT);
+DROP FUNCTION append_block(UUID, TEXT, TEXT, TEXT, TEXT, TEXT);
+
+-- Restituisce l'ID del documento con l'hash indicato, registrandolo se non esiste.
+-- La dimensione, se nota, viene registrata alla prima occasione.
+CREATE OR REPLACE FUNCTION document_ref(p_hash TEXT, p_size BIGINT DEFAULT NULL, p_algorithm TEXT DEFAULT 'sha256')
+RETURNS BIGINT
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+    ref BIGINT;
+    known_size BIGINT;
+BEGIN
+    SELECT id, size INTO ref, known_size FROM documents WHERE hash = p_hash AND algorithm = p_algorithm;
+    IF ref IS NULL THEN
+        INSERT INTO documents (hash, size, algorithm) VALUES (p_hash, p_size, p_algorithm)
+        ON CONFLICT (hash, algorithm) DO NOTHING
+        RETURNING id INTO ref;
+        IF ref IS NULL THEN
+            -- Registrato da una transazione concorrente.
+            SELECT id, size INTO ref, known_size FROM documents WHERE hash = p_hash AND algorithm = p_algorithm;
+        ELSE
+            RETURN ref;
+        END IF;
+    END IF;
+    IF known_size IS NULL AND p_size IS NOT NULL THEN
+        UPDATE documents SET size = p_size WHERE id = ref AND size IS NULL;
+    END IF;
+    RETURN ref;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION document_ref(TEXT, BIGINT, TEXT) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION document_ref(TEXT, BIGINT, TEXT) TO app_user;
+
+-- Vista di lettura dei blocchi con l'hash del documento risolto. La LEFT JOIN
+-- viene eliminata dal planner quando la query non usa document_hash.
+-- chain_hash è calcolato al volo (non è usato dalla logica della catena).
+-- I blocchi con document_hash in linea (precedenti a documents) usano SHA256.
+CREATE OR REPLACE VIEW signature_chain_blocks WITH (security_invoker = true) AS
+SELECT sc.id,
+       sc.document_id,
+       sc.signer,
+       sc.signed_at,
+       coalesce(sc.document_hash, d.hash) AS document_hash,
+       sc.prev_hash,
+       encode(digest(coalesce(sc.prev_hash, '') || coalesce(sc.document_hash, d.hash), 'sha256'), 'hex') AS chain_hash,
+       sc.signature,
+       sc.key_id,
+       sc.document_ref,
+       coalesce(d.algorithm, 'sha256') AS hash_algorithm
+FROM signature_chain sc
+LEFT JOIN documents d ON d.id = sc.document_ref;
+
+GRANT SELECT ON signature_chain_blocks TO app_user;
+
+CREATE OR REPLACE FUNCTION append_block(
+    p_document_id UUID,
+    p_signer TEXT,
+    p_document_hash TEXT,
+    p_expected_prev TEXT,
+    p_signature TEXT,
+    p_key_id TEXT DEFAULT NULL,
+    p_hash_algorithm TEXT DEFAULT 'sha256',
+    OUT block_id INTEGER,
+    OUT current_head TEXT
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- 15 caratteri esadecimali (60 bit) dello SHA256 del document_id, come in Python.
+    PERFORM pg_advisory_xact_lock(
+        ('x' || lpad(substr(encode(digest(p_document_id::text, 'sha256'), 'hex'), 1, 15), 16, '0'))::bit(64)::bigint);
+
+    SELECT sc.signature INTO current_head
+    FROM signature_chain sc
+    WHERE sc.document_id = p_document_id
+    ORDER BY sc.id DESC
+    LIMIT 1;
+
+    IF current_head IS DISTINCT FROM p_expected_prev THEN
+        block_id := NULL;
+        RETURN;
+    END IF;
+
+    INSERT INTO signature_chain (document_id, signer, document_ref, prev_hash, signature, key_id)
+    VALUES (p_document_id, p_signer, document_ref(p_document_hash, NULL, p_hash_algorithm), p_expected_prev, p_signature, p_key_id)
+    RETURNING id INTO block_id;
+
+    current_head := p_signature;
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION append_block(UUID, TEXT, TEXT, TEXT, TEXT, TEXT, TEXT) TO app_user;
@@ -0,0 +1,71 @@
+-- Migrazione: request_id dei blocchi per gli append idempotenti.
+-- Da eseguire dopo 002_hash_algorithm.sql, come proprietario delle tabelle:
+--   psql -v ON_ERROR_STOP=1 -1 -d signature_demo -f migrations/003_request_id.sql
+-- Su tabelle grandi conviene aggiungere la colonna e poi creare l'indice fuori
+-- transazione con CREATE UNIQUE INDEX CONCURRENTLY (stessa definizione): l'IF
+-- NOT EXISTS qui sotto lo salta.
+
+ALTER TABLE signature_chain ADD COLUMN request_id TEXT CHECK (length(request_id) <= 128);
+
+CREATE UNIQUE INDEX IF NOT EXISTS signature_chain_request_id_idx ON signature_chain (document_id, request_id)
+    WHERE request_id IS NOT NULL;
+
+-- I parametri OUT cambiano: la funzione va ricreata.
+DROP FUNCTION append_block(UUID, TEXT, TEXT, TEXT, TEXT, TEXT, TEXT);
+
+-- Append della catena in un singolo round trip (vedi init.sql).
+-- Con p_request_id, se il documento ha già un blocco con lo stesso
+-- request_id (una richiesta ripetuta) non inserisce nulla e restituisce quel
+-- blocco e la sua firma, con replayed TRUE.
+CREATE OR REPLACE FUNCTION append_block(
+    p_document_id UUID,
+    p_signer TEXT,
+    p_document_hash TEXT,
+    p_expected_prev TEXT,
+    p_signature TEXT,
+    p_key_id TEXT DEFAULT NULL,
+    p_hash_algorithm TEXT DEFAULT 'sha256',
+    p_request_id TEXT DEFAULT NULL,
+    OUT block_id INTEGER,
+    OUT current_head TEXT,
+    OUT replayed BOOLEAN
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- 15 caratteri esadecimali (60 bit) dello SHA256 del document_id, come in Python.
+    PERFORM pg_advisory_xact_lock(
+        ('x' || lpad(substr(encode(digest(p_document_id::text, 'sha256'), 'hex'), 1, 15), 16, '0'))::bit(64)::bigint);
+
+    replayed := FALSE;
+    IF p_request_id IS NOT NULL THEN
+        SELECT sc.id, sc.signature INTO block_id, current_head
+        FROM signature_chain sc
+        WHERE sc.document_id = p_document_id AND sc.request_id = p_request_id;
+        IF FOUND THEN
+            replayed := TRUE;
+            RETURN;
+        END IF;
+    END IF;
+
+    SELECT sc.signature INTO current_head
+    FROM signature_chain sc
+    WHERE sc.document_id = p_document_id
+    ORDER BY sc.id DESC
+    LIMIT 1;
+
+    IF current_head IS DISTINCT FROM p_expected_prev THEN
+        block_id := NULL;
+        RETURN;
+    END IF;
+
+    INSERT INTO signature_chain (document_id, signer, document_ref, prev_hash, signature, key_id, request_id)
+    VALUES (p_document_id, p_signer, document_ref(p_document_hash, NULL, p_hash_algorithm), p_expected_prev, p_signature,
+            p_key_id, p_request_id)
+    RETURNING id INTO block_id;
+
+    current_head := p_signature;
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION append_block(UUID, TEXT, TEXT, TEXT, TEXT, TEXT, TEXT, TEXT) TO app_user;
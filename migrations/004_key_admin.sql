@@ -0,0 +1,30 @@
+-- Migrazione: registrazione delle chiavi riservata al ruolo key_admin.
+-- app_user legge signer_keys ma non vi inserisce più chiavi: chi ne ha le
+-- credenziali non può registrare una chiave a nome di un altro firmatario.
+-- Da eseguire come proprietario delle tabelle, in una transazione:
+--   psql -v ON_ERROR_STOP=1 -1 -d signature_demo -f migrations/004_key_admin.sql
+-- Dopo la migrazione va cambiata la password di key_admin.
+
+DO
+$do$
+BEGIN
+   IF NOT EXISTS (
+      SELECT FROM pg_catalog.pg_roles
+      WHERE  rolname = 'key_admin') THEN
+
+      CREATE ROLE key_admin WITH LOGIN PASSWORD 'key_admin_password';
+   END IF;
+END
+$do$;
+
+GRANT CONNECT ON DATABASE signature_demo TO key_admin;
+GRANT USAGE ON SCHEMA public TO key_admin;
+
+REVOKE INSERT ON signer_keys FROM app_user;
+GRANT SELECT, INSERT, UPDATE (valid_from, valid_to) ON signer_keys TO key_admin;
+GRANT SELECT ON signature_chain TO key_admin;
+
+-- Le chiavi registrate da app_user prima della migrazione vanno controllate:
+--   SELECT key_id, signer, fingerprint, valid_from FROM signer_keys ORDER BY valid_from;
+-- Quelle registrate dopo i blocchi che hanno firmato senza key_id vanno
+-- retrodatate con key_registry.backfill_valid_from.
@@ -0,0 +1,25 @@
+-- Migrazione: ruolo dedicato al job di archiviazione (archive.py).
+-- Il job non gira più come superutente: archiver scavalca la RLS (BYPASSRLS)
+-- per cancellare i blocchi archiviati, ma sulle tabelle ha solo i privilegi
+-- concessi qui. Da eseguire come superutente, in una transazione:
+--   psql -v ON_ERROR_STOP=1 -1 -d signature_demo -f migrations/005_archiver.sql
+-- Dopo la migrazione va cambiata la password di archiver.
+
+DO
+$do$
+BEGIN
+   IF NOT EXISTS (
+      SELECT FROM pg_catalog.pg_roles
+      WHERE  rolname = 'archiver') THEN
+
+      CREATE ROLE archiver WITH LOGIN BYPASSRLS PASSWORD 'archiver_password';
+   END IF;
+END
+$do$;
+
+GRANT CONNECT ON DATABASE signature_demo TO archiver;
+GRANT USAGE ON SCHEMA public TO archiver;
+
+GRANT SELECT, INSERT ON archived_segments TO archiver;
+GRANT SELECT, DELETE ON signature_chain TO archiver;
+GRANT SELECT ON signature_chain_blocks, documents, chain_checkpoints, signer_keys TO archiver;
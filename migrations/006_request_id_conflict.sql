@@ -0,0 +1,70 @@
+-- Migrazione: append_block rifiuta i request_id riusati per una richiesta diversa.
+-- Una richiesta ripetuta restituisce il blocco già inserito solo se firmatario,
+-- hash del documento e algoritmo coincidono; altrimenti la funzione fallisce
+-- con unique_violation (SQLSTATE 23505). Da eseguire dopo 003_request_id.sql,
+-- come proprietario delle tabelle:
+--   psql -v ON_ERROR_STOP=1 -1 -d signature_demo -f migrations/006_request_id_conflict.sql
+
+-- Append della catena in un singolo round trip (vedi init.sql).
+CREATE OR REPLACE FUNCTION append_block(
+    p_document_id UUID,
+    p_signer TEXT,
+    p_document_hash TEXT,
+    p_expected_prev TEXT,
+    p_signature TEXT,
+    p_key_id TEXT DEFAULT NULL,
+    p_hash_algorithm TEXT DEFAULT 'sha256',
+    p_request_id TEXT DEFAULT NULL,
+    OUT block_id INTEGER,
+    OUT current_head TEXT,
+    OUT replayed BOOLEAN
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_signer TEXT;
+    v_document_hash TEXT;
+    v_hash_algorithm TEXT;
+BEGIN
+    -- 15 caratteri esadecimali (60 bit) dello SHA256 del document_id, come in Python.
+    PERFORM pg_advisory_xact_lock(
+        ('x' || lpad(substr(encode(digest(p_document_id::text, 'sha256'), 'hex'), 1, 15), 16, '0'))::bit(64)::bigint);
+
+    replayed := FALSE;
+    IF p_request_id IS NOT NULL THEN
+        SELECT sc.id, sc.signature, sc.signer, coalesce(sc.document_hash, d.hash), coalesce(d.algorithm, 'sha256')
+        INTO block_id, current_head, v_signer, v_document_hash, v_hash_algorithm
+        FROM signature_chain sc
+        LEFT JOIN documents d ON d.id = sc.document_ref
+        WHERE sc.document_id = p_document_id AND sc.request_id = p_request_id;
+        IF FOUND THEN
+            IF (v_signer, v_document_hash, v_hash_algorithm)
+                    IS DISTINCT FROM (p_signer, p_document_hash, p_hash_algorithm) THEN
+                RAISE EXCEPTION 'request_id % già usato sul documento % per una richiesta diversa (blocco ID %)',
+                    p_request_id, p_document_id, block_id
+                    USING ERRCODE = 'unique_violation';
+            END IF;
+            replayed := TRUE;
+            RETURN;
+        END IF;
+    END IF;
+
+    SELECT sc.signature INTO current_head
+    FROM signature_chain sc
+    WHERE sc.document_id = p_document_id
+    ORDER BY sc.id DESC
+    LIMIT 1;
+
+    IF current_head IS DISTINCT FROM p_expected_prev THEN
+        block_id := NULL;
+        RETURN;
+    END IF;
+
+    INSERT INTO signature_chain (document_id, signer, document_ref, prev_hash, signature, key_id, request_id)
+    VALUES (p_document_id, p_signer, document_ref(p_document_hash, NULL, p_hash_algorithm), p_expected_prev, p_signature,
+            p_key_id, p_request_id)
+    RETURNING id INTO block_id;
+
+    current_head := p_signature;
+END;
+$$;
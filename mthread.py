@@ -1,14 +1,22 @@
-import hashlib
+from contextlib import nullcontext
+
 import psycopg2
 from uuid import uuid4
 from datetime import datetime
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import padding, rsa
 import os
 import threading
 import time
 import random
 
+from admission import AdmissionController, AdmissionRejected
+from metrics import (DB_CONNECT_SECONDS, HASH_SECONDS,
+                     SIGN_SECONDS, cursor_factory, instrumented, timed)
+from prepared_statements import HEAD_BY_DOCUMENT, HEAD_BY_DOCUMENT_FOR_UPDATE, INSERT_BLOCK, execute_prepared
+from db_config import audit_connection
+from profiling import configure_from_argv, profiled
+from signature_chain import core
+from signature_chain.hash_cache import document_hash_cache
+
 # --- Variabili di Connessione al DB (da ENV o default) ---
 db_name = os.environ.get("DB_NAME", "signature_demo")
 # Usiamo l'utente 'postgres' per questa simulazione per avere pieni poteri
@@ -28,19 +36,10 @@ def generate_keys_for_simulation():
                - pem_private (bytes): La chiave privata in formato PEM.
                - pem_public (bytes): La chiave pubblica in formato PEM.
     """
-    private_key = rsa.generate_private_key(
-        public_exponent=65537, key_size=2048)
-    pem_private = private_key.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.PKCS8,
-        encryption_algorithm=serialization.NoEncryption())
-    public_key = private_key.public_key()
-    pem_public = public_key.public_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo)
-    return pem_private, pem_public
+    return core.generate_keys()
 
 
+@instrumented(SIGN_SECONDS)
 def sign_data_for_simulation(private_key_pem: bytes, data_to_sign: bytes) -> str:
     """
     Firma i dati forniti utilizzando una chiave privata RSA PEM.
@@ -52,26 +51,24 @@ def sign_data_for_simulation(private_key_pem: bytes, data_to_sign: bytes) -> str
     Returns:
         str: La firma esadecimale dei dati.
     """
-    private_key = serialization.load_pem_private_key(
-        private_key_pem, password=None)
-    signature_bytes = private_key.sign(
-        data_to_sign,
-        padding.PKCS1v15(),
-        hashes.SHA256())
-    return signature_bytes.hex()
+    return core.sign_data(data_to_sign, private_key_pem)
 
 
-def get_document_hash(document_content: str) -> str:
+@instrumented(HASH_SECONDS)
+def get_document_hash(document_content: str, algorithm: str = core.DEFAULT_HASH_ALGORITHM) -> str:
     """
-    Calcola l'hash SHA256 del contenuto di un documento.
+    Calcola l'hash del contenuto di un documento; i thread che firmano lo
+    stesso contenuto lo calcolano una sola volta (vedi `signature_chain.hash_cache`).
 
     Args:
         document_content (str): Il contenuto del documento.
+        algorithm (str, optional): L'algoritmo di hash (vedi `core.HASH_ALGORITHMS`).
+                                   Defaults to "sha256".
 
     Returns:
-        str: L'hash SHA256 esadecimale del contenuto.
+        str: L'hash esadecimale del contenuto.
     """
-    return hashlib.sha256(document_content.encode()).hexdigest()
+    return document_hash_cache.hash_document(document_content, algorithm)
 
 
 def clear_table(conn) -> None:
@@ -99,14 +96,13 @@ def get_last_signature_for_doc(conn, document_id_param: str) -> str | None:
         str | None: L'ultima firma se trovata, altrimenti None.
     """
     with conn.cursor() as cursor:
-        cursor.execute(
-            "SELECT signature FROM signature_chain WHERE document_id = %s ORDER BY id DESC LIMIT 1",
-            (document_id_param,))
+        execute_prepared(cursor, HEAD_BY_DOCUMENT, (document_id_param,))
         result = cursor.fetchone()
         return result[0] if result else None
 
 
-def insert_genesis_block(conn, document_id_param: str, signer_name: str, doc_hash: str, signature_param: str) -> int:
+def insert_genesis_block(conn, document_id_param: str, signer_name: str, doc_hash: str, signature_param: str,
+                         hash_algorithm: str = core.DEFAULT_HASH_ALGORITHM) -> int:
     """
     Inserisce il blocco genesi (il primo blocco) per una nuova catena di firme.
 
@@ -116,18 +112,14 @@ def insert_genesis_block(conn, document_id_param: str, signer_name: str, doc_has
         signer_name (str): Il nome del firmatario del blocco genesi.
         doc_hash (str): L'hash del documento originale.
         signature_param (str): La firma del blocco genesi (basata solo sul doc_hash).
+        hash_algorithm (str, optional): L'algoritmo con cui è stato calcolato doc_hash. Defaults to "sha256".
 
     Returns:
         int: L'ID del blocco genesi inserito.
     """
     with conn.cursor() as cursor:
-        cursor.execute(
-            """
-            INSERT INTO signature_chain (document_id, signer, document_hash, prev_hash, signature)
-            VALUES (%s, %s, %s, %s, %s) RETURNING id;
-            """,
-            (document_id_param, signer_name, doc_hash, None, signature_param)
-        )
+        execute_prepared(
+            cursor, INSERT_BLOCK, (document_id_param, signer_name, doc_hash, None, signature_param, hash_algorithm))
         block_id = cursor.fetchone()[0]
     conn.commit()
     print(
@@ -135,12 +127,16 @@ def insert_genesis_block(conn, document_id_param: str, signer_name: str, doc_has
     return block_id
 
 
+@profiled("mthread.concurrent_insert_signature")
 def concurrent_insert_signature(
         document_id_param: str,
         signer_name: str,
         document_content: str,
         private_key_pem: bytes,
-        thread_name: str) -> None:
+        thread_name: str,
+        signing_pool=None,
+        hash_algorithm: str = core.DEFAULT_HASH_ALGORITHM,
+        admission: AdmissionController | None = None) -> None:
     """
     Simula l'inserimento concorrente di una firma nella catena.
     Questa funzione è progettata per essere eseguita in un thread separato.
@@ -155,52 +151,60 @@ def concurrent_insert_signature(
         document_content (str): Il contenuto del documento (usato per l'hash).
         private_key_pem (bytes): La chiave privata PEM del firmatario.
         thread_name (str): Un nome identificativo per il thread (per il logging).
+        signing_pool (SigningPool | None, optional): Pool di processi con cui firmare invece
+                                                     che nel thread corrente; deve contenere la
+                                                     chiave di `signer_name`. Defaults to None.
+        hash_algorithm (str, optional): L'algoritmo di hash del documento, registrato in
+                                        documents.algorithm. Defaults to "sha256".
+        admission (AdmissionController | None, optional): Controllo di ammissione da superare
+                                                          prima di aprire la connessione.
+                                                          Defaults to None (nessun limite).
     """
     conn_thread = None
     try:
-        conn_thread = psycopg2.connect(
-            dbname=db_name, user=db_user, password=db_password, host=db_host)
-        conn_thread.autocommit = False  # Controllo manuale della transazione
-
-        doc_hash = get_document_hash(document_content)
-
-        # 1. Leggi l'ultimo prev_hash (PUNTO CRITICO)
-        # In una transazione per coerenza, con SELECT ... FOR UPDATE per tentare di serializzare.
-        with conn_thread.cursor()as cur_select:
-            cur_select.execute(
-                "SELECT signature FROM signature_chain WHERE document_id = %s ORDER BY id DESC LIMIT 1 FOR UPDATE",
-                (document_id_param,)
-            )
-            result = cur_select.fetchone()
-            prev_hash = result[0] if result else None
-
-        print(
-            f"[{thread_name}] Letto prev_hash: {prev_hash[:10] if prev_hash else 'NULL'} per {signer_name}")
-
-        # 2. Simula elaborazione / ritardo di rete
-        # Questo ritardo aumenta la finestra temporale per la race condition.
-        time.sleep(random.uniform(0.2, 0.8))  # Ritardo casuale
-
-        # 3. Crea la firma
-        data_to_sign = (prev_hash or '').encode() + doc_hash.encode()
-        current_signature = sign_data_for_simulation(
-            private_key_pem, data_to_sign)
-
-        # 4. Inserisci il nuovo blocco (PUNTO CRITICO)
-        with conn_thread.cursor() as cur_insert:
-            cur_insert.execute(
-                """
-                INSERT INTO signature_chain (document_id, signer, document_hash, prev_hash, signature)
-                VALUES (%s, %s, %s, %s, %s) RETURNING id;
-                """,
-                (document_id_param, signer_name,
-                 doc_hash, prev_hash, current_signature)
-            )
-            block_id = cur_insert.fetchone()[0]
-        # Commit della transazione che include il SELECT FOR UPDATE e l'INSERT
-        conn_thread.commit()
-        print(f"[{thread_name}] {signer_name} ha inserito il blocco ID: {block_id} con prev_hash: {prev_hash[:10] if prev_hash else 'NULL'}, Signature: {current_signature[:10]}...")
+        with admission.admit(document_id_param) if admission is not None else nullcontext():
+            with timed(DB_CONNECT_SECONDS):
+                conn_thread = psycopg2.connect(
+                    dbname=db_name, user=db_user, password=db_password, host=db_host,
+                    cursor_factory=cursor_factory())
+            conn_thread.autocommit = False  # Controllo manuale della transazione
+
+            doc_hash = get_document_hash(document_content, hash_algorithm)
+
+            # 1. Leggi l'ultimo prev_hash (PUNTO CRITICO)
+            # In una transazione per coerenza, con SELECT ... FOR UPDATE per tentare di serializzare.
+            with conn_thread.cursor()as cur_select:
+                execute_prepared(cur_select, HEAD_BY_DOCUMENT_FOR_UPDATE, (document_id_param,))
+                result = cur_select.fetchone()
+                prev_hash = result[0] if result else None
 
+            print(
+                f"[{thread_name}] Letto prev_hash: {prev_hash[:10] if prev_hash else 'NULL'} per {signer_name}")
+
+            # 2. Simula elaborazione / ritardo di rete
+            # Questo ritardo aumenta la finestra temporale per la race condition.
+            time.sleep(random.uniform(0.2, 0.8))  # Ritardo casuale
+
+            # 3. Crea la firma
+            data_to_sign = (prev_hash or '').encode() + doc_hash.encode()
+            if signing_pool is not None:
+                current_signature = signing_pool.sign(data_to_sign, signer_name)
+            else:
+                current_signature = sign_data_for_simulation(
+                    private_key_pem, data_to_sign)
+
+            # 4. Inserisci il nuovo blocco (PUNTO CRITICO)
+            with conn_thread.cursor() as cur_insert:
+                execute_prepared(
+                    cur_insert, INSERT_BLOCK,
+                    (document_id_param, signer_name, doc_hash, prev_hash, current_signature, hash_algorithm))
+                block_id = cur_insert.fetchone()[0]
+            # Commit della transazione che include il SELECT FOR UPDATE e l'INSERT
+            conn_thread.commit()
+            print(f"[{thread_name}] {signer_name} ha inserito il blocco ID: {block_id} con prev_hash: {prev_hash[:10] if prev_hash else 'NULL'}, Signature: {current_signature[:10]}...")
+
+    except AdmissionRejected as error:
+        print(f"[{thread_name}] Append di {signer_name} respinto dal controllo di ammissione: {error}")
     except (Exception, psycopg2.Error) as error:
         print(f"[{thread_name}] Errore per {signer_name}: {error}")
         if conn_thread:
@@ -210,7 +214,8 @@ def concurrent_insert_signature(
             conn_thread.close()
 
 
-def check_for_forks(conn, document_id_param: str) -> None:
+@profiled("mthread.check_for_forks")
+def check_for_forks(conn, document_id_param: str, max_block_id: int | None = None) -> None:
     """
     Controlla la presenza di biforcazioni (forks) nella catena di firme
     per un dato document_id. Una biforcazione si verifica se più blocchi
@@ -219,6 +224,9 @@ def check_for_forks(conn, document_id_param: str) -> None:
     Args:
         conn: Connessione attiva al database psycopg2.
         document_id_param (str): L'ID del documento da controllare.
+        max_block_id (int | None, optional): Considera solo i blocchi con ID non superiore,
+                                             ad esempio il watermark di un audit su replica.
+                                             Defaults to None (tutti i blocchi).
     """
     print(
         f"\n--- Controllo Biforcazioni per Documento ID: {document_id_param} ---")
@@ -227,11 +235,11 @@ def check_for_forks(conn, document_id_param: str) -> None:
             """
             SELECT prev_hash, COUNT(*) as count
             FROM signature_chain
-            WHERE document_id = %s AND prev_hash IS NOT NULL
+            WHERE document_id = %s AND prev_hash IS NOT NULL AND (%s IS NULL OR id <= %s)
             GROUP BY prev_hash
             HAVING COUNT(*) > 1;
             """,
-            (document_id_param,)
+            (document_id_param, max_block_id, max_block_id)
         )
         forks = cursor.fetchall()
         if forks:
@@ -242,7 +250,9 @@ def check_for_forks(conn, document_id_param: str) -> None:
             print("Nessuna biforcazione rilevata (prev_hash duplicati non trovati).")
 
         cursor.execute(
-            "SELECT id, signer, prev_hash, signature FROM signature_chain WHERE document_id = %s ORDER BY id", (document_id_param,))
+            "SELECT id, signer, prev_hash, signature FROM signature_chain "
+            "WHERE document_id = %s AND (%s IS NULL OR id <= %s) ORDER BY id",
+            (document_id_param, max_block_id, max_block_id))
         print("\nStato finale della catena:")
         for row in cursor.fetchall():
             print(
@@ -250,15 +260,22 @@ def check_for_forks(conn, document_id_param: str) -> None:
 
 
 if __name__ == "__main__":
+    # --profile, --profile-dir DIR, --profile-perf (vedi profiling.py)
+    configure_from_argv()
+
     main_conn = None
     try:
-        main_conn = psycopg2.connect(
-            dbname=db_name, user=db_user, password=db_password, host=db_host)
+        with timed(DB_CONNECT_SECONDS):
+            main_conn = psycopg2.connect(
+                dbname=db_name, user=db_user, password=db_password, host=db_host,
+                cursor_factory=cursor_factory())
         clear_table(main_conn)
 
         doc_id = str(uuid4())
         document_content_main = "Contenuto del documento per test di concorrenza."
-        doc_hash_main = get_document_hash(document_content_main)
+        # DOCUMENT_HASH_ALGORITHM sceglie l'algoritmo di hash della catena (default sha256).
+        hash_algorithm = os.environ.get("DOCUMENT_HASH_ALGORITHM", core.DEFAULT_HASH_ALGORITHM)
+        doc_hash_main = get_document_hash(document_content_main, hash_algorithm)
 
         # Firmatario Genesi
         # Ignoriamo la chiave pubblica qui
@@ -266,7 +283,12 @@ if __name__ == "__main__":
         genesis_signature = sign_data_for_simulation(
             priv_key_gen, doc_hash_main.encode())  # prev_hash è '' per il genesi
         insert_genesis_block(
-            main_conn, doc_id, "FirmatarioGenesi", doc_hash_main, genesis_signature)
+            main_conn, doc_id, "FirmatarioGenesi", doc_hash_main, genesis_signature,
+            hash_algorithm)
+
+        # ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_PER_DOCUMENT, ADMISSION_MAX_QUEUE e
+        # ADMISSION_MAX_WAIT_SECONDS limitano gli append concorrenti (vedi admission.py).
+        admission = AdmissionController.from_env()
 
         print("\nAvvio inserimenti concorrenti...")
 
@@ -278,12 +300,14 @@ if __name__ == "__main__":
         thread1 = threading.Thread(
             target=concurrent_insert_signature,
             args=(doc_id, "FirmatarioA", document_content_main,
-                  priv_key_A, "Thread-1")
+                  priv_key_A, "Thread-1"),
+            kwargs={"hash_algorithm": hash_algorithm, "admission": admission}
         )
         thread2 = threading.Thread(
             target=concurrent_insert_signature,
             args=(doc_id, "FirmatarioB", document_content_main,
-                  priv_key_B, "Thread-2")
+                  priv_key_B, "Thread-2"),
+            kwargs={"hash_algorithm": hash_algorithm, "admission": admission}
         )
 
         # Avvio dei thread
@@ -295,7 +319,13 @@ if __name__ == "__main__":
         thread2.join()
 
         print("\nInserimenti concorrenti completati.")
-        check_for_forks(main_conn, doc_id)
+        admission_stats = admission.snapshot()
+        print(f"  Ammissione: {admission_stats['admitted']} ammessi, {admission_stats['queue_full']} respinti per coda "
+              f"piena, {admission_stats['timeout']} per attesa scaduta.")
+        # Controllo sulla replica, se DB_READER_DSN è impostato (vedi db_config.py).
+        with audit_connection(dbname=db_name, user=db_user, password=db_password, host=db_host) \
+                as (audit_conn, watermark):
+            check_for_forks(audit_conn, doc_id, watermark.max_block_id)
 
     except (Exception, psycopg2.Error) as error:
         print(f"Errore nello script principale: {error}")
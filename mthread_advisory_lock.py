@@ -1,13 +1,25 @@
-import hashlib
+from contextlib import nullcontext
+from dataclasses import dataclass
 import psycopg2
+import psycopg2.errors
 from uuid import uuid4
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import padding, rsa
 import os
 import threading
 import time
 import random
 
+from admission import AdmissionController, AdmissionRejected
+from metrics import (DB_CONNECT_SECONDS, ENABLED as METRICS_ENABLED, HASH_SECONDS, LOCK_ACQUISITIONS_TOTAL,
+                     LOCK_WAIT_SECONDS, REGISTRY, SIGN_SECONDS, cursor_factory, instrumented, timed)
+from idempotency import RequestIdConflict, check_replay, new_request_id, recent_requests
+from prepared_statements import (BLOCK_BY_REQUEST, HEAD_BY_DOCUMENT, INSERT_BLOCK, INSERT_BLOCK_WITH_REQUEST,
+                                 execute_prepared)
+from db_config import audit_connection
+from profiling import configure_from_argv, profiled
+from signature_chain import core
+from signature_chain.hash_cache import document_hash_cache
+from signing_pool import SigningPool
+
 # --- Variabili di Connessione al DB (da ENV o default) ---
 db_name = os.environ.get("DB_NAME", "signature_demo")
 db_user = os.environ.get("SUPER_DB_USER", "postgres")
@@ -22,18 +34,12 @@ def generate_keys_for_simulation():
     Returns:
         tuple: Una tupla contenente:
                - pem_private (bytes): La chiave privata in formato PEM.
-               - pem_public (bytes | None): La chiave pubblica in formato PEM, o None se non generata.
-                                           In questa versione, la chiave pubblica non è usata e si restituisce None.
+               - pem_public (bytes): La chiave pubblica in formato PEM.
     """
-    private_key = rsa.generate_private_key(
-        public_exponent=65537, key_size=2048)
-    pem_private = private_key.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.PKCS8,
-        encryption_algorithm=serialization.NoEncryption())
-    return pem_private, None
+    return core.generate_keys()
 
 
+@instrumented(SIGN_SECONDS)
 def sign_data_for_simulation(private_key_pem: bytes, data_to_sign: bytes) -> str:
     """
     Firma i dati forniti utilizzando una chiave privata RSA PEM.
@@ -45,35 +51,30 @@ def sign_data_for_simulation(private_key_pem: bytes, data_to_sign: bytes) -> str
     Returns:
         str: La firma esadecimale dei dati.
     """
-    private_key = serialization.load_pem_private_key(
-        private_key_pem, password=None)
-    signature_bytes = private_key.sign(
-        data_to_sign,
-        padding.PKCS1v15(),
-        hashes.SHA256())
-    return signature_bytes.hex()
+    return core.sign_data(data_to_sign, private_key_pem)
 
 
-def get_document_hash(document_content: str) -> str:
+@instrumented(HASH_SECONDS)
+def get_document_hash(document_content: str, algorithm: str = core.DEFAULT_HASH_ALGORITHM) -> str:
     """
-    Calcola l'hash SHA256 del contenuto di un documento.
+    Calcola l'hash del contenuto di un documento; i thread che firmano lo
+    stesso contenuto lo calcolano una sola volta (vedi `signature_chain.hash_cache`).
 
     Args:
         document_content (str): Il contenuto del documento.
+        algorithm (str, optional): L'algoritmo di hash (vedi `core.HASH_ALGORITHMS`).
+                                   Defaults to "sha256".
 
     Returns:
-        str: L'hash SHA256 esadecimale del contenuto.
+        str: L'hash esadecimale del contenuto.
     """
-    return hashlib.sha256(document_content.encode()).hexdigest()
+    return document_hash_cache.hash_document(document_content, algorithm)
 
 
 def generate_advisory_lock_key(document_id_str: str) -> int:
     """
-    Genera una chiave bigint (intero a 64 bit) per l'advisory lock di PostgreSQL
-    a partire dall'ID del documento.
-    Utilizza i primi 15 caratteri esadecimali dell'hash SHA256 del document_id
-    per creare un intero. Questo assicura una chiave univoca e deterministica
-    per un dato document_id, adatta per `pg_advisory_xact_lock(bigint)`.
+    Genera la chiave bigint dell'advisory lock di PostgreSQL per un documento
+    (vedi `signature_chain.core.generate_advisory_lock_key`).
 
     Args:
         document_id_str (str): L'ID del documento (stringa UUID).
@@ -81,10 +82,156 @@ def generate_advisory_lock_key(document_id_str: str) -> int:
     Returns:
         int: Una chiave intera a 64 bit per l'advisory lock.
     """
-    hasher = hashlib.sha256(document_id_str.encode('utf-8'))
-    # 15 caratteri esadecimali corrispondono a 60 bit,
-    # che rientrano comodamente in un bigint (64 bit).
-    return int(hasher.hexdigest()[:15], 16)
+    return core.generate_advisory_lock_key(document_id_str)
+
+
+LOCK_POLICIES = ("block", "try", "timeout")
+
+
+class LockBusyError(Exception):
+    """
+    L'advisory lock del documento non è stato acquisito entro l'attesa massima
+    della `LockPolicy`: il documento è conteso e la richiesta va respinta o
+    ritentata più tardi dal chiamante.
+    """
+
+    def __init__(self, lock_key: int, waited: float):
+        super().__init__(f"Advisory lock {lock_key} occupato: non acquisito in {waited:.3f} s.")
+        self.lock_key = lock_key
+        self.waited = waited
+
+
+@dataclass(frozen=True)
+class LockPolicy:
+    """
+    Politica di acquisizione dell'advisory lock di un documento.
+
+    Attributes:
+        mode (str): "block" attende senza limite (`pg_advisory_xact_lock`); "try" ritenta
+                    `pg_try_advisory_xact_lock` con attese casuali crescenti; "timeout"
+                    attende il lock lato server fino al `lock_timeout`.
+        max_wait (float): Attesa massima in secondi per "try" e "timeout".
+        retry_base (float): Attesa massima prima del secondo tentativo in modalità "try";
+                            raddoppia ad ogni tentativo.
+        retry_max (float): Limite dell'attesa tra due tentativi in modalità "try".
+    """
+    mode: str = "block"
+    max_wait: float = 2.0
+    retry_base: float = 0.005
+    retry_max: float = 0.1
+
+    def __post_init__(self):
+        if self.mode not in LOCK_POLICIES:
+            raise ValueError(f"Politica di lock sconosciuta '{self.mode}' (valori ammessi: {', '.join(LOCK_POLICIES)}).")
+
+    @classmethod
+    def from_env(cls) -> "LockPolicy":
+        """
+        Legge la politica da `LOCK_POLICY` (default "block") e `LOCK_MAX_WAIT_SECONDS` (default 2).
+        """
+        return cls(mode=os.environ.get("LOCK_POLICY", "block"),
+                   max_wait=float(os.environ.get("LOCK_MAX_WAIT_SECONDS", "2")))
+
+    @property
+    def bounded(self) -> bool:
+        return self.mode != "block"
+
+    def lock_timeout_sql(self) -> str:
+        return f"SET LOCAL lock_timeout = '{max(1, round(self.max_wait * 1000))}ms'"
+
+
+class LockTelemetry:
+    """
+    Statistiche di contesa per chiave di advisory lock: acquisizioni, rifiuti per
+    lock occupato, attesa totale e massima. Le chiavi più contese indicano i
+    documenti "caldi". Oltre `max_keys` chiavi vengono scartate le meno recenti.
+    """
+
+    def __init__(self, max_keys: int = 10_000):
+        self.max_keys = max_keys
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, lock_key: int, waited: float, acquired: bool, policy: str) -> None:
+        with self._lock:
+            stats = self._stats.pop(lock_key, None) or {"acquired": 0, "busy": 0, "wait_total": 0.0, "wait_max": 0.0}
+            stats["acquired" if acquired else "busy"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+            self._stats[lock_key] = stats
+            if len(self._stats) > self.max_keys:
+                del self._stats[next(iter(self._stats))]
+        if METRICS_ENABLED:
+            REGISTRY[LOCK_ACQUISITIONS_TOTAL].inc(labels=(policy, "acquired" if acquired else "busy"))
+
+    def snapshot(self, top: int = 10) -> list[dict]:
+        """
+        Restituisce le `top` chiavi con la maggiore attesa complessiva.
+        """
+        with self._lock:
+            items = [dict(stats, lock_key=lock_key) for lock_key, stats in self._stats.items()]
+        return sorted(items, key=lambda stats: (stats["wait_total"], stats["busy"]), reverse=True)[:top]
+
+
+lock_telemetry = LockTelemetry()
+
+
+def acquire_advisory_lock(cur, lock_key: int, policy: LockPolicy | None = None) -> float:
+    """
+    Acquisisce l'advisory lock transazionale `lock_key` secondo la politica indicata.
+
+    Args:
+        cur: Cursore psycopg2 in una transazione (autocommit disattivato).
+        lock_key (int): La chiave del lock (vedi `generate_advisory_lock_key`).
+        policy (LockPolicy | None, optional): La politica di acquisizione. Defaults a "block".
+
+    Returns:
+        float: I secondi di attesa.
+
+    Raises:
+        LockBusyError: Se il lock non viene acquisito entro `policy.max_wait`; con la politica
+                       "timeout" la transazione è annullata e va eseguito il rollback.
+    """
+    policy = policy or LockPolicy()
+    start = time.perf_counter()
+    try:
+        with timed(LOCK_WAIT_SECONDS):
+            if policy.mode == "block":
+                cur.execute("SELECT pg_advisory_xact_lock(%s);", (lock_key,))
+            elif policy.mode == "timeout":
+                # Il lock_timeout vale solo per l'acquisizione, poi torna al valore in vigore
+                # prima (anche se impostato con SET nella sessione: SET LOCAL ... TO DEFAULT
+                # tornerebbe al default del server o del ruolo). Un unico round trip.
+                cur.execute("SELECT set_config('signature_chain.saved_lock_timeout', "
+                            "current_setting('lock_timeout'), true); "
+                            f"{policy.lock_timeout_sql()}; SELECT pg_advisory_xact_lock(%s); "
+                            "SELECT set_config('lock_timeout', "
+                            "current_setting('signature_chain.saved_lock_timeout'), true);", (lock_key,))
+            else:
+                attempt = 0
+                while True:
+                    cur.execute("SELECT pg_try_advisory_xact_lock(%s);", (lock_key,))
+                    if cur.fetchone()[0]:
+                        break
+                    waited = time.perf_counter() - start
+                    if waited >= policy.max_wait:
+                        raise LockBusyError(lock_key, waited)
+                    # Attesa casuale tra 0 e un limite che raddoppia ad ogni tentativo
+                    # ("full jitter"), per non far ritentare i concorrenti all'unisono.
+                    backoff = min(policy.retry_max, policy.retry_base * 2 ** attempt)
+                    time.sleep(min(policy.max_wait - waited, random.uniform(0, backoff)))
+                    attempt += 1
+    except psycopg2.errors.LockNotAvailable as error:
+        waited = time.perf_counter() - start
+        lock_telemetry.record(lock_key, waited, False, policy.mode)
+        raise LockBusyError(lock_key, waited) from error
+    except LockBusyError as error:
+        lock_telemetry.record(lock_key, error.waited, False, policy.mode)
+        raise
+
+    waited = time.perf_counter() - start
+    lock_telemetry.record(lock_key, waited, True, policy.mode)
+    return waited
 
 
 def clear_table(conn) -> None:
@@ -100,7 +247,8 @@ def clear_table(conn) -> None:
     print("Tabella signature_chain pulita.")
 
 
-def insert_genesis_block(conn, document_id_param: str, signer_name: str, doc_hash: str, signature_param: str) -> int:
+def insert_genesis_block(conn, document_id_param: str, signer_name: str, doc_hash: str, signature_param: str,
+                         hash_algorithm: str = core.DEFAULT_HASH_ALGORITHM) -> int:
     """
     Inserisce il blocco genesi (il primo blocco) per una nuova catena di firme.
 
@@ -110,18 +258,14 @@ def insert_genesis_block(conn, document_id_param: str, signer_name: str, doc_has
         signer_name (str): Il nome del firmatario del blocco genesi.
         doc_hash (str): L'hash del documento originale.
         signature_param (str): La firma del blocco genesi (basata solo sul doc_hash).
+        hash_algorithm (str, optional): L'algoritmo con cui è stato calcolato doc_hash. Defaults to "sha256".
 
     Returns:
         int: L'ID del blocco genesi inserito.
     """
     with conn.cursor() as cursor:
-        cursor.execute(
-            """
-            INSERT INTO signature_chain (document_id, signer, document_hash, prev_hash, signature)
-            VALUES (%s, %s, %s, %s, %s) RETURNING id;
-            """,
-            (document_id_param, signer_name, doc_hash, None, signature_param)
-        )
+        execute_prepared(
+            cursor, INSERT_BLOCK, (document_id_param, signer_name, doc_hash, None, signature_param, hash_algorithm))
         block_id = cursor.fetchone()[0]
     conn.commit()
     print(
@@ -129,81 +273,141 @@ def insert_genesis_block(conn, document_id_param: str, signer_name: str, doc_has
     return block_id
 
 
+@profiled("mthread_advisory_lock.concurrent_insert_signature")
 def concurrent_insert_signature(
         document_id_param: str,
         signer_name: str,
         document_content: str,
         private_key_pem: bytes,
-        thread_name: str) -> None:
+        thread_name: str,
+        signing_pool=None,
+        hash_algorithm: str = core.DEFAULT_HASH_ALGORITHM,
+        lock_policy: LockPolicy | None = None,
+        admission: AdmissionController | None = None,
+        request_id: str | None = None) -> int | None:
     """
     Simula l'inserimento concorrente di una firma nella catena, utilizzando
     un advisory lock transazionale di PostgreSQL (`pg_advisory_xact_lock`)
     per serializzare le operazioni critiche.
     Questa funzione è progettata per essere eseguita in un thread separato.
 
+    Con `request_id` l'append è idempotente: ripetere la chiamata con lo stesso
+    request_id (ad esempio dopo un timeout sul COMMIT) restituisce il blocco già
+    inserito invece di aggiungerne un altro (vedi `idempotency.py`). Se il blocco
+    ha firmatario, hash o algoritmo diversi l'append viene rifiutato.
+
     Args:
         document_id_param (str): L'ID del documento a cui aggiungere la firma.
         signer_name (str): Il nome del firmatario.
         document_content (str): Il contenuto del documento (usato per l'hash).
         private_key_pem (bytes): La chiave privata PEM del firmatario.
         thread_name (str): Un nome identificativo per il thread (per il logging).
+        signing_pool (SigningPool | None, optional): Pool di processi con cui firmare invece
+                                                     che nel thread corrente; deve contenere la
+                                                     chiave di `signer_name`. Defaults to None.
+        hash_algorithm (str, optional): L'algoritmo di hash del documento, registrato in
+                                        documents.algorithm. Defaults to "sha256".
+        lock_policy (LockPolicy | None, optional): Politica di acquisizione del lock; con
+                                                   "try" o "timeout" un documento conteso oltre
+                                                   l'attesa massima viene rifiutato invece di
+                                                   bloccare la connessione. Defaults a "block".
+        admission (AdmissionController | None, optional): Controllo di ammissione da superare
+                                                          prima di aprire la connessione.
+                                                          Defaults to None (nessun limite).
+        request_id (str | None, optional): L'identificativo della richiesta, uguale per tutti i
+                                           suoi tentativi. Defaults to None (append non idempotente).
+
+    Returns:
+        int | None: L'ID del blocco inserito (o già inserito per `request_id`); None in caso di errore.
     """
     conn_thread = None
     advisory_lock_key = generate_advisory_lock_key(document_id_param)
+    doc_hash = get_document_hash(document_content, hash_algorithm)
 
     try:
-        conn_thread = psycopg2.connect(
-            dbname=db_name, user=db_user, password=db_password, host=db_host)
-        # Cruciale per pg_advisory_xact_lock: il lock dura per la transazione.
-        conn_thread.autocommit = False
-
-        doc_hash = get_document_hash(document_content)
-
-        with conn_thread.cursor() as cur:  # Un unico cursore per la transazione
-            # Acquisire l'Advisory Lock transazionale
-            print(
-                f"[{thread_name}] Tentativo di acquisire advisory lock {advisory_lock_key} per {signer_name} su doc {document_id_param}")
-            cur.execute("SELECT pg_advisory_xact_lock(%s);",
-                        (advisory_lock_key,))
-            print(
-                f"[{thread_name}] Acquisito advisory lock {advisory_lock_key} per {signer_name}")
-
-            # --- INIZIO SEZIONE CRITICA (protetta dall'advisory lock) ---
-            # 1. Leggi l'ultimo prev_hash
-            cur.execute(
-                "SELECT signature FROM signature_chain WHERE document_id = %s ORDER BY id DESC LIMIT 1",
-                (document_id_param,)
-            )
-            result = cur.fetchone()
-            prev_hash = result[0] if result else None
-            print(
-                f"[{thread_name}] Letto prev_hash: {prev_hash[:10] if prev_hash else 'NULL'} per {signer_name}")
-
-            # 2. Simula elaborazione / ritardo di rete
-            time.sleep(random.uniform(0.1, 0.3))
-
-            # 3. Crea la firma
-            data_to_sign = (prev_hash or '').encode() + doc_hash.encode()
-            current_signature = sign_data_for_simulation(
-                private_key_pem, data_to_sign)
-
-            # 4. Inserisci il nuovo blocco
-            cur.execute(
-                """
-                INSERT INTO signature_chain (document_id, signer, document_hash, prev_hash, signature)
-                VALUES (%s, %s, %s, %s, %s) RETURNING id;
-                """,
-                (document_id_param, signer_name,
-                 doc_hash, prev_hash, current_signature)
-            )
-            block_id = cur.fetchone()[0]
-            # --- FINE SEZIONE CRITICA ---
-
-            # Commit della transazione, rilascia automaticamente pg_advisory_xact_lock
-            conn_thread.commit()
-            print(
-                f"[{thread_name}] {signer_name} ha inserito il blocco ID: {block_id}. Commit e rilascio lock {advisory_lock_key}.")
-
+        if request_id is not None:
+            cached = recent_requests.get(document_id_param, request_id, signer_name, doc_hash, hash_algorithm)
+            if cached is not None:
+                print(f"[{thread_name}] Richiesta {request_id} già eseguita: blocco ID {cached[0]} (cache).")
+                return cached[0]
+
+        with admission.admit(document_id_param) if admission is not None else nullcontext():
+            with timed(DB_CONNECT_SECONDS):
+                conn_thread = psycopg2.connect(
+                    dbname=db_name, user=db_user, password=db_password, host=db_host,
+                    cursor_factory=cursor_factory())
+            # Cruciale per pg_advisory_xact_lock: il lock dura per la transazione.
+            conn_thread.autocommit = False
+
+            with conn_thread.cursor() as cur:  # Un unico cursore per la transazione
+                # Acquisire l'Advisory Lock transazionale
+                print(
+                    f"[{thread_name}] Tentativo di acquisire advisory lock {advisory_lock_key} per {signer_name} su doc {document_id_param}")
+                waited = acquire_advisory_lock(cur, advisory_lock_key, lock_policy)
+                print(
+                    f"[{thread_name}] Acquisito advisory lock {advisory_lock_key} per {signer_name} (attesa {waited * 1000:.1f} ms)")
+
+                # --- INIZIO SEZIONE CRITICA (protetta dall'advisory lock) ---
+                # 0. Una richiesta ripetuta trova il blocco già inserito
+                if request_id is not None:
+                    execute_prepared(cur, BLOCK_BY_REQUEST, (document_id_param, request_id))
+                    existing = cur.fetchone()
+                    if existing is not None:
+                        check_replay(document_id_param, request_id, existing, signer_name, doc_hash, hash_algorithm)
+                        conn_thread.commit()
+                        recent_requests.put(document_id_param, request_id, *existing)
+                        print(f"[{thread_name}] Richiesta {request_id} già eseguita: blocco ID {existing[0]}.")
+                        return existing[0]
+
+                # 1. Leggi l'ultimo prev_hash
+                execute_prepared(cur, HEAD_BY_DOCUMENT, (document_id_param,))
+                result = cur.fetchone()
+                prev_hash = result[0] if result else None
+                print(
+                    f"[{thread_name}] Letto prev_hash: {prev_hash[:10] if prev_hash else 'NULL'} per {signer_name}")
+
+                # 2. Simula elaborazione / ritardo di rete
+                time.sleep(random.uniform(0.1, 0.3))
+
+                # 3. Crea la firma
+                data_to_sign = (prev_hash or '').encode() + doc_hash.encode()
+                if signing_pool is not None:
+                    current_signature = signing_pool.sign(data_to_sign, signer_name)
+                else:
+                    current_signature = sign_data_for_simulation(
+                        private_key_pem, data_to_sign)
+
+                # 4. Inserisci il nuovo blocco
+                if request_id is not None:
+                    execute_prepared(
+                        cur, INSERT_BLOCK_WITH_REQUEST,
+                        (document_id_param, signer_name, doc_hash, prev_hash, current_signature, hash_algorithm,
+                         request_id))
+                else:
+                    execute_prepared(
+                        cur, INSERT_BLOCK,
+                        (document_id_param, signer_name, doc_hash, prev_hash, current_signature, hash_algorithm))
+                block_id = cur.fetchone()[0]
+                # --- FINE SEZIONE CRITICA ---
+
+                # Commit della transazione, rilascia automaticamente pg_advisory_xact_lock
+                conn_thread.commit()
+                print(
+                    f"[{thread_name}] {signer_name} ha inserito il blocco ID: {block_id}. Commit e rilascio lock {advisory_lock_key}.")
+                if request_id is not None:
+                    recent_requests.put(document_id_param, request_id, block_id, current_signature, signer_name,
+                                        doc_hash, hash_algorithm)
+                return block_id
+
+    except AdmissionRejected as error:
+        print(f"[{thread_name}] Append di {signer_name} respinto dal controllo di ammissione: {error}")
+    except RequestIdConflict as error:
+        print(f"[{thread_name}] Append di {signer_name} rifiutato: {error}")
+        if conn_thread:
+            conn_thread.rollback()
+    except LockBusyError as error:
+        print(f"[{thread_name}] Documento occupato, append di {signer_name} rifiutato: {error}")
+        conn_thread.rollback()
     except (Exception, psycopg2.Error) as error:
         print(f"[{thread_name}] Errore per {signer_name}: {error}")
         if conn_thread:
@@ -216,7 +420,206 @@ def concurrent_insert_signature(
             conn_thread.close()
 
 
-def check_for_forks(conn, document_id_param: str) -> None:
+def call_append_block(cur, document_id_param: str, signer_name: str, doc_hash: str,
+                      expected_prev: str | None, signature_param: str,
+                      key_id: str | None = None,
+                      lock_policy: LockPolicy | None = None,
+                      hash_algorithm: str = core.DEFAULT_HASH_ALGORITHM,
+                      request_id: str | None = None) -> tuple[int | None, str | None, bool]:
+    """
+    Invoca la stored procedure `append_block`, che in un'unica chiamata acquisisce
+    l'advisory lock del documento, verifica che la testa della catena sia ancora
+    `expected_prev` e inserisce il nuovo blocco.
+
+    Con `request_id`, se il blocco della richiesta è già stato inserito viene
+    restituito quello, senza inserirne un altro; in autocommit le richieste
+    confermate restano in `idempotency.recent_requests` e una ripetizione
+    ravvicinata non interroga il database. Il blocco viene restituito solo se
+    firmatario, hash e algoritmo coincidono con quelli della richiesta.
+
+    Args:
+        cur: Cursore psycopg2 attivo.
+        document_id_param (str): L'ID del documento.
+        signer_name (str): Il nome del firmatario.
+        doc_hash (str): L'hash del documento.
+        expected_prev (str | None): La testa della catena su cui è stata calcolata la firma
+                                    (None per il blocco genesi).
+        signature_param (str): La firma del blocco.
+        key_id (str | None, optional): La chiave del registro `signer_keys` usata per firmare.
+                                       Defaults to None.
+        lock_policy (LockPolicy | None, optional): Politica di acquisizione del lock. Il lock è
+                                                   acquisito dentro `append_block`, quindi "try"
+                                                   e "timeout" si traducono entrambe in un
+                                                   `lock_timeout` pari all'attesa massima.
+                                                   Defaults a "block".
+        hash_algorithm (str, optional): L'algoritmo con cui è stato calcolato doc_hash.
+                                        Defaults to "sha256".
+        request_id (str | None, optional): L'identificativo della richiesta, uguale per tutti i
+                                           suoi tentativi. Defaults to None.
+
+    Returns:
+        tuple[int | None, str | None, bool]: L'ID del blocco inserito, la nuova testa e False; in
+                                             caso di conflitto l'ID è None e la testa è quella
+                                             corrente; per una richiesta ripetuta l'ID e la firma
+                                             del blocco già inserito e True.
+
+    Raises:
+        LockBusyError: Se il lock non viene acquisito entro l'attesa massima della politica.
+        RequestIdConflict: Se `request_id` è già stato usato sul documento per una richiesta diversa.
+    """
+    if request_id is not None:
+        cached = recent_requests.get(document_id_param, request_id, signer_name, doc_hash, hash_algorithm)
+        if cached is not None:
+            return cached[0], cached[1], True
+
+    # Anche senza politica il lock può scadere per un lock_timeout della sessione o del ruolo.
+    policy = lock_policy or LockPolicy()
+    query = "SELECT block_id, current_head, replayed FROM append_block(%s, %s, %s, %s, %s, %s, %s, %s);"
+    if policy.bounded:
+        # In autocommit le due istruzioni formano un'unica transazione implicita,
+        # quindi SET LOCAL vale solo per questa chiamata.
+        query = f"{policy.lock_timeout_sql()}; {query}"
+    start = time.perf_counter()
+    try:
+        cur.execute(query, (document_id_param, signer_name, doc_hash, expected_prev, signature_param, key_id,
+                            hash_algorithm, request_id))
+    except psycopg2.errors.LockNotAvailable as error:
+        waited = time.perf_counter() - start
+        lock_key = generate_advisory_lock_key(document_id_param)
+        lock_telemetry.record(lock_key, waited, False, policy.mode)
+        raise LockBusyError(lock_key, waited) from error
+    except psycopg2.errors.UniqueViolation as error:
+        # append_block segnala così un request_id riusato per una richiesta diversa.
+        raise RequestIdConflict(document_id_param, request_id) from error
+    block_id, current_head, replayed = cur.fetchone()
+    if lock_policy is not None:
+        # Per append_block l'attesa registrata comprende l'intera chiamata.
+        lock_telemetry.record(generate_advisory_lock_key(document_id_param), time.perf_counter() - start, True,
+                              lock_policy.mode)
+    # Fuori da autocommit il blocco non è ancora confermato: la cache lo vedrebbe prima del COMMIT.
+    if request_id is not None and block_id is not None and cur.connection.autocommit:
+        recent_requests.put(document_id_param, request_id, block_id, current_head, signer_name, doc_hash,
+                            hash_algorithm)
+    return block_id, current_head, replayed
+
+
+@profiled("mthread_advisory_lock.concurrent_insert_signature_procedure")
+def concurrent_insert_signature_procedure(
+        document_id_param: str,
+        signer_name: str,
+        document_content: str,
+        private_key_pem: bytes,
+        thread_name: str,
+        max_attempts: int = 5,
+        signing_pool=None,
+        hash_algorithm: str = core.DEFAULT_HASH_ALGORITHM,
+        lock_policy: LockPolicy | None = None,
+        admission: AdmissionController | None = None,
+        request_id: str | None = None) -> int | None:
+    """
+    Variante di `concurrent_insert_signature` che delega la sezione critica alla
+    stored procedure `append_block`. La testa della catena viene letta e la firma
+    calcolata senza alcun lock; lock, verifica della testa e INSERT costano un solo
+    round trip. In caso di conflitto (testa cambiata nel frattempo) si rifirma
+    sulla testa restituita dalla procedura e si riprova.
+
+    Args:
+        document_id_param (str): L'ID del documento a cui aggiungere la firma.
+        signer_name (str): Il nome del firmatario.
+        document_content (str): Il contenuto del documento (usato per l'hash).
+        private_key_pem (bytes): La chiave privata PEM del firmatario.
+        thread_name (str): Un nome identificativo per il thread (per il logging).
+        max_attempts (int, optional): Numero massimo di tentativi in caso di conflitto.
+                                      Defaults to 5.
+        signing_pool (SigningPool | None, optional): Pool di processi con cui firmare invece
+                                                     che nel thread corrente; deve contenere la
+                                                     chiave di `signer_name`. Defaults to None.
+        hash_algorithm (str, optional): L'algoritmo di hash del documento, registrato in
+                                        documents.algorithm. Defaults to "sha256".
+        lock_policy (LockPolicy | None, optional): Politica di acquisizione del lock
+                                                   (vedi `call_append_block`). Defaults a "block".
+        admission (AdmissionController | None, optional): Controllo di ammissione da superare
+                                                          prima di aprire la connessione.
+                                                          Defaults to None (nessun limite).
+        request_id (str | None, optional): L'identificativo della richiesta, uguale per tutti i
+                                           suoi tentativi (vedi `call_append_block`).
+                                           Defaults to None (append non idempotente).
+
+    Returns:
+        int | None: L'ID del blocco inserito (o già inserito per `request_id`); None se
+                    l'append non è riuscito.
+    """
+    conn_thread = None
+    doc_hash = get_document_hash(document_content, hash_algorithm)
+
+    try:
+        if request_id is not None:
+            cached = recent_requests.get(document_id_param, request_id, signer_name, doc_hash, hash_algorithm)
+            if cached is not None:
+                print(f"[{thread_name}] Richiesta {request_id} già eseguita: blocco ID {cached[0]} (cache).")
+                return cached[0]
+
+        with admission.admit(document_id_param) if admission is not None else nullcontext():
+            with timed(DB_CONNECT_SECONDS):
+                conn_thread = psycopg2.connect(
+                    dbname=db_name, user=db_user, password=db_password, host=db_host,
+                    cursor_factory=cursor_factory())
+            # Ogni chiamata è una transazione a sé: l'advisory lock acquisito da
+            # append_block viene rilasciato al termine della chiamata stessa.
+            conn_thread.autocommit = True
+
+            with conn_thread.cursor() as cur:
+                execute_prepared(cur, HEAD_BY_DOCUMENT, (document_id_param,))
+                result = cur.fetchone()
+                prev_hash = result[0] if result else None
+                print(
+                    f"[{thread_name}] Letto prev_hash: {prev_hash[:10] if prev_hash else 'NULL'} per {signer_name} (senza lock)")
+
+                for attempt in range(1, max_attempts + 1):
+                    # Simula elaborazione / ritardo di rete, ora fuori da qualsiasi lock
+                    time.sleep(random.uniform(0.1, 0.3))
+
+                    data_to_sign = (prev_hash or '').encode() + doc_hash.encode()
+                    if signing_pool is not None:
+                        current_signature = signing_pool.sign(data_to_sign, signer_name)
+                    else:
+                        current_signature = sign_data_for_simulation(
+                            private_key_pem, data_to_sign)
+
+                    block_id, current_head, replayed = call_append_block(
+                        cur, document_id_param, signer_name, doc_hash, prev_hash, current_signature,
+                        lock_policy=lock_policy, hash_algorithm=hash_algorithm, request_id=request_id)
+
+                    if replayed:
+                        print(f"[{thread_name}] Richiesta {request_id} già eseguita: blocco ID {block_id}.")
+                        return block_id
+                    if block_id is not None:
+                        print(
+                            f"[{thread_name}] {signer_name} ha inserito il blocco ID: {block_id} tramite append_block (tentativo {attempt}).")
+                        return block_id
+
+                    print(
+                        f"[{thread_name}] Conflitto per {signer_name}: la testa è ora {current_head[:10] if current_head else 'NULL'}. Nuova firma e nuovo tentativo.")
+                    prev_hash = current_head
+
+                print(
+                    f"[{thread_name}] {signer_name} non è riuscito ad inserire il blocco dopo {max_attempts} tentativi.")
+
+    except AdmissionRejected as error:
+        print(f"[{thread_name}] Append di {signer_name} respinto dal controllo di ammissione: {error}")
+    except RequestIdConflict as error:
+        print(f"[{thread_name}] Append di {signer_name} rifiutato: {error}")
+    except LockBusyError as error:
+        print(f"[{thread_name}] Documento occupato, append di {signer_name} rifiutato: {error}")
+    except (Exception, psycopg2.Error) as error:
+        print(f"[{thread_name}] Errore per {signer_name}: {error}")
+    finally:
+        if conn_thread:
+            conn_thread.close()
+
+
+@profiled("mthread_advisory_lock.check_for_forks")
+def check_for_forks(conn, document_id_param: str, max_block_id: int | None = None) -> None:
     """
     Controlla la presenza di biforcazioni (forks) nella catena di firme
     per un dato document_id. Una biforcazione si verifica se più blocchi
@@ -225,6 +628,9 @@ def check_for_forks(conn, document_id_param: str) -> None:
     Args:
         conn: Connessione attiva al database psycopg2.
         document_id_param (str): L'ID del documento da controllare.
+        max_block_id (int | None, optional): Considera solo i blocchi con ID non superiore,
+                                             ad esempio il watermark di un audit su replica.
+                                             Defaults to None (tutti i blocchi).
     """
     print(
         f"\n--- Controllo Biforcazioni per Documento ID: {document_id_param} ---")
@@ -233,11 +639,11 @@ def check_for_forks(conn, document_id_param: str) -> None:
             """
             SELECT prev_hash, COUNT(*) as count
             FROM signature_chain
-            WHERE document_id = %s AND prev_hash IS NOT NULL
+            WHERE document_id = %s AND prev_hash IS NOT NULL AND (%s IS NULL OR id <= %s)
             GROUP BY prev_hash
             HAVING COUNT(*) > 1;
             """,
-            (document_id_param,)
+            (document_id_param, max_block_id, max_block_id)
         )
         forks = cursor.fetchall()
         if forks:
@@ -248,7 +654,9 @@ def check_for_forks(conn, document_id_param: str) -> None:
             print("Nessuna biforcazione rilevata. La catena è sequenziale.")
 
         cursor.execute(
-            "SELECT id, signer, prev_hash, signature FROM signature_chain WHERE document_id = %s ORDER BY id", (document_id_param,))
+            "SELECT id, signer, prev_hash, signature FROM signature_chain "
+            "WHERE document_id = %s AND (%s IS NULL OR id <= %s) ORDER BY id",
+            (document_id_param, max_block_id, max_block_id))
         print("\nStato finale della catena:")
         for row in cursor.fetchall():
             print(
@@ -256,36 +664,71 @@ def check_for_forks(conn, document_id_param: str) -> None:
 
 
 if __name__ == "__main__":
+    # --profile, --profile-dir DIR, --profile-perf (vedi profiling.py)
+    configure_from_argv()
+
     main_conn = None
+    signing_pool = None
     try:
-        main_conn = psycopg2.connect(
-            dbname=db_name, user=db_user, password=db_password, host=db_host)
+        with timed(DB_CONNECT_SECONDS):
+            main_conn = psycopg2.connect(
+                dbname=db_name, user=db_user, password=db_password, host=db_host,
+                cursor_factory=cursor_factory())
         clear_table(main_conn)
 
         doc_id_test = str(uuid4())
         document_content_main = "Contenuto del documento per test di concorrenza con advisory lock."
-        doc_hash_main = get_document_hash(document_content_main)
+        # DOCUMENT_HASH_ALGORITHM sceglie l'algoritmo di hash della catena (default sha256).
+        hash_algorithm = os.environ.get("DOCUMENT_HASH_ALGORITHM", core.DEFAULT_HASH_ALGORITHM)
+        doc_hash_main = get_document_hash(document_content_main, hash_algorithm)
 
         priv_key_gen, _ = generate_keys_for_simulation()
         genesis_signature = sign_data_for_simulation(
             priv_key_gen, doc_hash_main.encode())
         insert_genesis_block(
-            main_conn, doc_id_test, "FirmatarioGenesi", doc_hash_main, genesis_signature)
+            main_conn, doc_id_test, "FirmatarioGenesi", doc_hash_main, genesis_signature,
+            hash_algorithm)
 
-        print("\nAvvio inserimenti concorrenti con Advisory Locks...")
+        # APPEND_MODE=procedure usa la stored procedure append_block (un solo
+        # round trip per append) al posto del lock esplicito lato client.
+        append_mode = os.environ.get("APPEND_MODE", "lock")
+        insert_target = concurrent_insert_signature_procedure if append_mode == "procedure" \
+            else concurrent_insert_signature
+
+        # LOCK_POLICY=try|timeout e LOCK_MAX_WAIT_SECONDS limitano l'attesa del lock.
+        lock_policy = LockPolicy.from_env()
+        # ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_PER_DOCUMENT, ADMISSION_MAX_QUEUE e
+        # ADMISSION_MAX_WAIT_SECONDS limitano gli append concorrenti (vedi admission.py).
+        admission = AdmissionController.from_env()
+
+        print(f"\nAvvio inserimenti concorrenti con Advisory Locks (modalità: {append_mode}, "
+              f"politica di lock: {lock_policy.mode})...")
 
         priv_key_A, _ = generate_keys_for_simulation()
         priv_key_B, _ = generate_keys_for_simulation()
 
+        # SIGNING_WORKERS=N firma in un pool di N processi invece che nei thread.
+        signing_workers = int(os.environ.get("SIGNING_WORKERS", "0"))
+        if signing_workers > 0:
+            signing_pool = SigningPool(
+                {"FirmatarioA": priv_key_A, "FirmatarioB": priv_key_B}, workers=signing_workers)
+
+        # Un request_id per richiesta, riusato dai suoi eventuali tentativi (vedi idempotency.py).
+        request_id_A, request_id_B = new_request_id(), new_request_id()
+
         thread1 = threading.Thread(
-            target=concurrent_insert_signature,
+            target=insert_target,
             args=(doc_id_test, "FirmatarioA",
-                  document_content_main, priv_key_A, "Thread-1")
+                  document_content_main, priv_key_A, "Thread-1"),
+            kwargs={"signing_pool": signing_pool, "lock_policy": lock_policy, "hash_algorithm": hash_algorithm,
+                    "admission": admission, "request_id": request_id_A}
         )
         thread2 = threading.Thread(
-            target=concurrent_insert_signature,
+            target=insert_target,
             args=(doc_id_test, "FirmatarioB",
-                  document_content_main, priv_key_B, "Thread-2")
+                  document_content_main, priv_key_B, "Thread-2"),
+            kwargs={"signing_pool": signing_pool, "lock_policy": lock_policy, "hash_algorithm": hash_algorithm,
+                    "admission": admission, "request_id": request_id_B}
         )
 
         thread1.start()
@@ -294,11 +737,30 @@ if __name__ == "__main__":
         thread1.join()
         thread2.join()
 
+        # Ripetizione della richiesta di FirmatarioA, come dopo un timeout sul COMMIT:
+        # viene restituito il blocco già inserito. La cache è svuotata perché la
+        # ripetizione passi dall'indice su (document_id, request_id).
+        recent_requests.clear()
+        insert_target(doc_id_test, "FirmatarioA", document_content_main, priv_key_A, "Thread-1 (ripetizione)",
+                      signing_pool=signing_pool, lock_policy=lock_policy, hash_algorithm=hash_algorithm,
+                      request_id=request_id_A)
+
         print("\nInserimenti concorrenti completati.")
-        check_for_forks(main_conn, doc_id_test)
+        for stats in lock_telemetry.snapshot():
+            print(f"  Lock {stats['lock_key']}: {stats['acquired']} acquisiti, {stats['busy']} rifiutati, "
+                  f"attesa totale {stats['wait_total'] * 1000:.1f} ms (max {stats['wait_max'] * 1000:.1f} ms)")
+        admission_stats = admission.snapshot()
+        print(f"  Ammissione: {admission_stats['admitted']} ammessi, {admission_stats['queue_full']} respinti per coda "
+              f"piena, {admission_stats['timeout']} per attesa scaduta.")
+        # Controllo sulla replica, se DB_READER_DSN è impostato (vedi db_config.py).
+        with audit_connection(dbname=db_name, user=db_user, password=db_password, host=db_host) \
+                as (audit_conn, watermark):
+            check_for_forks(audit_conn, doc_id_test, watermark.max_block_id)
 
     except (Exception, psycopg2.Error) as error:
         print(f"Errore nello script principale: {error}")
     finally:
+        if signing_pool:
+            signing_pool.close()
         if main_conn:
             main_conn.close()
@@ -0,0 +1,323 @@
+"""
+Append concorrenti senza lock: lettura della testa e INSERT in una
+transazione SERIALIZABLE, ritentata in caso di conflitto.
+
+Con SERIALIZABLE PostgreSQL tiene traccia (SSI, predicate lock sull'indice
+`(document_id, id)`) di cosa ha letto ogni transazione. Se due append leggono
+la stessa testa e inseriscono entrambi un blocco, una delle due transazioni
+viene annullata con SQLSTATE 40001 (`serialization_failure`), al momento
+dell'INSERT o del COMMIT: la biforcazione non può essere registrata.
+`append_serializable` ritenta la transazione da capo (nuova lettura della
+testa e nuova firma) con attese casuali crescenti, e registra quanti
+tentativi sono serviti in `retry_telemetry`.
+
+Il confronto del throughput con l'advisory lock è in
+`benchmarks/bench_append_strategies.py`.
+"""
+from contextlib import nullcontext
+from dataclasses import dataclass
+import os
+import random
+import threading
+import time
+from typing import Callable
+from uuid import uuid4
+
+import psycopg2
+import psycopg2.errors
+
+from admission import AdmissionController, AdmissionRejected
+from db_config import audit_connection
+from metrics import (DB_CONNECT_SECONDS, ENABLED as METRICS_ENABLED, REGISTRY, SERIALIZATION_FAILURES_TOTAL,
+                     cursor_factory, timed)
+from mthread_advisory_lock import (check_for_forks, clear_table, generate_keys_for_simulation, get_document_hash,
+                                   insert_genesis_block, sign_data_for_simulation)
+from prepared_statements import HEAD_BY_DOCUMENT, INSERT_BLOCK, execute_prepared, prepare_statements
+from profiling import configure_from_argv, profiled
+from signature_chain import core
+
+# --- Variabili di Connessione al DB (da ENV o default) ---
+db_name = os.environ.get("DB_NAME", "signature_demo")
+db_user = os.environ.get("SUPER_DB_USER", "postgres")
+db_password = os.environ.get("SUPER_DB_PASSWORD", "postgres")
+db_host = os.environ.get("DB_HOST", "localhost")
+
+
+class SerializationRetriesExhausted(Exception):
+    """
+    L'append è stato annullato per conflitto di serializzazione ad ogni
+    tentativo: il documento è troppo conteso per la `RetryPolicy`.
+    """
+
+    def __init__(self, attempts: int):
+        super().__init__(f"Conflitto di serializzazione ad ognuno dei {attempts} tentativi.")
+        self.attempts = attempts
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    Politica di ripetizione degli append annullati con SQLSTATE 40001.
+
+    Attributes:
+        max_attempts (int): Numero massimo di transazioni per append.
+        retry_base (float): Attesa massima prima del secondo tentativo; raddoppia ad ogni tentativo.
+        retry_max (float): Limite dell'attesa tra due tentativi.
+    """
+    max_attempts: int = 10
+    retry_base: float = 0.005
+    retry_max: float = 0.2
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        """
+        Legge il numero di tentativi da `SERIALIZABLE_MAX_ATTEMPTS` (default 10).
+        """
+        return cls(max_attempts=int(os.environ.get("SERIALIZABLE_MAX_ATTEMPTS", "10")))
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Attesa prima del tentativo successivo al numero `attempt` (da 1): casuale tra 0
+        e un limite che raddoppia ad ogni tentativo ("full jitter").
+        """
+        return random.uniform(0, min(self.retry_max, self.retry_base * 2 ** (attempt - 1)))
+
+
+class RetryTelemetry:
+    """
+    Distribuzione del numero di tentativi degli append SERIALIZABLE: quanti sono
+    riusciti al primo tentativo, quanti al secondo, ..., e quanti hanno esaurito
+    i tentativi.
+    """
+
+    def __init__(self):
+        self._attempts = {}
+        self._retries = 0
+        self._exhausted = 0
+        self._lock = threading.Lock()
+
+    def record(self, attempts: int, succeeded: bool) -> None:
+        with self._lock:
+            self._retries += attempts - 1
+            if succeeded:
+                self._attempts[attempts] = self._attempts.get(attempts, 0) + 1
+            else:
+                self._exhausted += 1
+
+    def snapshot(self) -> dict:
+        """
+        Restituisce {"appends", "retries", "exhausted", "attempts"}: append riusciti,
+        transazioni ripetute (anche degli append falliti), append falliti e la
+        distribuzione {tentativi: append riusciti}.
+        """
+        with self._lock:
+            return {"appends": sum(self._attempts.values()),
+                    "retries": self._retries,
+                    "exhausted": self._exhausted,
+                    "attempts": dict(sorted(self._attempts.items()))}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._attempts.clear()
+            self._retries = self._exhausted = 0
+
+
+retry_telemetry = RetryTelemetry()
+
+
+def append_serializable(conn, document_id_param: str, signer_name: str, doc_hash: str,
+                        sign: Callable[[bytes], str],
+                        hash_algorithm: str = core.DEFAULT_HASH_ALGORITHM,
+                        retry_policy: RetryPolicy | None = None,
+                        think: Callable[[], None] | None = None) -> tuple[int, int]:
+    """
+    Aggiunge un blocco alla catena del documento leggendo la testa e inserendo
+    il blocco in una transazione SERIALIZABLE, senza alcun lock. Se PostgreSQL
+    annulla la transazione per conflitto di serializzazione, la ritenta da capo
+    (nuova testa, nuova firma) secondo `retry_policy`.
+
+    Args:
+        conn: Connessione psycopg2 senza autocommit e senza transazioni aperte; il livello di
+              isolamento della sessione non viene modificato.
+        document_id_param (str): L'ID del documento.
+        signer_name (str): Il nome del firmatario.
+        doc_hash (str): L'hash del documento.
+        sign (Callable[[bytes], str]): Firma i dati di un blocco e restituisce la firma esadecimale.
+        hash_algorithm (str, optional): L'algoritmo con cui è stato calcolato doc_hash.
+                                        Defaults to "sha256".
+        retry_policy (RetryPolicy | None, optional): La politica di ripetizione. Defaults a `RetryPolicy()`.
+        think (Callable[[], None] | None, optional): Chiamata tra la lettura della testa e l'INSERT,
+                                                     per simulare elaborazione o ritardi di rete.
+                                                     Defaults to None.
+
+    Returns:
+        tuple[int, int]: L'ID del blocco inserito e il numero di tentativi.
+
+    Raises:
+        SerializationRetriesExhausted: Se tutti i tentativi sono stati annullati.
+    """
+    retry_policy = retry_policy or RetryPolicy()
+    # Il PREPARE leggerebbe il catalogo prima di SET TRANSACTION: va fatto fuori dai tentativi.
+    prepare_statements(conn)
+    conn.commit()
+
+    for attempt in range(1, retry_policy.max_attempts + 1):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET TRANSACTION ISOLATION LEVEL SERIALIZABLE")
+                execute_prepared(cur, HEAD_BY_DOCUMENT, (document_id_param,))
+                row = cur.fetchone()
+                prev_hash = row[0] if row else None
+                if think is not None:
+                    think()
+                signature = sign(core.signing_input(prev_hash, doc_hash))
+                execute_prepared(
+                    cur, INSERT_BLOCK, (document_id_param, signer_name, doc_hash, prev_hash, signature, hash_algorithm))
+                block_id = cur.fetchone()[0]
+            conn.commit()
+        except psycopg2.errors.SerializationFailure:
+            conn.rollback()
+            if attempt == retry_policy.max_attempts:
+                break
+            if METRICS_ENABLED:
+                REGISTRY[SERIALIZATION_FAILURES_TOTAL].inc(labels=("retried",))
+            time.sleep(retry_policy.backoff(attempt))
+            continue
+        retry_telemetry.record(attempt, True)
+        return block_id, attempt
+
+    retry_telemetry.record(retry_policy.max_attempts, False)
+    if METRICS_ENABLED:
+        REGISTRY[SERIALIZATION_FAILURES_TOTAL].inc(labels=("exhausted",))
+    raise SerializationRetriesExhausted(retry_policy.max_attempts)
+
+
+@profiled("mthread_serializable.concurrent_insert_signature")
+def concurrent_insert_signature(
+        document_id_param: str,
+        signer_name: str,
+        document_content: str,
+        private_key_pem: bytes,
+        thread_name: str,
+        signing_pool=None,
+        hash_algorithm: str = core.DEFAULT_HASH_ALGORITHM,
+        retry_policy: RetryPolicy | None = None,
+        admission: AdmissionController | None = None) -> None:
+    """
+    Simula l'inserimento concorrente di una firma nella catena con
+    `append_serializable`, senza lock.
+    Questa funzione è progettata per essere eseguita in un thread separato.
+
+    Args:
+        document_id_param (str): L'ID del documento a cui aggiungere la firma.
+        signer_name (str): Il nome del firmatario.
+        document_content (str): Il contenuto del documento (usato per l'hash).
+        private_key_pem (bytes): La chiave privata PEM del firmatario.
+        thread_name (str): Un nome identificativo per il thread (per il logging).
+        signing_pool (SigningPool | None, optional): Pool di processi con cui firmare invece
+                                                     che nel thread corrente; deve contenere la
+                                                     chiave di `signer_name`. Defaults to None.
+        hash_algorithm (str, optional): L'algoritmo di hash del documento, registrato in
+                                        documents.algorithm. Defaults to "sha256".
+        retry_policy (RetryPolicy | None, optional): La politica di ripetizione dei conflitti.
+                                                     Defaults a `RetryPolicy()`.
+        admission (AdmissionController | None, optional): Controllo di ammissione da superare
+                                                          prima di aprire la connessione.
+                                                          Defaults to None (nessun limite).
+    """
+    conn_thread = None
+
+    def sign(data_to_sign: bytes) -> str:
+        if signing_pool is not None:
+            return signing_pool.sign(data_to_sign, signer_name)
+        return sign_data_for_simulation(private_key_pem, data_to_sign)
+
+    try:
+        with admission.admit(document_id_param) if admission is not None else nullcontext():
+            with timed(DB_CONNECT_SECONDS):
+                conn_thread = psycopg2.connect(
+                    dbname=db_name, user=db_user, password=db_password, host=db_host,
+                    cursor_factory=cursor_factory())
+            conn_thread.autocommit = False
+
+            doc_hash = get_document_hash(document_content, hash_algorithm)
+            block_id, attempts = append_serializable(
+                conn_thread, document_id_param, signer_name, doc_hash, sign, hash_algorithm, retry_policy,
+                # Simula elaborazione / ritardo di rete tra lettura della testa e INSERT
+                think=lambda: time.sleep(random.uniform(0.1, 0.3)))
+            print(f"[{thread_name}] {signer_name} ha inserito il blocco ID: {block_id} (tentativi: {attempts}).")
+
+    except AdmissionRejected as error:
+        print(f"[{thread_name}] Append di {signer_name} respinto dal controllo di ammissione: {error}")
+    except SerializationRetriesExhausted as error:
+        print(f"[{thread_name}] Append di {signer_name} rinunciato: {error}")
+    except (Exception, psycopg2.Error) as error:
+        print(f"[{thread_name}] Errore per {signer_name}: {error}")
+        if conn_thread:
+            conn_thread.rollback()
+    finally:
+        if conn_thread:
+            conn_thread.close()
+
+
+if __name__ == "__main__":
+    # --profile, --profile-dir DIR, --profile-perf (vedi profiling.py)
+    configure_from_argv()
+
+    main_conn = None
+    try:
+        with timed(DB_CONNECT_SECONDS):
+            main_conn = psycopg2.connect(
+                dbname=db_name, user=db_user, password=db_password, host=db_host,
+                cursor_factory=cursor_factory())
+        clear_table(main_conn)
+
+        doc_id_test = str(uuid4())
+        document_content_main = "Contenuto del documento per test di concorrenza SERIALIZABLE."
+        # DOCUMENT_HASH_ALGORITHM sceglie l'algoritmo di hash della catena (default sha256).
+        hash_algorithm = os.environ.get("DOCUMENT_HASH_ALGORITHM", core.DEFAULT_HASH_ALGORITHM)
+        doc_hash_main = get_document_hash(document_content_main, hash_algorithm)
+
+        priv_key_gen, _ = generate_keys_for_simulation()
+        genesis_signature = sign_data_for_simulation(priv_key_gen, doc_hash_main.encode())
+        insert_genesis_block(
+            main_conn, doc_id_test, "FirmatarioGenesi", doc_hash_main, genesis_signature, hash_algorithm)
+
+        # SERIALIZABLE_MAX_ATTEMPTS limita i tentativi per append.
+        retry_policy = RetryPolicy.from_env()
+        # ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_PER_DOCUMENT, ADMISSION_MAX_QUEUE e
+        # ADMISSION_MAX_WAIT_SECONDS limitano gli append concorrenti (vedi admission.py).
+        admission = AdmissionController.from_env()
+        # CONCURRENT_SIGNERS=N avvia N firmatari concorrenti (default 2).
+        signers = int(os.environ.get("CONCURRENT_SIGNERS", "2"))
+        print(f"\nAvvio di {signers} inserimenti concorrenti SERIALIZABLE "
+              f"(massimo {retry_policy.max_attempts} tentativi)...")
+
+        threads = []
+        for index in range(1, signers + 1):
+            private_key, _ = generate_keys_for_simulation()
+            threads.append(threading.Thread(
+                target=concurrent_insert_signature,
+                args=(doc_id_test, f"Firmatario{index}", document_content_main, private_key, f"Thread-{index}"),
+                kwargs={"hash_algorithm": hash_algorithm, "retry_policy": retry_policy, "admission": admission}))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = retry_telemetry.snapshot()
+        print(f"\nInserimenti concorrenti completati: {stats['appends']} append, {stats['retries']} transazioni "
+              f"ripetute, {stats['exhausted']} append rinunciati; tentativi per append: {stats['attempts']}.")
+        admission_stats = admission.snapshot()
+        print(f"  Ammissione: {admission_stats['admitted']} ammessi, {admission_stats['queue_full']} respinti per coda "
+              f"piena, {admission_stats['timeout']} per attesa scaduta.")
+        # Controllo sulla replica, se DB_READER_DSN è impostato (vedi db_config.py).
+        with audit_connection(dbname=db_name, user=db_user, password=db_password, host=db_host) \
+                as (audit_conn, watermark):
+            check_for_forks(audit_conn, doc_id_test, watermark.max_block_id)
+
+    except (Exception, psycopg2.Error) as error:
+        print(f"Errore nello script principale: {error}")
+    finally:
+        if main_conn:
+            main_conn.close()
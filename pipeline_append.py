@@ -0,0 +1,294 @@
+"""
+Append pipelined su più documenti tramite la pipeline mode di libpq (psycopg 3).
+
+Quando uno stesso worker deve aggiungere blocchi alle catene di molti documenti
+diversi, eseguire gli append uno dopo l'altro costa almeno un round trip di rete
+ciascuno. Questo motore procede per "ondate": in ogni ondata c'è al più una
+richiesta per documento (così l'ordine delle richieste di uno stesso documento
+è preservato), le letture delle teste e le chiamate alla stored procedure
+`append_block` di tutte le richieste dell'ondata vengono accodate e inviate
+insieme, pagando un solo round trip per ondata invece di uno per richiesta.
+"""
+from collections import deque
+from dataclasses import dataclass
+import os
+import time
+from uuid import uuid4
+
+import psycopg
+
+from mthread_advisory_lock import (generate_advisory_lock_key, generate_keys_for_simulation,
+                                   get_document_hash, sign_data_for_simulation)
+from signing_pool import SigningPool, gather
+
+db_name = os.environ.get("DB_NAME", "signature_demo")
+db_user = os.environ.get("SUPER_DB_USER", "postgres")
+db_password = os.environ.get("SUPER_DB_PASSWORD", "postgres")
+db_host = os.environ.get("DB_HOST", "localhost")
+
+# Come HEAD_BY_DOCUMENT: con tutti i blocchi archiviati la testa è in archived_heads.
+HEAD_SQL = ("SELECT coalesce((SELECT signature FROM signature_chain WHERE document_id = %(document_id)s "
+            "ORDER BY id DESC LIMIT 1), (SELECT signature FROM archived_heads WHERE document_id = %(document_id)s))")
+APPEND_BLOCK_SQL = "SELECT block_id, current_head FROM append_block(%s, %s, %s, %s, %s)"
+
+
+class AppendConflictError(Exception):
+    """
+    La testa della catena del documento è cambiata ad ogni tentativo: il blocco
+    non è stato inserito entro il numero massimo di tentativi.
+    """
+
+
+@dataclass
+class AppendRequest:
+    """
+    Una richiesta di append di un blocco alla catena di un documento.
+    """
+    document_id: str
+    signer: str
+    document_hash: str
+    private_key_pem: bytes
+
+
+@dataclass
+class AppendResult:
+    """
+    L'esito di una richiesta di append: l'ID del blocco inserito e la sua firma,
+    oppure l'errore che ne ha impedito l'inserimento.
+    """
+    request: AppendRequest
+    block_id: int | None = None
+    signature: str | None = None
+    attempts: int = 0
+    error: Exception | None = None
+
+
+class PipelineAppendEngine:
+    """
+    Motore di append che accoda le operazioni di documenti indipendenti in
+    pipeline mode e le invia al server in un'unica volta.
+
+    Ogni ondata viene eseguita dal server come un'unica transazione implicita:
+    gli advisory lock di `append_block` vengono quindi acquisiti in ordine di
+    chiave, così che due motori concorrenti non possano andare in deadlock.
+    Se un'istruzione dell'ondata fallisce, la transazione viene annullata e
+    le richieste dell'ondata vengono rieseguite una per volta, in modo che
+    l'errore sia attribuito esattamente alla richiesta che lo ha causato.
+    """
+
+    def __init__(self, conn, max_attempts: int = 5, signing_pool=None):
+        """
+        Args:
+            conn: Una connessione psycopg 3 in autocommit.
+            max_attempts (int, optional): Numero massimo di tentativi per richiesta
+                                          in caso di conflitto sulla testa. Defaults to 5.
+            signing_pool (SigningPool | None, optional): Pool di processi con cui firmare
+                                                         in parallelo le richieste di un'ondata;
+                                                         deve contenere le chiavi dei firmatari.
+                                                         Defaults to None (firma nel processo corrente).
+        """
+        self.conn = conn
+        self.max_attempts = max_attempts
+        self.signing_pool = signing_pool
+        self.round_trips = 0
+
+    def append_many(self, requests: list[AppendRequest]) -> list[AppendResult]:
+        """
+        Esegue gli append richiesti, preservando l'ordine relativo delle richieste
+        di uno stesso documento.
+
+        Args:
+            requests (list[AppendRequest]): Le richieste di append.
+
+        Returns:
+            list[AppendResult]: Gli esiti, nello stesso ordine delle richieste.
+        """
+        results = [AppendResult(request) for request in requests]
+        pending = {}
+        for result in results:
+            pending.setdefault(result.request.document_id, deque()).append(result)
+
+        heads = self._read_heads(list(pending))
+        for document_id, head in list(heads.items()):
+            if isinstance(head, Exception):
+                for result in pending.pop(document_id):
+                    result.error = head
+
+        while pending:
+            wave = sorted((queue[0] for queue in pending.values()),
+                          key=lambda r: generate_advisory_lock_key(r.request.document_id))
+
+            signatures = self._sign_wave(wave, heads)
+            outcomes = self._append_wave(wave, heads, signatures)
+
+            for result, signature, outcome in zip(wave, signatures, outcomes):
+                document_id = result.request.document_id
+                result.attempts += 1
+
+                if isinstance(outcome, Exception):
+                    result.error = outcome
+                else:
+                    block_id, current_head = outcome
+                    heads[document_id] = current_head
+                    if block_id is not None:
+                        result.block_id = block_id
+                        result.signature = signature
+                    elif result.attempts >= self.max_attempts:
+                        result.error = AppendConflictError(
+                            f"Testa del documento {document_id} cambiata ad ogni tentativo "
+                            f"({result.attempts} tentativi).")
+                    else:
+                        # Conflitto: la richiesta resta in testa alla coda e
+                        # verrà rifirmata sulla nuova testa nella prossima ondata.
+                        continue
+
+                pending[document_id].popleft()
+                if not pending[document_id]:
+                    del pending[document_id]
+
+        return results
+
+    def _read_heads(self, document_ids: list[str]) -> dict:
+        """
+        Legge in pipeline la testa corrente della catena di ciascun documento.
+        Se la pipeline fallisce, le letture vengono ripetute una per volta per
+        attribuire l'errore al documento che lo ha causato.
+
+        Args:
+            document_ids (list[str]): Gli ID dei documenti.
+
+        Returns:
+            dict: Mappa document_id -> ultima firma della catena (None se vuota),
+                  oppure l'eccezione sollevata dalla lettura.
+        """
+        heads = {}
+        cursors = []
+        try:
+            with self.conn.pipeline():
+                for document_id in document_ids:
+                    cursor = self.conn.cursor()
+                    cursor.execute(HEAD_SQL, {"document_id": document_id})
+                    cursors.append(cursor)
+            self.round_trips += 1
+            for document_id, cursor in zip(document_ids, cursors):
+                row = cursor.fetchone()
+                heads[document_id] = row[0] if row else None
+        except psycopg.Error:
+            self.round_trips += 1
+            for document_id in document_ids:
+                try:
+                    row = self.conn.execute(HEAD_SQL, {"document_id": document_id}).fetchone()
+                    heads[document_id] = row[0] if row else None
+                except psycopg.Error as error:
+                    heads[document_id] = error
+                self.round_trips += 1
+        return heads
+
+    def _sign_wave(self, wave: list[AppendResult], heads: dict) -> list[str]:
+        """
+        Firma i blocchi di un'ondata sulla testa corrente della catena di ciascun
+        documento. Con un pool di firma, le richieste vengono raggruppate per
+        firmatario e i gruppi firmati in parallelo nei processi del pool.
+
+        Args:
+            wave (list[AppendResult]): Le richieste dell'ondata.
+            heads (dict): Mappa document_id -> testa corrente della catena.
+
+        Returns:
+            list[str]: Le firme esadecimali, nello stesso ordine delle richieste.
+        """
+        inputs = [(heads[result.request.document_id] or '').encode() + result.request.document_hash.encode()
+                  for result in wave]
+
+        if self.signing_pool is None:
+            return [sign_data_for_simulation(result.request.private_key_pem, data)
+                    for result, data in zip(wave, inputs)]
+
+        by_signer = {}
+        for index, result in enumerate(wave):
+            by_signer.setdefault(result.request.signer, []).append(index)
+
+        pending = [(indexes, self.signing_pool.submit_many([inputs[i] for i in indexes], signer))
+                   for signer, indexes in by_signer.items()]
+
+        signatures = [None] * len(wave)
+        for indexes, futures in pending:
+            for index, signature in zip(indexes, gather(futures)):
+                signatures[index] = signature
+        return signatures
+
+    def _append_wave(self, wave: list[AppendResult], heads: dict, signatures: list[str]) -> list:
+        """
+        Invia in pipeline le chiamate ad `append_block` di un'ondata.
+
+        Returns:
+            list: Per ogni richiesta, la tupla (block_id, current_head) restituita
+                  da `append_block` oppure l'eccezione sollevata.
+        """
+        params = [(result.request.document_id, result.request.signer, result.request.document_hash,
+                   heads[result.request.document_id], signature)
+                  for result, signature in zip(wave, signatures)]
+
+        cursors = []
+        try:
+            with self.conn.pipeline():
+                for param in params:
+                    cursor = self.conn.cursor()
+                    cursor.execute(APPEND_BLOCK_SQL, param)
+                    cursors.append(cursor)
+            self.round_trips += 1
+            return [cursor.fetchone() for cursor in cursors]
+        except psycopg.Error:
+            self.round_trips += 1
+            return self._append_individually(params)
+
+    def _append_individually(self, params: list[tuple]) -> list:
+        """
+        Riesegue una per volta, ciascuna nella propria transazione, le chiamate
+        di un'ondata fallita, per attribuire ogni errore alla propria richiesta.
+        """
+        outcomes = []
+        for param in params:
+            try:
+                outcomes.append(self.conn.execute(APPEND_BLOCK_SQL, param).fetchone())
+            except psycopg.Error as error:
+                outcomes.append(error)
+            self.round_trips += 1
+        return outcomes
+
+
+if __name__ == "__main__":
+    documents_count = int(os.environ.get("PIPELINE_DOCUMENTS", "20"))
+    signers_per_document = int(os.environ.get("PIPELINE_SIGNERS", "3"))
+
+    signer_keys = {f"Firmatario{i}": generate_keys_for_simulation()[0]
+                   for i in range(signers_per_document)}
+
+    requests = []
+    for d in range(documents_count):
+        document_id = str(uuid4())
+        document_hash = get_document_hash(f"Documento {d} per append in pipeline.")
+        for signer, private_key_pem in signer_keys.items():
+            requests.append(AppendRequest(document_id, signer, document_hash, private_key_pem))
+
+    # SIGNING_WORKERS=N firma le richieste di ogni ondata in un pool di N processi.
+    signing_workers = int(os.environ.get("SIGNING_WORKERS", "0"))
+    signing_pool = SigningPool(signer_keys, workers=signing_workers) if signing_workers > 0 else None
+
+    try:
+        with psycopg.connect(dbname=db_name, user=db_user, password=db_password, host=db_host,
+                             autocommit=True) as conn:
+            engine = PipelineAppendEngine(conn, signing_pool=signing_pool)
+            start = time.perf_counter()
+            results = engine.append_many(requests)
+            elapsed = time.perf_counter() - start
+    finally:
+        if signing_pool:
+            signing_pool.close()
+
+    failed = [result for result in results if result.error]
+    print(f"Append eseguiti: {len(results) - len(failed)}/{len(results)} "
+          f"su {documents_count} documenti in {elapsed:.3f} s "
+          f"({engine.round_trips} round trip, {len(results)} richieste).")
+    for result in failed:
+        print(f"  Errore per {result.request.signer} su doc {result.request.document_id}: {result.error}")
@@ -0,0 +1,150 @@
+"""
+Prepared statement lato server per le query calde della catena di firme.
+
+Le query di lettura della testa della catena e di inserimento di un blocco
+vengono preparate (`PREPARE`) una sola volta per connessione ed eseguite con
+`EXECUTE`, evitando che PostgreSQL le analizzi e pianifichi ad ogni append.
+"""
+import threading
+import weakref
+
+import psycopg2
+import psycopg2.errors
+
+HEAD_GLOBAL = "sc_head"
+HEAD_BY_DOCUMENT = "sc_head_by_document"
+HEAD_BY_DOCUMENT_FOR_UPDATE = "sc_head_by_document_for_update"
+INSERT_BLOCK = "sc_insert_block"
+INSERT_BLOCK_WITH_KEY = "sc_insert_block_with_key"
+INSERT_BLOCK_WITH_REQUEST = "sc_insert_block_with_request"
+BLOCK_BY_REQUEST = "sc_block_by_request"
+
+# Nome -> (tipi dei parametri, testo della query)
+# Le letture della testa ricadono su archived_heads quando i blocchi sono stati
+# tutti archiviati (vedi archive.py): la catena prosegue dall'ultimo blocco
+# archiviato invece di ripartire da un nuovo blocco genesi.
+STATEMENTS = {
+    HEAD_GLOBAL: (
+        "",
+        "SELECT coalesce((SELECT signature FROM signature_chain ORDER BY id DESC LIMIT 1), "
+        "(SELECT signature FROM archived_heads ORDER BY block_id DESC LIMIT 1))"),
+    HEAD_BY_DOCUMENT: (
+        "(uuid)",
+        "SELECT coalesce((SELECT signature FROM signature_chain WHERE document_id = $1 ORDER BY id DESC LIMIT 1), "
+        "(SELECT signature FROM archived_heads WHERE document_id = $1))"),
+    HEAD_BY_DOCUMENT_FOR_UPDATE: (
+        "(uuid)",
+        "SELECT coalesce((SELECT signature FROM signature_chain WHERE document_id = $1 ORDER BY id DESC LIMIT 1 "
+        "FOR UPDATE), (SELECT signature FROM archived_heads WHERE document_id = $1))"),
+    # Ultimo parametro: l'algoritmo di hash del documento (documents.algorithm).
+    INSERT_BLOCK: (
+        "(uuid, text, text, text, text, text)",
+        "INSERT INTO signature_chain (document_id, signer, document_ref, prev_hash, signature) "
+        "VALUES ($1, $2, document_ref($3, NULL, $6), $4, $5) RETURNING id"),
+    # Parametri 7 e 8: dimensione (può essere NULL) e algoritmo di hash del documento.
+    INSERT_BLOCK_WITH_KEY: (
+        "(uuid, text, text, text, text, text, bigint, text)",
+        "INSERT INTO signature_chain (document_id, signer, document_ref, prev_hash, signature, key_id) "
+        "VALUES ($1, $2, document_ref($3, $7, $8), $4, $5, $6) RETURNING id"),
+    # Come INSERT_BLOCK, con il request_id del client come parametro 7.
+    INSERT_BLOCK_WITH_REQUEST: (
+        "(uuid, text, text, text, text, text, text)",
+        "INSERT INTO signature_chain (document_id, signer, document_ref, prev_hash, signature, request_id) "
+        "VALUES ($1, $2, document_ref($3, NULL, $6), $4, $5, $7) RETURNING id"),
+    # Blocco già inserito da una richiesta con lo stesso request_id, in tabella o
+    # archiviato, con firmatario, hash e algoritmo per confrontarlo con la richiesta
+    # ripetuta (vedi idempotency.py).
+    BLOCK_BY_REQUEST: (
+        "(uuid, text)",
+        "SELECT sc.id, sc.signature, sc.signer, coalesce(sc.document_hash, d.hash), coalesce(d.algorithm, 'sha256') "
+        "FROM signature_chain sc LEFT JOIN documents d ON d.id = sc.document_ref "
+        "WHERE sc.document_id = $1 AND sc.request_id = $2 "
+        "UNION ALL "
+        "SELECT block_id, signature, signer, document_hash, hash_algorithm FROM archived_requests "
+        "WHERE document_id = $1 AND request_id = $2 "
+        "LIMIT 1"),
+}
+
+# Connessione -> PID del backend su cui sono stati preparati gli statement.
+# Se la connessione viene riciclata (nuovo backend) il PID cambia e gli
+# statement vengono preparati di nuovo.
+_prepared_connections = weakref.WeakKeyDictionary()
+_registry_lock = threading.Lock()
+
+
+def prepare_statements(conn) -> bool:
+    """
+    Prepara sulla connessione gli statement di `STATEMENTS` non ancora presenti.
+
+    L'operazione è idempotente: se la connessione risulta già preparata sullo
+    stesso backend non viene eseguito alcun round trip.
+
+    Args:
+        conn: La connessione al database psycopg2.
+
+    Returns:
+        bool: True se sono stati eseguiti dei PREPARE, False se la connessione era già pronta.
+    """
+    backend_pid = conn.get_backend_pid()
+
+    with _registry_lock:
+        if _prepared_connections.get(conn) == backend_pid:
+            return False
+
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT name FROM pg_prepared_statements")
+        existing = {row[0] for row in cursor.fetchall()}
+        missing = [name for name in STATEMENTS if name not in existing]
+        if missing:
+            cursor.execute("; ".join(
+                f"PREPARE {name} {STATEMENTS[name][0]} AS {STATEMENTS[name][1]}" for name in missing))
+
+    with _registry_lock:
+        _prepared_connections[conn] = backend_pid
+
+    return bool(missing)
+
+
+def forget_connection(conn) -> None:
+    """
+    Dimentica lo stato di preparazione di una connessione, forzando un nuovo
+    controllo al prossimo utilizzo.
+
+    Args:
+        conn: La connessione al database psycopg2.
+    """
+    with _registry_lock:
+        _prepared_connections.pop(conn, None)
+
+
+def execute_prepared(cursor, name: str, params: tuple = ()) -> None:
+    """
+    Esegue uno statement preparato, preparandolo prima se necessario.
+
+    Se lo statement non esiste più sul server (ad esempio dopo un `DISCARD ALL`
+    eseguito da un connection pooler) lo stato della connessione viene
+    dimenticato: in autocommit lo statement viene ripreparato e rieseguito
+    subito, altrimenti l'errore viene propagato perché la transazione corrente
+    è ormai abortita e il chiamante deve eseguire il rollback e riprovare.
+
+    Args:
+        cursor: Il cursore psycopg2 su cui eseguire lo statement.
+        name (str): Il nome dello statement (una delle chiavi di `STATEMENTS`).
+        params (tuple, optional): I parametri dello statement. Defaults to ().
+    """
+    conn = cursor.connection
+    prepare_statements(conn)
+
+    if params:
+        query = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})"
+    else:
+        query = f"EXECUTE {name}"
+
+    try:
+        cursor.execute(query, params)
+    except psycopg2.errors.InvalidSqlStatementName:
+        forget_connection(conn)
+        if not conn.autocommit:
+            raise
+        prepare_statements(conn)
+        cursor.execute(query, params)
@@ -0,0 +1,192 @@
+"""
+Modalità di profiling per i punti di ingresso di firma e verifica.
+
+Si abilita con la variabile d'ambiente `SIGNATURE_CHAIN_PROFILE=1` oppure con
+l'opzione `--profile` degli script (vedi `configure_from_argv`). Le funzioni
+decorate con `profiled` vengono eseguite sotto cProfile e per ogni chiamata
+vengono registrati il tempo reale e il tempo CPU del thread che la esegue.
+
+Ogni esecuzione scrive i propri artefatti in una sottodirectory distinta di
+`SIGNATURE_CHAIN_PROFILE_DIR` (default `profiles`), così da poter confrontare
+esecuzioni diverse nel tempo:
+
+    profile.prof     statistiche cProfile in formato pstats (snakeviz, pstats, ...)
+    profile.txt      le funzioni più costose per tempo cumulativo
+    sections.jsonl   una riga per chiamata profilata: thread, inizio e fine sul
+                     clock monotono (CLOCK_MONOTONIC, lo stesso di perf e py-spy),
+                     tempo reale e tempo CPU del thread
+    summary.json     totali per funzione profilata
+
+Con `SIGNATURE_CHAIN_PROFILE_PERF=1` (o `--profile-perf`, Linux e Python 3.12+)
+viene attivato il trampolino di `perf`, che rende visibili i nomi delle funzioni
+Python ai profiler a campionamento nativi come `perf record`.
+"""
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime
+import functools
+import io
+import json
+import os
+from pathlib import Path
+import pstats
+import sys
+import threading
+import time
+
+
+class _Settings:
+    enabled = os.environ.get("SIGNATURE_CHAIN_PROFILE", "").lower() in ("1", "true", "yes", "on")
+    directory = Path(os.environ.get("SIGNATURE_CHAIN_PROFILE_DIR", "profiles"))
+    perf = os.environ.get("SIGNATURE_CHAIN_PROFILE_PERF", "").lower() in ("1", "true", "yes", "on")
+
+
+class _ProfileSession:
+    """
+    Sessione di profiling del processo.
+
+    Da Python 3.12 cProfile si appoggia a `sys.monitoring`: può esserci un solo
+    profiler attivo per processo, che raccoglie le chiamate di tutti i thread.
+    La sessione lo abilita quando inizia la prima sezione profilata e lo
+    disabilita, scrivendo gli artefatti, quando termina l'ultima ancora attiva.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = 0
+        self._profiler = None
+        self._run_dir = None
+        self._summary = {}
+
+    def run_dir(self) -> Path:
+        if self._run_dir is None:
+            run_id = datetime.now().strftime("%Y%m%dT%H%M%S") + f"-{os.getpid()}"
+            self._run_dir = _Settings.directory / run_id
+            self._run_dir.mkdir(parents=True, exist_ok=True)
+            if _Settings.perf and hasattr(sys, "activate_stack_trampoline"):
+                try:
+                    sys.activate_stack_trampoline("perf")
+                except (ValueError, OSError):
+                    pass
+        return self._run_dir
+
+    def enter(self) -> None:
+        with self._lock:
+            self.run_dir()
+            self._active += 1
+            if self._active == 1:
+                if self._profiler is None:
+                    self._profiler = cProfile.Profile()
+                try:
+                    self._profiler.enable()
+                except ValueError:
+                    # Un altro strumento di profiling è già attivo (ad esempio coverage):
+                    # si registrano comunque i tempi delle sezioni.
+                    self._profiler = None
+
+    def exit(self, record: dict) -> None:
+        with self._lock:
+            self._active -= 1
+            if self._active == 0 and self._profiler is not None:
+                self._profiler.disable()
+                self._write_stats()
+
+            totals = self._summary.setdefault(record["section"], {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0})
+            totals["calls"] += 1
+            totals["wall_seconds"] += record["wall_seconds"]
+            totals["cpu_seconds"] += record["cpu_seconds"]
+
+            with open(self._run_dir / "sections.jsonl", "a", encoding="utf-8") as sections_file:
+                sections_file.write(json.dumps(record) + "\n")
+            with open(self._run_dir / "summary.json", "w", encoding="utf-8") as summary_file:
+                json.dump(self._summary, summary_file, indent=2)
+
+    def _write_stats(self) -> None:
+        self._profiler.dump_stats(self._run_dir / "profile.prof")
+        report = io.StringIO()
+        pstats.Stats(self._profiler, stream=report).sort_stats("cumulative").print_stats(50)
+        (self._run_dir / "profile.txt").write_text(report.getvalue(), encoding="utf-8")
+
+
+_session = _ProfileSession()
+
+
+def configure_from_argv(argv: list[str] = sys.argv) -> None:
+    """
+    Legge e rimuove da `argv` le opzioni di profiling degli script:
+    `--profile`, `--profile-dir DIR` e `--profile-perf`.
+
+    Args:
+        argv (list[str], optional): Gli argomenti da analizzare. Defaults to sys.argv.
+    """
+    remaining = [argv[0]] if argv else []
+    args = iter(argv[1:])
+    for arg in args:
+        if arg == "--profile":
+            _Settings.enabled = True
+        elif arg == "--profile-perf":
+            _Settings.enabled = True
+            _Settings.perf = True
+        elif arg == "--profile-dir":
+            _Settings.enabled = True
+            _Settings.directory = Path(next(args, _Settings.directory))
+        elif arg.startswith("--profile-dir="):
+            _Settings.enabled = True
+            _Settings.directory = Path(arg.split("=", 1)[1])
+        else:
+            remaining.append(arg)
+    argv[:] = remaining
+
+
+def is_enabled() -> bool:
+    return _Settings.enabled
+
+
+@contextmanager
+def profile_section(name: str):
+    """
+    Esegue il blocco sotto il profiler della sessione, registrando tempo reale
+    e tempo CPU del thread corrente.
+
+    Args:
+        name (str): Il nome della sezione negli artefatti.
+    """
+    _session.enter()
+    thread = threading.current_thread()
+    start_monotonic_ns = time.monotonic_ns()
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        _session.exit({
+            "section": name,
+            "thread": thread.name,
+            "native_thread_id": thread.native_id,
+            "start_monotonic_ns": start_monotonic_ns,
+            "end_monotonic_ns": time.monotonic_ns(),
+            "wall_seconds": time.perf_counter() - start_wall,
+            "cpu_seconds": time.thread_time() - start_cpu,
+        })
+
+
+def profiled(name: str | None = None):
+    """
+    Decoratore che esegue la funzione in `profile_section` quando il profiling
+    è abilitato. L'abilitazione viene controllata ad ogni chiamata, così che
+    l'opzione `--profile` abbia effetto anche se letta dopo l'import.
+
+    Args:
+        name (str | None, optional): Il nome della sezione. Defaults al nome qualificato della funzione.
+    """
+    def decorator(func):
+        section = name or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _Settings.enabled:
+                return func(*args, **kwargs)
+            with profile_section(section):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,192 @@
+"""
+Verifica della catena limitata ad una finestra temporale o ad un intervallo di ID.
+
+Un audit del tipo "le firme di marzo sono integre?" non richiede di rileggere
+l'intera catena: `verify_range` legge con un cursore lato server solo i blocchi
+con `signed_at` nella finestra (indici `signature_chain_signed_at_idx` e
+`signature_chain_document_signed_at_idx`) e, per ogni documento, ancora il
+collegamento del primo blocco della finestra alla firma del blocco che lo
+precede, letta con una query per indice. Il costo è proporzionale ai blocchi
+nella finestra, non alla dimensione della tabella.
+
+Le firme vengono verificate con le chiavi del registro `signer_keys`. Se il
+predecessore di un blocco è stato archiviato (vedi `archive.py`), l'ancora si
+legge dai segmenti archiviati.
+"""
+import argparse
+from datetime import datetime
+import os
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+import psycopg2
+
+from key_registry import KeyResolver
+from metrics import VERIFY_SECONDS, cursor_factory, timed
+
+_BLOCK_COLUMNS = "id, document_id, signer, signed_at, document_hash, prev_hash, signature, key_id"
+
+
+def anchor_signature(cursor, document_id, block_id: int, prev_hash: str | None = None,
+                     archived_heads=None) -> str | None:
+    """
+    Restituisce la firma a cui deve collegarsi il blocco `block_id`: quella
+    dell'ultimo blocco precedente dello stesso documento. Se il documento non
+    ha blocchi precedenti e `prev_hash` non è NULL, il blocco è collegato alla
+    catena globale (come in main.py) e vale la firma del blocco precedente in assoluto.
+
+    I blocchi archiviati non sono più in tabella: con `archived_heads`, se il
+    predecessore non è in tabella e il blocco segue il confine dell'archivio,
+    viene cercato nei segmenti archiviati.
+
+    Args:
+        cursor: Un cursore psycopg2.
+        document_id: Il documento del blocco.
+        block_id (int): L'ID del blocco.
+        prev_hash (str | None, optional): Il prev_hash registrato nel blocco. Defaults to None.
+        archived_heads (archive.ArchivedHeads | None, optional): Le firme dei segmenti archiviati.
+                                                                 Defaults to None (solo la tabella).
+
+    Returns:
+        str | None: La firma attesa come prev_hash; None per un blocco genesi.
+    """
+    cursor.execute(
+        "SELECT signature FROM signature_chain WHERE document_id = %s AND id < %s ORDER BY id DESC LIMIT 1",
+        (document_id, block_id))
+    previous = cursor.fetchone()
+    if previous is not None:
+        return previous[0]
+    archived = archived_heads is not None and 0 < archived_heads.boundary(cursor.connection) < block_id
+    if archived:
+        signature = archived_heads.document_signature(cursor.connection, document_id)
+        if signature is not None:
+            return signature
+    if prev_hash is None:
+        return None
+    cursor.execute("SELECT signature FROM signature_chain WHERE id < %s ORDER BY id DESC LIMIT 1", (block_id,))
+    previous = cursor.fetchone()
+    if previous is not None:
+        return previous[0]
+    return archived_heads.last_signature(cursor.connection) if archived else None
+
+
+def verify_range(conn, document_id: str | None, start: datetime, end: datetime,
+                 key_resolver: KeyResolver | None = None, batch_size: int = 5000, archive=None) -> dict:
+    """
+    Verifica collegamenti e firme dei blocchi con `signed_at` in [start, end).
+
+    Args:
+        conn: La connessione al database psycopg2.
+        document_id (str | None): Il documento da verificare; None per tutti i documenti.
+        start (datetime): Inizio della finestra (incluso).
+        end (datetime): Fine della finestra (escluso).
+        key_resolver (KeyResolver | None, optional): Il resolver delle chiavi. Defaults a un
+                                                     KeyResolver su `conn`.
+        batch_size (int, optional): Blocchi letti per round trip. Defaults to 5000.
+        archive (archive.ChainArchive | None, optional): L'archivio da cui ancorare i blocchi il
+                                                         cui predecessore è archiviato.
+                                                         Defaults a `archive.ChainArchive()`.
+
+    Returns:
+        dict: {"valid", "verified_blocks", "first_block_id", "last_block_id", "anchors", "errors"}.
+    """
+    return _verify_window(conn, "signed_at >= %s AND signed_at < %s", (start, end), document_id,
+                          key_resolver, batch_size, archive)
+
+
+def verify_id_range(conn, document_id: str | None, first_block_id: int, last_block_id: int,
+                    key_resolver: KeyResolver | None = None, batch_size: int = 5000, archive=None) -> dict:
+    """
+    Come `verify_range`, per i blocchi con ID in [first_block_id, last_block_id].
+    """
+    return _verify_window(conn, "id BETWEEN %s AND %s", (first_block_id, last_block_id), document_id,
+                          key_resolver, batch_size, archive)
+
+
+def _verify_window(conn, condition: str, params: tuple, document_id, key_resolver, batch_size, archive) -> dict:
+    # Import locale: archive.py dipende (tramite checkpoints.py e main.py) da questo modulo.
+    from archive import ArchivedHeads
+
+    key_resolver = key_resolver or KeyResolver(conn)
+    archived_heads = ArchivedHeads(archive)
+    if document_id is not None:
+        condition = "document_id = %s AND " + condition
+        params = (document_id, *params)
+
+    heads = {}
+    errors = []
+    verified, anchors = 0, 0
+    first_block_id = last_block_id = None
+
+    with conn.cursor(name="range_audit", withhold=conn.autocommit) as rows_cursor, conn.cursor() as cursor:
+        rows_cursor.execute(f"SELECT {_BLOCK_COLUMNS} FROM signature_chain_blocks WHERE {condition} ORDER BY id", params)
+        while rows := rows_cursor.fetchmany(batch_size):
+            key_resolver.prefetch_blocks((row[2], row[7]) for row in rows)
+            for block_id, block_document_id, signer, signed_at, document_hash, prev_hash, signature, key_id in rows:
+                if first_block_id is None:
+                    first_block_id = block_id
+                last_block_id = block_id
+
+                if block_document_id not in heads:
+                    heads[block_document_id] = anchor_signature(cursor, block_document_id, block_id, prev_hash,
+                                                                archived_heads)
+                    anchors += 1
+                if prev_hash != heads[block_document_id] and \
+                        prev_hash != anchor_signature(cursor, block_document_id, block_id, prev_hash,
+                                                      archived_heads):
+                    # Il secondo controllo copre i blocchi fuori finestra intercalati
+                    # (signed_at non monotono rispetto all'ID).
+                    errors.append({"block_id": block_id, "error": "prev_hash non collegato al blocco precedente"})
+
+                public_key = key_resolver.resolve(signer, key_id, signed_at)
+                if public_key is None:
+                    errors.append({"block_id": block_id, "error": f"chiave pubblica assente per '{signer}'"})
+                else:
+                    try:
+                        with timed(VERIFY_SECONDS):
+                            public_key.verify(bytes.fromhex(signature),
+                                              (prev_hash or '').encode() + document_hash.encode(),
+                                              padding.PKCS1v15(), hashes.SHA256())
+                    except (InvalidSignature, ValueError):
+                        errors.append({"block_id": block_id, "error": "firma non valida"})
+
+                heads[block_document_id] = signature
+                verified += 1
+
+    if not conn.autocommit:
+        conn.rollback()
+    return {"valid": not errors, "verified_blocks": verified, "first_block_id": first_block_id,
+            "last_block_id": last_block_id, "anchors": anchors, "errors": errors}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verifica della catena in una finestra temporale o di ID.")
+    parser.add_argument("--document", help="document_id da verificare; default: tutti i documenti")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="inizio della finestra (ISO 8601, incluso)")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="fine della finestra (ISO 8601, escluso)")
+    parser.add_argument("--first-id", type=int)
+    parser.add_argument("--last-id", type=int)
+    args = parser.parse_args()
+    if (args.start is None) == (args.first_id is None):
+        parser.error("indicare --start/--end oppure --first-id/--last-id")
+
+    connection = psycopg2.connect(dbname=os.environ.get("DB_NAME", "signature_demo"),
+                                  user=os.environ.get("APP_DB_USER", "app_user"),
+                                  password=os.environ.get("APP_DB_PASSWORD", "app_password"),
+                                  host=os.environ.get("DB_HOST", "localhost"),
+                                  cursor_factory=cursor_factory())
+    try:
+        if args.start is not None:
+            result = verify_range(connection, args.document, args.start, args.end or datetime.max)
+        else:
+            result = verify_id_range(connection, args.document, args.first_id,
+                                     args.last_id if args.last_id is not None else 2**31 - 1)
+    finally:
+        connection.close()
+
+    print(f"Blocchi verificati: {result['verified_blocks']} (ID {result['first_block_id']}-{result['last_block_id']}, "
+          f"{result['anchors']} ancoraggi).")
+    for error in result["errors"]:
+        print(f"  ERRORE blocco {error['block_id']}: {error['error']}")
+    print("Finestra VALIDA." if result["valid"] else f"Finestra NON valida: {len(result['errors'])} errori.")
@@ -0,0 +1,10 @@
+#!/bin/bash
+# Eseguito da docker-entrypoint-initdb.d al primo avvio del primario:
+# crea l'utente di replica e consente le connessioni di replica in pg_hba.conf.
+set -e
+
+psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
+    CREATE ROLE ${REPLICATION_USER:-replicator} WITH REPLICATION LOGIN PASSWORD '${REPLICATION_PASSWORD:-replicator_password}';
+EOSQL
+
+echo "host replication ${REPLICATION_USER:-replicator} all scram-sha-256" >> "$PGDATA/pg_hba.conf"
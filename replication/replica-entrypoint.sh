@@ -0,0 +1,21 @@
+#!/bin/bash
+# Entrypoint della replica in streaming: al primo avvio clona il primario con
+# pg_basebackup (-R scrive primary_conninfo e standby.signal), poi avvia
+# PostgreSQL tramite l'entrypoint standard dell'immagine.
+set -e
+
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+    until pg_isready -h "$PRIMARY_HOST" -p "${PRIMARY_PORT:-5432}" -q; do
+        echo "In attesa del primario $PRIMARY_HOST..."
+        sleep 1
+    done
+
+    mkdir -p "$PGDATA"
+    chown postgres:postgres "$PGDATA"
+    chmod 700 "$PGDATA"
+    gosu postgres env PGPASSWORD="$REPLICATION_PASSWORD" pg_basebackup \
+        -h "$PRIMARY_HOST" -p "${PRIMARY_PORT:-5432}" -U "$REPLICATION_USER" \
+        -D "$PGDATA" -R -X stream -P
+fi
+
+exec docker-entrypoint.sh postgres
@@ -0,0 +1,419 @@
+"""
+Servizio HTTP locale per append e verifica della catena di firme.
+
+A differenza degli script dimostrativi, il servizio è un processo di lunga
+durata che mantiene "calde" tra una richiesta e l'altra le risorse costose:
+le chiavi dei firmatari (lette e analizzate una sola volta all'avvio), un pool
+di connessioni al database e una cache delle verifiche già eseguite, così che
+una nuova verifica di un documento controlli solo i blocchi aggiunti nel
+frattempo.
+
+Endpoint:
+    POST /documents/{id}/signatures  {"signer": "...", "document": "..."}
+                                     (oppure "document_hash" al posto di "document";
+                                     "hash_algorithm" opzionale, default "sha256";
+                                     "request_id" opzionale: ripetendolo si riceve il blocco
+                                     già inserito, con 200 e "replayed": true; 409 se il
+                                     request_id è stato usato per una richiesta diversa)
+    GET  /documents/{id}/verify      (?full=1 per ignorare la cache)
+    GET  /metrics                    (metriche Prometheus, con SIGNATURE_CHAIN_METRICS=1)
+    GET  /locks                      (documenti più contesi: attese e rifiuti per chiave di lock)
+    GET  /admission                  (limiti, richieste in corso e in coda, rifiuti del controllo di ammissione)
+
+Con `LOCK_POLICY=try|timeout` (vedi `LockPolicy`) un append su un documento
+conteso oltre `LOCK_MAX_WAIT_SECONDS` viene rifiutato con 503 invece di tenere
+occupata una connessione del pool.
+
+Le richieste prendono le connessioni del pool attraverso il controllo di
+ammissione (`admission.py`): non più richieste in corso delle connessioni del
+pool, non più di ADMISSION_MAX_PER_DOCUMENT append sullo stesso documento, e
+una coda d'attesa limitata. Le richieste in eccesso ricevono 503 con
+Retry-After; lo stato è su `GET /admission`.
+
+Uso:
+    python service.py --keys-dir keys --generate-signers Antonio,Marianna,Claudio
+    python service.py --keys-dir keys --port 8000
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import os
+from pathlib import Path
+import re
+import threading
+from uuid import UUID
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+from admission import AdmissionController, AdmissionRejected
+from archive import ArchivedHeads, ChainArchive
+from idempotency import RequestIdConflict, recent_requests
+from main import generate_keys
+from metrics import SIGN_SECONDS, VERIFY_SECONDS, cursor_factory, instrumented, render_prometheus
+from mthread_advisory_lock import LockBusyError, LockPolicy, call_append_block, lock_telemetry
+from prepared_statements import HEAD_BY_DOCUMENT, execute_prepared
+from signature_chain import core
+from snapshot_audit import read_only_snapshot
+
+db_name = os.environ.get("DB_NAME", "signature_demo")
+db_user = os.environ.get("APP_DB_USER", "app_user")
+db_password = os.environ.get("APP_DB_PASSWORD", "app_password")
+db_host = os.environ.get("DB_HOST", "localhost")
+
+SIGNATURES_PATH = re.compile(r"^/documents/([^/]+)/signatures$")
+VERIFY_PATH = re.compile(r"^/documents/([^/]+)/verify$")
+HEX_DIGEST = re.compile(r"^[0-9a-f]+$")
+
+
+class SignerKeys:
+    """
+    Chiavi dei firmatari lette da una directory e analizzate una sola volta.
+
+    Per ogni firmatario la directory contiene `<nome>.key.pem` (chiave privata,
+    necessaria per firmare tramite il servizio) e `<nome>.pub.pem` (chiave
+    pubblica, necessaria per verificare).
+    """
+
+    def __init__(self, keys_dir: Path):
+        self.private_keys = {}
+        self.public_keys = {}
+
+        for path in sorted(keys_dir.glob("*.key.pem")):
+            self.private_keys[path.name.removesuffix(".key.pem")] = \
+                serialization.load_pem_private_key(path.read_bytes(), password=None)
+
+        for path in sorted(keys_dir.glob("*.pub.pem")):
+            self.public_keys[path.name.removesuffix(".pub.pem")] = \
+                serialization.load_pem_public_key(path.read_bytes())
+
+    @staticmethod
+    def generate(keys_dir: Path, signers: list[str]) -> None:
+        """
+        Genera e salva nella directory una coppia di chiavi per ogni firmatario.
+
+        Args:
+            keys_dir (Path): La directory delle chiavi.
+            signers (list[str]): I nomi dei firmatari.
+        """
+        keys_dir.mkdir(parents=True, exist_ok=True)
+        for signer in signers:
+            pem_private, pem_public = generate_keys()
+            (keys_dir / f"{signer}.key.pem").write_bytes(pem_private)
+            (keys_dir / f"{signer}.pub.pem").write_bytes(pem_public)
+
+    @instrumented(SIGN_SECONDS)
+    def sign(self, signer: str, data: bytes) -> str:
+        return self.private_keys[signer].sign(data, padding.PKCS1v15(), hashes.SHA256()).hex()
+
+    @instrumented(VERIFY_SECONDS)
+    def verify(self, signer: str, data: bytes, signature_hex: str) -> bool:
+        try:
+            self.public_keys[signer].verify(
+                bytes.fromhex(signature_hex), data, padding.PKCS1v15(), hashes.SHA256())
+            return True
+        except (InvalidSignature, ValueError):
+            return False
+
+
+class VerificationCache:
+    """
+    Stato dell'ultima verifica di ciascun documento: ID e firma dell'ultimo
+    blocco verificato, numero di blocchi ed esito. Una verifica successiva
+    riparte dall'ultimo blocco verificato invece che dal blocco genesi.
+
+    La cache assume che i blocchi già verificati non cambino: grazie ai vincoli
+    RLS l'utente applicativo non può modificarli, ma una manomissione eseguita
+    da un superutente viene rilevata solo con una verifica completa (`?full=1`).
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, document_id: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(document_id)
+            # Copia anche la lista degli errori: la verifica la estende sul posto.
+            return dict(entry, errors=list(entry["errors"])) if entry else None
+
+    def put(self, document_id: str, entry: dict) -> None:
+        with self._lock:
+            self._entries[document_id] = entry
+
+
+class SignatureChainService:
+    """
+    Logica del servizio, indipendente dal livello HTTP.
+    """
+
+    def __init__(self, pool: ThreadedConnectionPool, keys: SignerKeys, max_attempts: int = 5,
+                 lock_policy: LockPolicy | None = None, admission: AdmissionController | None = None,
+                 archive: ChainArchive | None = None):
+        self.pool = pool
+        self.keys = keys
+        self.cache = VerificationCache()
+        # Firme archiviate a cui ancorare il primo blocco rimasto in tabella (vedi archive.py).
+        self.archived_heads = ArchivedHeads(archive)
+        self._archived_heads_lock = threading.Lock()
+        self.max_attempts = max_attempts
+        self.lock_policy = lock_policy
+        # Il limite globale coincide con le connessioni del pool: getconn non fallisce mai per pool esaurito.
+        self.admission = admission or AdmissionController(max_in_flight=pool.maxconn)
+
+    def append(self, document_id: str, signer: str, document_hash: str,
+               hash_algorithm: str = core.DEFAULT_HASH_ALGORITHM, request_id: str | None = None) -> dict:
+        """
+        Aggiunge un blocco firmato da `signer` alla catena del documento tramite
+        la stored procedure `append_block`, rifirmando in caso di conflitto.
+        `hash_algorithm` è l'algoritmo con cui è stato calcolato `document_hash`.
+        Se il blocco di `request_id` è già stato inserito, viene restituito quello
+        (status 200, "replayed"); se quel blocco ha firmatario, hash o algoritmo
+        diversi, il request_id è stato riusato e la risposta è 409.
+
+        Returns:
+            dict: L'esito dell'append (status HTTP e corpo della risposta).
+        """
+        if signer not in self.keys.private_keys:
+            return {"status": 404, "error": f"Chiave privata non disponibile per '{signer}'."}
+
+        try:
+            # Una ripetizione ravvicinata non richiede né ammissione, né connessione, né firma.
+            if request_id is not None:
+                cached = recent_requests.get(document_id, request_id, signer, document_hash, hash_algorithm)
+                if cached is not None:
+                    return {"status": 200, "block_id": cached[0], "replayed": True,
+                            "request_id": request_id, "signature": cached[1]}
+
+            with self.admission.connection(self.pool, document_id) as conn:
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    execute_prepared(cur, HEAD_BY_DOCUMENT, (document_id,))
+                    row = cur.fetchone()
+                    prev_hash = row[0] if row else None
+
+                    for attempt in range(1, self.max_attempts + 1):
+                        signature = self.keys.sign(signer, (prev_hash or '').encode() + document_hash.encode())
+                        try:
+                            block_id, current_head, replayed = call_append_block(
+                                cur, document_id, signer, document_hash, prev_hash, signature,
+                                lock_policy=self.lock_policy, hash_algorithm=hash_algorithm,
+                                request_id=request_id)
+                        except LockBusyError as error:
+                            return {"status": 503, "error": f"Documento occupato, riprovare: {error}"}
+                        if replayed:
+                            return {"status": 200, "block_id": block_id, "replayed": True,
+                                    "request_id": request_id, "signature": current_head}
+                        if block_id is not None:
+                            return {"status": 201, "block_id": block_id, "attempts": attempt,
+                                    "prev_hash": prev_hash, "signature": signature}
+                        prev_hash = current_head
+        except AdmissionRejected as error:
+            return self._overloaded(error)
+        except RequestIdConflict as error:
+            return {"status": 409, "error": str(error), "request_id": request_id}
+
+        return {"status": 409, "error": f"Testa della catena cambiata ad ogni tentativo ({self.max_attempts})."}
+
+    def verify(self, document_id: str, full: bool = False) -> dict:
+        """
+        Verifica la catena del documento, a partire dall'ultimo blocco già
+        verificato se presente in cache e `full` è False. Se i blocchi del
+        documento fino a quel punto sono stati archiviati, la verifica riparte
+        dall'ultima firma archiviata del documento.
+
+        Returns:
+            dict: L'esito della verifica (status HTTP e corpo della risposta).
+        """
+        entry = None if full else self.cache.get(document_id)
+        if entry is None:
+            entry = {"last_id": 0, "head": None, "blocks": 0, "valid": True, "errors": []}
+
+        try:
+            # Le verifiche contano solo verso il limite globale.
+            with self.admission.connection(self.pool) as conn:
+                conn.autocommit = True
+                # Archivio e blocchi letti dallo stesso snapshot: un'archiviazione concorrente
+                # non può togliere blocchi tra la lettura dell'ancora e quella della tabella.
+                with read_only_snapshot(conn):
+                    with self._archived_heads_lock:
+                        if entry["last_id"] < self.archived_heads.boundary(conn):
+                            entry["head"] = self.archived_heads.document_signature(conn, document_id)
+                    with conn.cursor() as cur:
+                        cur.execute(
+                            "SELECT id, signer, document_hash, prev_hash, signature FROM signature_chain_blocks "
+                            "WHERE document_id = %s AND id > %s ORDER BY id",
+                            (document_id, entry["last_id"]))
+                        rows = cur.fetchall()
+        except AdmissionRejected as error:
+            return self._overloaded(error)
+
+        for record_id, signer, doc_hash, prev_hash, signature in rows:
+            if prev_hash != entry["head"]:
+                entry["valid"] = False
+                entry["errors"].append({"block_id": record_id, "error": "prev_hash non collegato al blocco precedente"})
+            if signer not in self.keys.public_keys:
+                entry["valid"] = False
+                entry["errors"].append({"block_id": record_id, "error": f"chiave pubblica assente per '{signer}'"})
+            elif not self.keys.verify(signer, (prev_hash or '').encode() + doc_hash.encode(), signature):
+                entry["valid"] = False
+                entry["errors"].append({"block_id": record_id, "error": "firma non valida"})
+            entry["last_id"] = record_id
+            entry["head"] = signature
+            entry["blocks"] += 1
+
+        self.cache.put(document_id, entry)
+
+        return {"status": 200, "document_id": document_id, "valid": entry["valid"],
+                "blocks": entry["blocks"], "verified_now": len(rows), "errors": entry["errors"]}
+
+    def _overloaded(self, error: AdmissionRejected) -> dict:
+        return {"status": 503, "error": f"Servizio sovraccarico, riprovare: {error}", "reason": error.reason,
+                "retry_after": max(1, math.ceil(self.admission.max_wait))}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Handler HTTP: traduce le richieste negli metodi di `SignatureChainService`.
+    """
+    protocol_version = "HTTP/1.1"
+    service: SignatureChainService = None
+
+    def do_POST(self):
+        match = SIGNATURES_PATH.match(self.path)
+        if not match:
+            return self._reply({"status": 404, "error": "Risorsa non trovata."})
+
+        document_id = self._document_id(match.group(1))
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            return self._reply({"status": 400, "error": "Corpo JSON non valido."})
+        if not isinstance(body, dict):
+            return self._reply({"status": 400, "error": "Il corpo JSON deve essere un oggetto."})
+
+        signer = body.get("signer")
+        document_hash = body.get("document_hash")
+        hash_algorithm = body.get("hash_algorithm", core.DEFAULT_HASH_ALGORITHM)
+        if not isinstance(hash_algorithm, str) or hash_algorithm not in core.HASH_ALGORITHMS:
+            return self._reply({"status": 400, "error": f"'hash_algorithm' deve essere uno tra: "
+                                                        f"{', '.join(core.HASH_ALGORITHMS)}."})
+        if signer is not None and not isinstance(signer, str):
+            return self._reply({"status": 400, "error": "'signer' deve essere una stringa."})
+        if document_hash is not None:
+            digest_length = core.new_hasher(hash_algorithm).digest_size * 2
+            if not isinstance(document_hash, str) or len(document_hash) != digest_length \
+                    or not HEX_DIGEST.match(document_hash):
+                return self._reply({"status": 400, "error": f"'document_hash' deve essere il digest {hash_algorithm} "
+                                                            f"in esadecimale minuscolo ({digest_length} caratteri)."})
+        elif "document" in body:
+            if not isinstance(body["document"], str):
+                return self._reply({"status": 400, "error": "'document' deve essere una stringa."})
+            document_hash = core.hash_document(body["document"], hash_algorithm)
+        if document_id is None or not signer or not document_hash:
+            return self._reply({"status": 400, "error": "Servono un document_id UUID, 'signer' e 'document' o 'document_hash'."})
+        request_id = body.get("request_id")
+        if request_id is not None and (not isinstance(request_id, str) or not 0 < len(request_id) <= 128):
+            return self._reply({"status": 400, "error": "'request_id' deve essere una stringa di 1-128 caratteri."})
+
+        self._reply(self._guard(lambda: self.service.append(document_id, signer, document_hash, hash_algorithm,
+                                                            request_id)))
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if path == "/metrics":
+            return self._reply_text(render_prometheus())
+        if path == "/locks":
+            return self._reply({"status": 200, "locks": lock_telemetry.snapshot(top=20)})
+        if path == "/admission":
+            return self._reply({"status": 200, **self.service.admission.snapshot()})
+
+        match = VERIFY_PATH.match(path)
+        if not match:
+            return self._reply({"status": 404, "error": "Risorsa non trovata."})
+
+        document_id = self._document_id(match.group(1))
+        if document_id is None:
+            return self._reply({"status": 400, "error": "Il document_id deve essere un UUID."})
+
+        full = "full=1" in query.split("&")
+        self._reply(self._guard(lambda: self.service.verify(document_id, full)))
+
+    @staticmethod
+    def _document_id(raw: str) -> str | None:
+        try:
+            return str(UUID(raw))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _guard(action) -> dict:
+        try:
+            return action()
+        except psycopg2.Error as error:
+            return {"status": 503, "error": f"Errore database: {error}"}
+
+    def _reply(self, result: dict) -> None:
+        status = result.pop("status")
+        retry_after = result.pop("retry_after", None)
+        payload = json.dumps(result).encode()
+        self.send_response(status)
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _reply_text(self, text: str) -> None:
+        payload = text.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # Il logging per richiesta falserebbe le misure di carico.
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servizio HTTP di append e verifica della catena di firme.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--keys-dir", type=Path, default=Path("keys"))
+    parser.add_argument("--generate-signers", default="",
+                        help="nomi separati da virgola: genera le chiavi nella directory ed esce")
+    parser.add_argument("--pool-min", type=int, default=2)
+    parser.add_argument("--pool-max", type=int, default=16)
+    args = parser.parse_args()
+
+    if args.generate_signers:
+        signers = [name.strip() for name in args.generate_signers.split(",") if name.strip()]
+        SignerKeys.generate(args.keys_dir, signers)
+        print(f"Chiavi generate in '{args.keys_dir}' per: {', '.join(signers)}")
+        raise SystemExit(0)
+
+    keys = SignerKeys(args.keys_dir)
+    pool = ThreadedConnectionPool(args.pool_min, args.pool_max, dbname=db_name, user=db_user,
+                                  password=db_password, host=db_host, cursor_factory=cursor_factory())
+    RequestHandler.service = SignatureChainService(pool, keys, lock_policy=LockPolicy.from_env(),
+                                                   admission=AdmissionController.from_env(args.pool_max))
+
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    server.daemon_threads = True
+    print(f"Servizio in ascolto su http://{args.host}:{args.port} "
+          f"({len(keys.private_keys)} chiavi private, {len(keys.public_keys)} chiavi pubbliche, "
+          f"pool {args.pool_min}-{args.pool_max} connessioni).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.closeall()
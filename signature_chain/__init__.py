@@ -0,0 +1,17 @@
+"""
+Catena di firme digitali su PostgreSQL.
+
+Il pacchetto raccoglie le primitive condivise (`signature_chain.core`) e la
+riga di comando `signature-chain` (`signature_chain.cli`). Gli script e i
+moduli di primo livello del repository (verifiche, archiviazione, servizio)
+usano le stesse primitive.
+"""
+from signature_chain.core import (DEFAULT_HASH_ALGORITHM, HASH_ALGORITHMS, generate_advisory_lock_key,
+                                  generate_keys, hash_document, sign_data, signing_input, verify_signature)
+from signature_chain.hash_cache import DocumentHashCache, document_hash_cache
+
+__version__ = "0.1.0"
+
+__all__ = ["DEFAULT_HASH_ALGORITHM", "HASH_ALGORITHMS", "DocumentHashCache", "document_hash_cache",
+           "generate_advisory_lock_key", "generate_keys", "hash_document", "sign_data", "signing_input",
+           "verify_signature", "__version__"]
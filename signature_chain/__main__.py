@@ -0,0 +1,3 @@
+from signature_chain.cli import main
+
+raise SystemExit(main())
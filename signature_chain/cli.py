@@ -0,0 +1,293 @@
+"""
+Riga di comando `signature-chain`.
+
+Sottocomandi:
+    append   aggiunge un blocco firmato alla catena di un documento (`append_block`)
+    verify   verifica collegamenti e firme, per documento e/o finestra temporale o di ID,
+             anche in parallelo su uno snapshot (`--workers`)
+    forks    elenca le biforcazioni (blocchi con lo stesso prev_hash)
+    export   esporta i blocchi in CSV o JSON Lines
+    bench    misura hash, firma e verifica in locale, senza database
+
+Le dipendenze pesanti (`psycopg2`, `cryptography` e i moduli che le usano)
+vengono importate solo dal sottocomando che le richiede: `--help` e `bench
+hash` partono in poche decine di millisecondi.
+
+La connessione usa `--dsn` oppure le variabili d'ambiente DB_NAME, APP_DB_USER,
+APP_DB_PASSWORD e DB_HOST, come gli script del repository.
+"""
+import argparse
+import os
+import sys
+
+from signature_chain.core import DEFAULT_HASH_ALGORITHM, HASH_ALGORITHMS
+
+
+def _connection_params(args) -> dict:
+    if args.dsn:
+        return {"dsn": args.dsn}
+    return {"dbname": os.environ.get("DB_NAME", "signature_demo"),
+            "user": os.environ.get("APP_DB_USER", "app_user"),
+            "password": os.environ.get("APP_DB_PASSWORD", "app_password"),
+            "host": os.environ.get("DB_HOST", "localhost")}
+
+
+def _connect(args):
+    import psycopg2
+
+    from metrics import cursor_factory
+
+    return psycopg2.connect(**_connection_params(args), cursor_factory=cursor_factory())
+
+
+def cmd_append(args) -> int:
+    import json
+
+    from idempotency import RequestIdConflict
+    from mthread_advisory_lock import LockBusyError, LockPolicy, call_append_block
+    from prepared_statements import HEAD_BY_DOCUMENT, execute_prepared
+    from signature_chain.core import hash_document, sign_data, signing_input
+    from signature_chain.hash_cache import document_hash_cache
+
+    if args.document_hash:
+        document_hash = args.document_hash
+    elif args.file:
+        document_hash = document_hash_cache.hash_file(args.file, args.hash_algorithm)
+    else:
+        document_hash = hash_document(args.content, args.hash_algorithm)
+    with open(args.private_key, "rb") as key_file:
+        private_key_pem = key_file.read()
+    lock_policy = LockPolicy(args.lock_policy, args.lock_max_wait)
+
+    conn = _connect(args)
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            execute_prepared(cursor, HEAD_BY_DOCUMENT, (args.document_id,))
+            row = cursor.fetchone()
+            prev_hash = row[0] if row else None
+            for attempt in range(1, args.max_attempts + 1):
+                signature = sign_data(signing_input(prev_hash, document_hash), private_key_pem)
+                try:
+                    block_id, current_head, replayed = call_append_block(
+                        cursor, args.document_id, args.signer, document_hash, prev_hash, signature,
+                        args.key_id, lock_policy=lock_policy, hash_algorithm=args.hash_algorithm,
+                        request_id=args.request_id)
+                except LockBusyError as error:
+                    print(f"Documento occupato: {error}", file=sys.stderr)
+                    return 75
+                except RequestIdConflict as error:
+                    print(f"Richiesta rifiutata: {error}", file=sys.stderr)
+                    return 1
+                if replayed:
+                    # Richiesta già eseguita: il blocco esistente, con la sua firma.
+                    print(json.dumps({"block_id": block_id, "document_id": args.document_id, "replayed": True,
+                                      "request_id": args.request_id, "signature": current_head}))
+                    return 0
+                if block_id is not None:
+                    print(json.dumps({"block_id": block_id, "document_id": args.document_id, "attempts": attempt,
+                                      "document_hash": document_hash, "hash_algorithm": args.hash_algorithm,
+                                      "signature": signature}))
+                    return 0
+                prev_hash = current_head
+    finally:
+        conn.close()
+    print(f"Testa della catena cambiata ad ogni tentativo ({args.max_attempts}).", file=sys.stderr)
+    return 1
+
+
+def cmd_verify(args) -> int:
+    if args.workers > 1:
+        from snapshot_audit import verify_snapshot
+
+        if args.start or args.end or args.first_id or args.last_id is not None:
+            print("--workers verifica l'intera catena: non è compatibile con --start, --end, --first-id e --last-id.",
+                  file=sys.stderr)
+            return 2
+        result = verify_snapshot(_connection_params(args), args.document_id, args.workers)
+        return _report_verify(args, result)
+
+    from range_audit import verify_id_range, verify_range
+
+    conn = _connect(args)
+    try:
+        if args.start or args.end:
+            from datetime import datetime
+
+            result = verify_range(conn, args.document_id,
+                                  datetime.fromisoformat(args.start) if args.start else datetime.min,
+                                  datetime.fromisoformat(args.end) if args.end else datetime.max)
+        else:
+            result = verify_id_range(conn, args.document_id, args.first_id,
+                                     args.last_id if args.last_id is not None else 2**31 - 1)
+    finally:
+        conn.close()
+    return _report_verify(args, result)
+
+
+def _report_verify(args, result: dict) -> int:
+    import json
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(f"Blocchi verificati: {result['verified_blocks']} "
+              f"(ID {result['first_block_id']}-{result['last_block_id']}).")
+        for error in result["errors"]:
+            print(f"  ERRORE blocco {error['block_id']}: {error['error']}")
+        print("Catena VALIDA." if result["valid"] else f"Catena NON valida: {len(result['errors'])} errori.")
+    return 0 if result["valid"] else 1
+
+
+def cmd_forks(args) -> int:
+    conn = _connect(args)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT document_id, prev_hash, array_agg(id ORDER BY id)
+                FROM signature_chain
+                WHERE prev_hash IS NOT NULL AND (%(document_id)s::uuid IS NULL OR document_id = %(document_id)s::uuid)
+                GROUP BY document_id, prev_hash
+                HAVING count(*) > 1
+                ORDER BY min(id)
+                """,
+                {"document_id": args.document_id})
+            forks = cursor.fetchall()
+    finally:
+        conn.close()
+
+    for document_id, prev_hash, block_ids in forks:
+        print(f"Documento {document_id}: prev_hash {prev_hash[:16]}... condiviso dai blocchi "
+              f"{', '.join(map(str, block_ids))}")
+    print(f"{len(forks)} biforcazioni." if forks else "Nessuna biforcazione rilevata.")
+    return 1 if forks else 0
+
+
+def cmd_export(args) -> int:
+    from chain_segment import COLUMNS
+
+    output = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+    conn = _connect(args)
+    try:
+        with conn.cursor() as cursor:
+            query = cursor.mogrify(
+                f"SELECT {COLUMNS} FROM signature_chain_blocks "
+                "WHERE (%(document_id)s::uuid IS NULL OR document_id = %(document_id)s::uuid) ORDER BY id",
+                {"document_id": args.document_id}).decode()
+            if args.format == "csv":
+                cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", output)
+                return 0
+
+        import json
+
+        names = [name.strip() for name in COLUMNS.split(",")]
+        with conn.cursor(name="signature_chain_export") as cursor:
+            cursor.itersize = 10000
+            cursor.execute(query)
+            for row in cursor:
+                output.write(json.dumps(dict(zip(names, row)), default=str) + "\n")
+        return 0
+    finally:
+        conn.close()
+        if output is not sys.stdout:
+            output.close()
+
+
+def cmd_bench(args) -> int:
+    import functools
+    import time
+
+    from signature_chain import core
+
+    data = os.urandom(args.size)
+    operations = ["hash", "sign", "verify"] if args.operation == "all" else [args.operation]
+    if "sign" in operations or "verify" in operations:
+        private_key_pem, public_key_pem = core.generate_keys(args.key_size)
+        signature = core.sign_data(data, private_key_pem)
+
+    runs = []
+    for operation in operations:
+        if operation == "hash":
+            runs.extend((f"hash {algorithm}", functools.partial(core.hash_document, data, algorithm))
+                        for algorithm in HASH_ALGORITHMS)
+        elif operation == "sign":
+            runs.append(("sign", functools.partial(core.sign_data, data, private_key_pem)))
+        else:
+            runs.append(("verify", functools.partial(core.verify_signature, data, signature, public_key_pem)))
+
+    for label, run in runs:
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            run()
+        elapsed = time.perf_counter() - start
+        print(f"{label:17s} {args.iterations / elapsed:12.0f} op/s  {elapsed / args.iterations * 1e6:10.1f} µs/op")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="signature-chain", description="Catena di firme digitali su PostgreSQL.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    database = argparse.ArgumentParser(add_help=False)
+    database.add_argument("--dsn", default=os.environ.get("DB_WRITER_DSN", ""),
+                          help="DSN libpq; default: DB_WRITER_DSN o le variabili DB_*")
+
+    append = subparsers.add_parser("append", parents=[database], help="aggiunge un blocco firmato")
+    append.add_argument("--document-id", required=True)
+    append.add_argument("--signer", required=True)
+    append.add_argument("--private-key", required=True, help="file PEM della chiave privata del firmatario")
+    append.add_argument("--key-id", help="chiave del registro signer_keys")
+    content = append.add_mutually_exclusive_group(required=True)
+    content.add_argument("--content", help="contenuto del documento")
+    content.add_argument("--file", help="file del documento")
+    content.add_argument("--document-hash", help="hash esadecimale già calcolato con --hash-algorithm")
+    append.add_argument("--hash-algorithm", choices=HASH_ALGORITHMS,
+                        default=os.environ.get("DOCUMENT_HASH_ALGORITHM", DEFAULT_HASH_ALGORITHM))
+    append.add_argument("--max-attempts", type=int, default=5)
+    append.add_argument("--request-id",
+                        help="identificativo della richiesta: ripetendo il comando con lo stesso valore "
+                             "non si aggiunge un secondo blocco")
+    append.add_argument("--lock-policy", choices=("block", "try", "timeout"),
+                        default=os.environ.get("LOCK_POLICY", "block"))
+    append.add_argument("--lock-max-wait", type=float, default=float(os.environ.get("LOCK_MAX_WAIT_SECONDS", "2")))
+    append.set_defaults(handler=cmd_append)
+
+    verify = subparsers.add_parser("verify", parents=[database], help="verifica collegamenti e firme")
+    verify.add_argument("--document-id")
+    verify.add_argument("--start", help="inizio della finestra signed_at (ISO 8601, incluso)")
+    verify.add_argument("--end", help="fine della finestra signed_at (ISO 8601, escluso)")
+    verify.add_argument("--first-id", type=int, default=0)
+    verify.add_argument("--last-id", type=int)
+    verify.add_argument("--workers", type=int, default=1,
+                        help="processi che verificano in parallelo lo stesso snapshot (solo catena intera)")
+    verify.add_argument("--json", action="store_true")
+    verify.set_defaults(handler=cmd_verify)
+
+    forks = subparsers.add_parser("forks", parents=[database], help="elenca le biforcazioni")
+    forks.add_argument("--document-id")
+    forks.set_defaults(handler=cmd_forks)
+
+    export = subparsers.add_parser("export", parents=[database], help="esporta i blocchi")
+    export.add_argument("--document-id")
+    export.add_argument("--format", choices=("csv", "jsonl"), default="csv")
+    export.add_argument("--output", help="file di destinazione; default: standard output")
+    export.set_defaults(handler=cmd_export)
+
+    bench = subparsers.add_parser("bench", help="misura hash, firma e verifica (senza database)")
+    bench.add_argument("operation", nargs="?", choices=("hash", "sign", "verify", "all"), default="all")
+    bench.add_argument("--iterations", type=int, default=1000)
+    bench.add_argument("--size", type=int, default=1024, help="byte del documento")
+    bench.add_argument("--key-size", type=int, default=2048)
+    bench.set_defaults(handler=cmd_bench)
+
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,160 @@
+"""
+Primitive condivise della catena di firme: hash dei documenti, dati firmati,
+firma e verifica RSA, generazione delle chiavi e chiave dell'advisory lock.
+
+`cryptography` viene importata alla prima firma, verifica o generazione di
+chiavi, non all'import del modulo: l'hash di un documento non la richiede.
+Le chiavi PEM già analizzate restano in cache, così che firme ripetute con
+la stessa chiave non ripetano il parsing.
+"""
+import functools
+import hashlib
+
+# Algoritmi di hash dei documenti, tutti con digest di 32 byte (64 caratteri
+# esadecimali). SHA-512/256 e BLAKE2b sono più veloci di SHA256 sui processori
+# a 64 bit senza estensioni SHA. L'algoritmo di ogni documento è registrato
+# nella colonna documents.algorithm.
+_HASHERS = {
+    "sha256": hashlib.sha256,
+    "sha512_256": functools.partial(hashlib.new, "sha512_256"),
+    "blake2b": functools.partial(hashlib.blake2b, digest_size=32),
+}
+HASH_ALGORITHMS = tuple(_HASHERS)
+DEFAULT_HASH_ALGORITHM = "sha256"
+
+
+def new_hasher(algorithm: str = DEFAULT_HASH_ALGORITHM):
+    """
+    Restituisce un oggetto hash `hashlib` vuoto per l'algoritmo indicato.
+
+    Raises:
+        ValueError: Se l'algoritmo non è supportato.
+    """
+    try:
+        return _HASHERS[algorithm]()
+    except KeyError:
+        raise ValueError(f"Algoritmo di hash non supportato: {algorithm!r} (disponibili: "
+                         f"{', '.join(HASH_ALGORITHMS)})") from None
+
+
+def hash_document(document: bytes | str, algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
+    """
+    Calcola l'hash di un documento.
+
+    Args:
+        document (bytes | str): Il contenuto del documento; le stringhe sono codificate in UTF-8.
+        algorithm (str, optional): Uno di HASH_ALGORITHMS. Defaults to "sha256".
+
+    Returns:
+        str: L'hash esadecimale.
+
+    Raises:
+        ValueError: Se l'algoritmo non è supportato.
+    """
+    hasher = new_hasher(algorithm)
+    hasher.update(document.encode() if isinstance(document, str) else document)
+    return hasher.hexdigest()
+
+
+def signing_input(prev_hash: str | None, document_hash: str) -> bytes:
+    """
+    Restituisce i dati firmati da un blocco: il prev_hash (vuoto per il blocco
+    genesi) seguito dall'hash del documento.
+    """
+    return (prev_hash or '').encode() + document_hash.encode()
+
+
+@functools.lru_cache(maxsize=256)
+def load_private_key(private_key_pem: bytes):
+    from cryptography.hazmat.primitives import serialization
+
+    return serialization.load_pem_private_key(private_key_pem, password=None)
+
+
+@functools.lru_cache(maxsize=1024)
+def load_public_key(public_key_pem: bytes):
+    from cryptography.hazmat.primitives import serialization
+
+    return serialization.load_pem_public_key(public_key_pem)
+
+
+def sign_data(data: bytes, private_key_pem: bytes) -> str:
+    """
+    Firma i dati con una chiave privata RSA (PKCS#1 v1.5, SHA256).
+
+    Args:
+        data (bytes): I dati da firmare.
+        private_key_pem (bytes): La chiave privata in formato PEM.
+
+    Returns:
+        str: La firma esadecimale.
+    """
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    return load_private_key(private_key_pem).sign(data, padding.PKCS1v15(), hashes.SHA256()).hex()
+
+
+def verify_signature(data: bytes, signature_hex: str, public_key) -> bool:
+    """
+    Verifica una firma RSA (PKCS#1 v1.5, SHA256).
+
+    Args:
+        data (bytes): I dati firmati.
+        signature_hex (str): La firma esadecimale.
+        public_key (bytes | RSAPublicKey): La chiave pubblica in formato PEM, oppure già caricata
+                                           (ad esempio da `KeyResolver`).
+
+    Returns:
+        bool: True se la firma è valida; False se non lo è o non è esadecimale.
+    """
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    if isinstance(public_key, bytes):
+        public_key = load_public_key(public_key)
+    try:
+        public_key.verify(bytes.fromhex(signature_hex), data, padding.PKCS1v15(), hashes.SHA256())
+        return True
+    except (InvalidSignature, ValueError):
+        return False
+
+
+def generate_keys(key_size: int = 2048) -> tuple[bytes, bytes]:
+    """
+    Genera una coppia di chiavi RSA.
+
+    Args:
+        key_size (int, optional): La dimensione della chiave in bit. Defaults to 2048.
+
+    Returns:
+        tuple: (chiave privata PEM PKCS#8, chiave pubblica PEM SubjectPublicKeyInfo).
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    pem_private = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption())
+    pem_public = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo)
+    return pem_private, pem_public
+
+
+def generate_advisory_lock_key(document_id: str) -> int:
+    """
+    Calcola la chiave bigint dell'advisory lock di un documento: i primi 15
+    caratteri esadecimali (60 bit) dello SHA256 del document_id. È la stessa
+    chiave usata dalla funzione `append_block` in init.sql.
+
+    Args:
+        document_id (str): L'ID del documento (stringa UUID).
+
+    Returns:
+        int: La chiave dell'advisory lock.
+    """
+    return int(hashlib.sha256(document_id.encode('utf-8')).hexdigest()[:15], 16)
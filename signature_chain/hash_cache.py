@@ -0,0 +1,134 @@
+"""
+Cache LRU degli hash dei documenti.
+
+Nei flussi con più firmatari lo stesso documento viene firmato più volte
+(`main.py`: tutti i firmatari firmano gli stessi byte) e ricalcolarne l'hash
+ad ogni firma costa quanto leggere l'intero documento. La cache restituisce
+l'hash già calcolato:
+
+- per i documenti in memoria (`bytes` o `str`, immutabili) la chiave è
+  l'identità dell'oggetto, la sua lunghezza e l'algoritmo. La voce conserva un
+  riferimento all'oggetto, così che il suo `id` non possa essere riutilizzato
+  da un altro documento finché la voce è in cache: il confronto `is` rende
+  esatta la corrispondenza senza rileggere il contenuto. Gli oggetti mutabili
+  (`bytearray`, `memoryview`) non vengono messi in cache;
+- per i file la chiave è percorso reale, dispositivo, inode, dimensione e
+  mtime in nanosecondi: un file riscritto cambia chiave e viene ricalcolato.
+
+Le voci sono limitate per numero (`max_entries`) e per byte di documenti in
+memoria trattenuti (`max_bytes`); oltre i limiti si scartano le meno usate.
+"""
+from collections import OrderedDict
+import os
+import threading
+
+from signature_chain.core import DEFAULT_HASH_ALGORITHM, hash_document, new_hasher
+
+# Blocchi letti per volta da `hash_file`.
+_FILE_CHUNK_SIZE = 1024 * 1024
+
+
+class DocumentHashCache:
+    """
+    Cache LRU, thread-safe, degli hash dei documenti in memoria e su file.
+
+    Args:
+        max_entries (int, optional): Numero massimo di voci; 0 disattiva la cache. Defaults to 256.
+        max_bytes (int, optional): Byte massimi di documenti in memoria trattenuti dalle voci.
+                                   Defaults to 256 MiB.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # chiave -> (documento trattenuto o None per i file, byte trattenuti, hash)
+        self._entries = OrderedDict()
+        self._retained_bytes = 0
+        self._lock = threading.Lock()
+
+    def hash_document(self, document: bytes | str, algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
+        """
+        Come `core.hash_document`, ma restituisce l'hash già calcolato se lo
+        stesso oggetto è già stato passato con lo stesso algoritmo.
+        """
+        if not isinstance(document, (bytes, str)) or self.max_entries <= 0:
+            return hash_document(document, algorithm)
+
+        key = ("object", id(document), len(document), algorithm)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is document:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        digest = hash_document(document, algorithm)
+        size = len(document)
+        if size <= self.max_bytes:
+            self._store(key, document, size, digest)
+        return digest
+
+    def hash_file(self, path: str | os.PathLike, algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
+        """
+        Calcola l'hash del contenuto di un file, leggendolo a blocchi, e lo
+        conserva finché percorso, inode, dimensione e mtime non cambiano.
+
+        Args:
+            path (str | os.PathLike): Il percorso del file.
+            algorithm (str, optional): Uno di `core.HASH_ALGORITHMS`. Defaults to "sha256".
+
+        Returns:
+            str: L'hash esadecimale del contenuto.
+        """
+        real_path = os.path.realpath(path)
+        with open(real_path, "rb") as document_file:
+            stat = os.fstat(document_file.fileno())
+            key = ("file", real_path, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, algorithm)
+            if self.max_entries > 0:
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry is not None:
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        return entry[2]
+                    self.misses += 1
+
+            hasher = new_hasher(algorithm)
+            while chunk := document_file.read(_FILE_CHUNK_SIZE):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+        if self.max_entries > 0:
+            self._store(key, None, 0, digest)
+        return digest
+
+    def clear(self) -> None:
+        """
+        Svuota la cache e azzera i contatori.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._retained_bytes = 0
+            self.hits = self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _store(self, key, document, size: int, digest: str) -> None:
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._retained_bytes -= previous[1]
+            self._entries[key] = (document, size, digest)
+            self._retained_bytes += size
+            while len(self._entries) > self.max_entries or self._retained_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._retained_bytes -= evicted_size
+
+
+# Cache condivisa dal processo; DOCUMENT_HASH_CACHE_ENTRIES=0 la disattiva.
+document_hash_cache = DocumentHashCache(
+    max_entries=int(os.environ.get("DOCUMENT_HASH_CACHE_ENTRIES", "256")),
+    max_bytes=int(os.environ.get("DOCUMENT_HASH_CACHE_MAX_BYTES", str(256 * 1024 * 1024))))
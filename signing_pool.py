@@ -0,0 +1,134 @@
+"""
+Pool di processi per la firma RSA dei blocchi.
+
+La firma RSA è CPU-bound e un singolo processo Python non riesce a sfruttare
+tutti i core di un host di firma. Il pool distribuisce le firme su più processi
+worker: le chiavi private vengono passate ai worker una sola volta, al loro
+avvio, e ciascun worker le analizza una volta e le tiene in memoria; per ogni
+chiamata viaggiano solo il nome del firmatario e i dati da firmare.
+
+Le durate delle firme misurate nei worker tornano con i risultati e vengono
+registrate dal processo chiamante nell'istogramma `SIGN_SECONDS`, come per le
+firme eseguite in locale.
+
+Esempio:
+
+    with SigningPool({"Antonio": pem_antonio, "Marianna": pem_marianna}) as pool:
+        signatures = pool.sign_many([data_1, data_2, data_3], "Antonio")
+"""
+from concurrent.futures import Future, ProcessPoolExecutor
+import time
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+
+from metrics import ENABLED as METRICS_ENABLED, REGISTRY, SIGN_SECONDS
+
+# Chiavi private già analizzate, per firmatario. Popolato in ogni worker da _init_worker.
+_worker_keys = {}
+
+
+def _init_worker(private_keys_pem: dict[str, bytes]) -> None:
+    """
+    Inizializzatore dei worker: analizza una sola volta le chiavi private PEM.
+
+    Args:
+        private_keys_pem (dict[str, bytes]): Mappa firmatario -> chiave privata PEM.
+    """
+    _worker_keys.clear()
+    for signer, private_key_pem in private_keys_pem.items():
+        _worker_keys[signer] = serialization.load_pem_private_key(private_key_pem, password=None)
+
+
+def _sign_batch(signer: str, inputs: list[bytes]) -> tuple[list[str], list[float]]:
+    """
+    Firma nel worker un lotto di dati con la chiave del firmatario.
+
+    Returns:
+        tuple[list[str], list[float]]: Le firme esadecimali, nello stesso ordine dei dati,
+                                       e la durata in secondi di ciascuna firma.
+    """
+    private_key = _worker_keys[signer]
+    signatures, durations = [], []
+    for data in inputs:
+        start = time.perf_counter()
+        signatures.append(private_key.sign(data, padding.PKCS1v15(), hashes.SHA256()).hex())
+        durations.append(time.perf_counter() - start)
+    return signatures, durations
+
+
+class SigningPool:
+    """
+    Servizio di firma basato su un `ProcessPoolExecutor` i cui worker tengono
+    in memoria le chiavi private dei firmatari.
+    """
+
+    def __init__(self, private_keys_pem: dict[str, bytes], workers: int | None = None, chunk_size: int = 32):
+        """
+        Args:
+            private_keys_pem (dict[str, bytes]): Mappa firmatario -> chiave privata PEM.
+            workers (int | None, optional): Numero di processi worker. Defaults al numero di CPU.
+            chunk_size (int, optional): Numero di firme per singolo task inviato ad un worker.
+                                        Defaults to 32.
+        """
+        self.signers = frozenset(private_keys_pem)
+        self.chunk_size = chunk_size
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(dict(private_keys_pem),))
+
+    def submit_many(self, inputs: list[bytes], signer: str) -> list[Future]:
+        """
+        Invia ai worker la firma dei dati, suddivisi in lotti, senza attenderne il risultato.
+        Permette di firmare in parallelo lotti di firmatari diversi.
+
+        Returns:
+            list[Future]: Un future per lotto, da passare a `gather`.
+        """
+        if signer not in self.signers:
+            raise KeyError(f"Chiave privata non disponibile nel pool per '{signer}'.")
+        return [self._executor.submit(_sign_batch, signer, inputs[i:i + self.chunk_size])
+                for i in range(0, len(inputs), self.chunk_size)]
+
+    def sign_many(self, inputs: list[bytes], signer: str) -> list[str]:
+        """
+        Firma i dati con la chiave del firmatario, distribuendo i lotti sui worker.
+
+        Args:
+            inputs (list[bytes]): I dati da firmare.
+            signer (str): Il nome del firmatario.
+
+        Returns:
+            list[str]: Le firme esadecimali, nello stesso ordine dei dati.
+        """
+        return gather(self.submit_many(inputs, signer))
+
+    def sign(self, data: bytes, signer: str) -> str:
+        """
+        Firma un singolo dato in un worker del pool.
+        """
+        return self.sign_many([data], signer)[0]
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def gather(futures: list[Future]) -> list[str]:
+    """
+    Attende i lotti restituiti da `SigningPool.submit_many`, ne concatena le firme
+    e registra le durate misurate nei worker in `SIGN_SECONDS`.
+    """
+    signatures = []
+    for future in futures:
+        batch, durations = future.result()
+        signatures.extend(batch)
+        if METRICS_ENABLED:
+            for duration in durations:
+                REGISTRY[SIGN_SECONDS].observe(duration)
+    return signatures
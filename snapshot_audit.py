@@ -0,0 +1,164 @@
+"""
+Verifica della catena su uno snapshot coerente, anche durante gli append.
+
+Una verifica in READ COMMITTED esegue più letture (segmenti archiviati,
+blocchi, chiavi), ognuna con il proprio snapshot: un append o un'archiviazione
+che termina nel frattempo può far vedere una coda parziale o un segmento due
+volte. `read_only_snapshot` apre invece una transazione REPEATABLE READ READ
+ONLY: tutte le letture vedono lo stesso stato della catena, fino all'ID massimo
+visibile all'apertura (high-water), senza prendere lock che rallentino chi
+scrive.
+
+`verify_snapshot` può dividere lo snapshot tra più processi: la transazione
+del coordinatore esporta lo snapshot (`pg_export_snapshot`) e ogni worker lo
+importa (`SET TRANSACTION SNAPSHOT`) per verificare un intervallo di ID con
+`range_audit.verify_id_range`. Tutti i worker vedono esattamente gli stessi
+blocchi.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+import os
+
+import psycopg2
+import psycopg2.extensions
+
+from metrics import cursor_factory
+from range_audit import verify_id_range
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """
+    Lo snapshot di una verifica.
+
+    Attributes:
+        high_water_id (int): L'ID massimo della catena visibile nello snapshot (0 se vuota).
+        snapshot_id (str | None): L'identificativo esportato, da usare con
+                                  `SET TRANSACTION SNAPSHOT`; None se non esportato.
+    """
+    high_water_id: int
+    snapshot_id: str | None = None
+
+
+@contextmanager
+def read_only_snapshot(conn, export: bool = False):
+    """
+    Apre sulla connessione una transazione REPEATABLE READ READ ONLY e ne
+    legge l'ID massimo della catena. All'uscita la transazione viene chiusa e
+    ripristinate le impostazioni di sessione precedenti.
+
+    Args:
+        conn: La connessione psycopg2, senza transazioni aperte.
+        export (bool, optional): Esporta lo snapshot per altre connessioni. Defaults to False.
+
+    Yields:
+        Snapshot: L'high-water e, con `export`, l'identificativo dello snapshot.
+
+    Raises:
+        psycopg2.ProgrammingError: Se sulla connessione è aperta una transazione.
+    """
+    previous = (conn.isolation_level, conn.readonly, conn.autocommit)
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True,
+                     autocommit=False)
+    try:
+        with conn.cursor() as cursor:
+            # La prima istruzione della transazione fissa lo snapshot.
+            cursor.execute("SELECT coalesce(max(id), 0), CASE WHEN %s THEN pg_export_snapshot() END "
+                           "FROM signature_chain", (export,))
+            high_water_id, snapshot_id = cursor.fetchone()
+        yield Snapshot(high_water_id, snapshot_id)
+    finally:
+        conn.rollback()
+        isolation_level, readonly, autocommit = previous
+        conn.set_session(isolation_level="DEFAULT" if isolation_level is None else isolation_level,
+                         readonly="DEFAULT" if readonly is None else readonly, autocommit=autocommit)
+
+
+def verify_snapshot(connection_params: dict, document_id: str | None = None, workers: int = 1,
+                    batch_size: int = 5000) -> dict:
+    """
+    Verifica collegamenti e firme di tutti i blocchi di uno snapshot, fino al
+    suo high-water, eventualmente in parallelo.
+
+    Args:
+        connection_params (dict): Parametri di `psycopg2.connect` (dbname, user, ... oppure dsn).
+        document_id (str | None, optional): Il documento da verificare; None per tutti. Defaults to None.
+        workers (int, optional): Processi tra cui dividere l'intervallo di ID; con 1 la verifica
+                                 avviene nel processo corrente. Defaults to 1.
+        batch_size (int, optional): Blocchi letti per round trip. Defaults to 5000.
+
+    Returns:
+        dict: Il risultato di `range_audit.verify_id_range` sull'intero snapshot, con in più
+              "high_water_id" e "workers".
+    """
+    conn = psycopg2.connect(**connection_params, cursor_factory=cursor_factory())
+    try:
+        with read_only_snapshot(conn, export=workers > 1) as snapshot:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT min(id) FROM signature_chain WHERE (%(document_id)s::uuid IS NULL "
+                               "OR document_id = %(document_id)s::uuid)", {"document_id": document_id})
+                first_id = cursor.fetchone()[0] or 1
+
+            if workers <= 1:
+                results = [verify_id_range(conn, document_id, first_id, snapshot.high_water_id,
+                                           batch_size=batch_size)]
+            else:
+                step = max(1, -(-(snapshot.high_water_id - first_id + 1) // workers))
+                slices = [(start, min(start + step - 1, snapshot.high_water_id))
+                          for start in range(first_id, snapshot.high_water_id + 1, step)]
+                # La transazione esportatrice resta aperta finché tutti i worker
+                # non hanno terminato (lo snapshot è importabile solo finché esiste).
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(_verify_slice, connection_params, snapshot.snapshot_id, document_id,
+                                               start, end, batch_size) for start, end in slices]
+                    results = [future.result() for future in futures]
+    finally:
+        conn.close()
+
+    verified = [result for result in results if result["verified_blocks"]]
+    return {"valid": all(result["valid"] for result in results),
+            "verified_blocks": sum(result["verified_blocks"] for result in results),
+            "first_block_id": verified[0]["first_block_id"] if verified else None,
+            "last_block_id": verified[-1]["last_block_id"] if verified else None,
+            "anchors": sum(result["anchors"] for result in results),
+            "errors": [error for result in results for error in result["errors"]],
+            "high_water_id": snapshot.high_water_id,
+            "workers": max(1, workers)}
+
+
+def _verify_slice(connection_params: dict, snapshot_id: str, document_id: str | None, first_id: int, last_id: int,
+                  batch_size: int) -> dict:
+    """
+    Worker di `verify_snapshot`: importa lo snapshot esportato e verifica i
+    blocchi con ID in [first_id, last_id].
+    """
+    conn = psycopg2.connect(**connection_params, cursor_factory=cursor_factory())
+    try:
+        conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+        with conn.cursor() as cursor:
+            cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+        return verify_id_range(conn, document_id, first_id, last_id, batch_size=batch_size)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verifica della catena su uno snapshot coerente.")
+    parser.add_argument("--document", help="document_id da verificare; default: tutti i documenti")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("SNAPSHOT_AUDIT_WORKERS", "1")),
+                        help="processi che verificano lo snapshot in parallelo")
+    args = parser.parse_args()
+
+    result = verify_snapshot({"dbname": os.environ.get("DB_NAME", "signature_demo"),
+                              "user": os.environ.get("APP_DB_USER", "app_user"),
+                              "password": os.environ.get("APP_DB_PASSWORD", "app_password"),
+                              "host": os.environ.get("DB_HOST", "localhost")},
+                             args.document, args.workers)
+
+    print(f"Snapshot fino al blocco {result['high_water_id']}: {result['verified_blocks']} blocchi verificati "
+          f"da {result['workers']} worker.")
+    for error in result["errors"]:
+        print(f"  ERRORE blocco {error['block_id']}: {error['error']}")
+    print("Catena VALIDA." if result["valid"] else f"Catena NON valida: {len(result['errors'])} errori.")
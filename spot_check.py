@@ -0,0 +1,151 @@
+"""
+Audit a campione (spot check) delle firme della catena.
+
+La verifica dei collegamenti `prev_hash` -> `signature` costa poco ed è sempre
+eseguita su tutti i blocchi; la verifica RSA delle firme è invece la parte
+costosa di un audit completo. In modalità spot check si verifica la firma di un
+campione casuale di blocchi, dimensionato in modo che, se almeno una frazione
+`tamper_rate` dei blocchi è manomessa, il campione contenga almeno un blocco
+manomesso con probabilità `detection_probability`.
+
+Il campionamento è senza reinserimento, quindi la probabilità di non rilevare
+alcuna manomissione è quella ipergeometrica:
+
+    P(mancata rilevazione) = C(N - K, n) / C(N, n) = prod_{i=0}^{n-1} (N - K - i) / (N - i)
+
+con N blocchi, K = ceil(tamper_rate * N) blocchi manomessi e n blocchi
+campionati. Il campione è determinato dal seme, che viene riportato insieme
+agli ID campionati così da poter ripetere esattamente la stessa verifica.
+"""
+from dataclasses import dataclass, field
+import math
+import random
+
+
+def detection_confidence(population: int, sample_size: int, tamper_rate: float) -> float:
+    """
+    Calcola la probabilità che un campione di `sample_size` blocchi su
+    `population` contenga almeno un blocco manomesso.
+
+    Args:
+        population (int): Numero di blocchi della catena.
+        sample_size (int): Numero di blocchi campionati.
+        tamper_rate (float): Frazione di blocchi manomessi ipotizzata (0 < tamper_rate <= 1).
+
+    Returns:
+        float: La probabilità di rilevazione, tra 0 e 1.
+    """
+    if population <= 0:
+        return 1.0
+    tampered = tampered_blocks(population, tamper_rate)
+    miss = 1.0
+    for i in range(min(sample_size, population)):
+        if population - tampered - i <= 0:
+            return 1.0
+        miss *= (population - tampered - i) / (population - i)
+    return 1.0 - miss
+
+
+def tampered_blocks(population: int, tamper_rate: float) -> int:
+    """
+    Numero minimo di blocchi manomessi corrispondente a `tamper_rate` (almeno uno).
+    """
+    if not 0 < tamper_rate <= 1:
+        raise ValueError(f"tamper_rate deve essere compreso in (0, 1], ricevuto {tamper_rate}.")
+    return min(population, max(1, math.ceil(tamper_rate * population)))
+
+
+def signature_sample_size(population: int, detection_probability: float, tamper_rate: float) -> int:
+    """
+    Calcola il campione minimo che rileva una manomissione con la probabilità richiesta.
+
+    Args:
+        population (int): Numero di blocchi della catena.
+        detection_probability (float): Probabilità di rilevazione richiesta (0 < p < 1).
+        tamper_rate (float): Frazione di blocchi manomessi ipotizzata (0 < tamper_rate <= 1).
+
+    Returns:
+        int: Il numero di firme da verificare (al più `population`).
+    """
+    if not 0 < detection_probability < 1:
+        raise ValueError(
+            f"detection_probability deve essere compresa in (0, 1), ricevuta {detection_probability}.")
+    if population <= 0:
+        return 0
+
+    tampered = tampered_blocks(population, tamper_rate)
+    target_miss = 1.0 - detection_probability
+    miss = 1.0
+    for n in range(population):
+        if miss <= target_miss:
+            return n
+        if population - tampered - n <= 0:
+            return n + 1
+        miss *= (population - tampered - n) / (population - n)
+    return population
+
+
+@dataclass
+class SpotCheckReport:
+    """
+    Esito della pianificazione di uno spot check: quanto basta per ripeterlo.
+    """
+    seed: int
+    population: int
+    detection_probability: float
+    tamper_rate: float
+    sampled_ids: list[int]
+    confidence: float
+
+    def as_dict(self) -> dict:
+        return {
+            "seed": self.seed,
+            "population": self.population,
+            "detection_probability": self.detection_probability,
+            "tamper_rate": self.tamper_rate,
+            "sample_size": len(self.sampled_ids),
+            "confidence": self.confidence,
+            "sampled_ids": self.sampled_ids,
+        }
+
+
+@dataclass
+class SpotCheck:
+    """
+    Parametri di uno spot check delle firme, da passare a `verify_chain`.
+
+    Attributes:
+        detection_probability (float): Probabilità di rilevazione richiesta. Defaults to 0.99.
+        tamper_rate (float): Frazione di blocchi manomessi da rilevare. Defaults to 0.01.
+        seed (int | None): Seme del campionamento; se None ne viene estratto uno casuale,
+                           riportato nel report.
+        report (SpotCheckReport | None): Il report dell'ultima pianificazione eseguita.
+    """
+    detection_probability: float = 0.99
+    tamper_rate: float = 0.01
+    seed: int | None = None
+    report: SpotCheckReport | None = field(default=None, compare=False)
+
+    def plan(self, block_ids: list[int]) -> SpotCheckReport:
+        """
+        Sceglie i blocchi di cui verificare la firma.
+
+        Args:
+            block_ids (list[int]): Gli ID di tutti i blocchi della catena.
+
+        Returns:
+            SpotCheckReport: Il seme usato, gli ID campionati (ordinati) e la confidenza ottenuta.
+        """
+        seed = self.seed if self.seed is not None else random.SystemRandom().getrandbits(63)
+        population = len(block_ids)
+        size = signature_sample_size(population, self.detection_probability, self.tamper_rate)
+        sampled_ids = sorted(random.Random(seed).sample(sorted(block_ids), size))
+        self.report = SpotCheckReport(
+            seed=seed,
+            population=population,
+            detection_probability=self.detection_probability,
+            tamper_rate=self.tamper_rate,
+            sampled_ids=sampled_ids,
+            confidence=detection_confidence(population, size, self.tamper_rate),
+        )
+        return self.report
@@ -0,0 +1,314 @@
+"""
+Verificatore continuo della catena di firme, guidato da LISTEN/NOTIFY.
+
+Il trigger `signature_chain_appended` (vedi init.sql) notifica sul canale
+`signature_chain_appended` l'ID massimo di ogni INSERT confermato. Il
+verificatore resta in ascolto e, ad ogni notifica, legge per ID i blocchi nuovi
+e per ciascuno controlla:
+
+    - il collegamento: `prev_hash` deve essere la testa corrente del documento,
+      tenuta in memoria (LRU) per i documenti attivi e letta dal database con
+      una query per indice solo la prima volta che il documento viene visto
+      (il primo blocco di un documento può essere un genesi o, come in main.py,
+      collegarsi al blocco precedente della catena globale);
+    - la firma, con la chiave risolta dal registro `signer_keys`.
+
+Se il predecessore di un blocco è stato archiviato (vedi `archive.py`),
+l'ancora si legge dai segmenti archiviati in ARCHIVE_DIR.
+
+Il costo per blocco è costante e non richiede riletture della catena.
+
+Gli ID vengono assegnati all'INSERT ma i blocchi diventano visibili al commit,
+quindi un blocco con ID inferiore può comparire dopo uno con ID superiore: gli
+ID mancanti vengono ricontrollati ad ogni lettura, finché compaiono o finché
+scade `STREAM_VERIFIER_GAP_SECONDS` (un ID consumato da una transazione
+annullata non comparirà mai). Un salto di ID più ampio di
+`STREAM_VERIFIER_MAX_GAPS` (blocchi cancellati o archiviati, salto della
+sequenza) registra come mancanti solo gli ID più vicini al blocco letto; la
+verifica parte comunque dal primo blocco presente nella tabella, così che un
+prefisso archiviato non venga atteso ID per ID.
+
+Dopo una disconnessione il verificatore si riconnette e riprende dall'ultimo ID
+elaborato; con `STREAM_VERIFIER_STATE=<file>` l'ultimo ID e gli ID mancanti
+ancora attesi vengono salvati su file e ripresi anche al riavvio del processo:
+un blocco confermato in ritardo viene verificato anche se il commit arriva
+mentre il verificatore è fermo.
+
+Con `SIGNATURE_CHAIN_METRICS=1` e `STREAM_VERIFIER_METRICS_PORT=<porta>` il
+verificatore espone `/metrics` con i blocchi verificati per esito e il ritardo
+di verifica.
+
+Uso:
+    python stream_verifier.py                # dai blocchi inseriti da ora in poi
+    python stream_verifier.py --from-id 0    # verifica prima tutta la catena
+"""
+import argparse
+from collections import OrderedDict
+import json
+import os
+from pathlib import Path
+import select
+import time
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+import psycopg2
+
+from archive import ArchivedHeads
+from key_registry import KeyResolver
+from metrics import (DB_CONNECT_SECONDS, ENABLED as METRICS_ENABLED, REGISTRY, STREAM_BLOCKS_TOTAL,
+                     STREAM_LAG_SECONDS, VERIFY_SECONDS, cursor_factory, start_http_server, timed)
+from range_audit import anchor_signature
+
+CHANNEL = "signature_chain_appended"
+
+_BLOCK_COLUMNS = "id, document_id, signer, signed_at, document_hash, prev_hash, signature, key_id"
+
+
+class StreamVerifier:
+    """
+    Verifica i blocchi nuovi in ordine di arrivo, mantenendo in memoria la testa
+    della catena dei documenti attivi.
+    """
+
+    def __init__(self, conn, from_id: int, max_documents: int = 100_000, gap_seconds: float = 60.0,
+                 batch_size: int = 1000, max_gaps: int = 10_000, gaps=(), archive=None):
+        """
+        Args:
+            conn: Connessione psycopg2 in autocommit.
+            from_id (int): Ultimo ID già elaborato; la verifica parte dal successivo.
+            max_documents (int, optional): Teste di documento tenute in memoria. Defaults to 100000.
+            gap_seconds (float, optional): Per quanto ricontrollare un ID mancante. Defaults to 60.
+            batch_size (int, optional): Blocchi letti per query. Defaults to 1000.
+            max_gaps (int, optional): ID mancanti registrati al massimo per un singolo salto di ID.
+                                      Defaults to 10000.
+            gaps (Iterable[int], optional): ID mancanti ancora attesi, ad esempio dallo stato
+                                            salvato. Defaults to nessuno.
+            archive (ChainArchive | None, optional): L'archivio da cui ancorare i blocchi il cui
+                                                     predecessore è archiviato.
+                                                     Defaults a `ChainArchive()`.
+        """
+        self.last_id = from_id
+        self.max_documents = max_documents
+        self.gap_seconds = gap_seconds
+        self.batch_size = batch_size
+        self.max_gaps = max_gaps
+        self.heads = OrderedDict()
+        now = time.monotonic()
+        self.gaps = {block_id: now for block_id in gaps}
+        self.archived_heads = ArchivedHeads(archive)
+        self.verified = 0
+        self.alerts = []
+        self.attach(conn)
+
+    def attach(self, conn) -> None:
+        """
+        Usa una nuova connessione (ad esempio dopo una riconnessione), mantenendo
+        teste e ID mancanti.
+        """
+        self.conn = conn
+        self.key_resolver = KeyResolver(conn)
+        self._resolver_loaded_at = time.monotonic()
+
+    def process_new_blocks(self) -> list[dict]:
+        """
+        Legge e verifica i blocchi successivi all'ultimo elaborato e quelli
+        mancanti ancora attesi.
+
+        Returns:
+            list[dict]: Gli allarmi dei blocchi non validi elaborati in questa chiamata.
+        """
+        alerts = []
+        now = time.monotonic()
+        for block_id in [block_id for block_id, seen in self.gaps.items() if now - seen > self.gap_seconds]:
+            del self.gaps[block_id]
+
+        with self.conn.cursor() as cursor:
+            while True:
+                cursor.execute(
+                    f"SELECT {_BLOCK_COLUMNS} FROM signature_chain_blocks WHERE id > %s OR id = ANY(%s) ORDER BY id LIMIT %s",
+                    (self.last_id, list(self.gaps), self.batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                self.key_resolver.prefetch_blocks((row[2], row[7]) for row in rows)
+                for row in rows:
+                    alert = self._verify_block(cursor, row)
+                    if alert:
+                        alerts.append(alert)
+                if len(rows) < self.batch_size:
+                    break
+
+        self.alerts.extend(alerts)
+        return alerts
+
+    def _expected_prev_hash(self, cursor, block_id: int, document_id, prev_hash: str | None) -> str | None:
+        head = self.heads.get(document_id)
+        if head is not None and head[0] < block_id:
+            return head[1]
+        # Documento non in memoria, oppure blocco arrivato in ritardo (ID mancante):
+        # il predecessore si legge per indice.
+        return anchor_signature(cursor, document_id, block_id, prev_hash, self.archived_heads)
+
+    def _check_signature(self, row) -> str | None:
+        _, _, signer, signed_at, document_hash, prev_hash, signature, key_id = row
+        public_key = self.key_resolver.resolve(signer, key_id, signed_at)
+        if public_key is None:
+            return f"chiave pubblica assente per '{signer}'"
+        try:
+            with timed(VERIFY_SECONDS):
+                public_key.verify(bytes.fromhex(signature), (prev_hash or '').encode() + document_hash.encode(),
+                                  padding.PKCS1v15(), hashes.SHA256())
+        except (InvalidSignature, ValueError):
+            return "firma non valida"
+        return None
+
+    def _verify_block(self, cursor, row) -> dict | None:
+        block_id, document_id, signer, signed_at, _, prev_hash, signature, _ = row
+
+        if block_id in self.gaps:
+            del self.gaps[block_id]
+        elif block_id > self.last_id:
+            # ID intermedi non ancora visibili: transazioni non ancora confermate (o annullate).
+            # Le transazioni in corso hanno gli ID più vicini a block_id: oltre max_gaps
+            # il salto è fatto di blocchi cancellati o archiviati e non va atteso.
+            now = time.monotonic()
+            for missing_id in range(max(self.last_id + 1, block_id - self.max_gaps), block_id):
+                self.gaps[missing_id] = now
+            self.last_id = block_id
+
+        errors = []
+        if prev_hash != self._expected_prev_hash(cursor, block_id, document_id, prev_hash):
+            errors.append("prev_hash non collegato alla testa del documento (manomissione o biforcazione)")
+
+        signature_error = self._check_signature(row)
+        if signature_error and self._resolver_loaded_at < time.monotonic() - 1.0:
+            # Il resolver tiene in cache il registro: una chiave registrata dopo
+            # l'avvio (nuovo firmatario o rotazione) richiede di ricaricarlo.
+            self.key_resolver = KeyResolver(self.conn)
+            self._resolver_loaded_at = time.monotonic()
+            signature_error = self._check_signature(row)
+        if signature_error:
+            errors.append(signature_error)
+
+        head = self.heads.get(document_id)
+        if head is None or head[0] < block_id:
+            self.heads[document_id] = (block_id, signature)
+            self.heads.move_to_end(document_id)
+            if len(self.heads) > self.max_documents:
+                self.heads.popitem(last=False)
+        self.verified += 1
+
+        if METRICS_ENABLED:
+            REGISTRY[STREAM_BLOCKS_TOTAL].inc(labels=("invalid" if errors else "valid",))
+            REGISTRY[STREAM_LAG_SECONDS].observe(max(0.0, time.time() - signed_at.timestamp()))
+
+        if errors:
+            return {"block_id": block_id, "document_id": str(document_id), "signer": signer, "errors": errors}
+        return None
+
+
+def _load_state(path: Path | None) -> tuple[int | None, list[int]]:
+    if path is None or not path.exists():
+        return None, []
+    text = path.read_text(encoding="utf-8").strip()
+    if not text.startswith("{"):
+        # Formato precedente: solo l'ultimo ID.
+        return int(text or 0), []
+    state = json.loads(text)
+    return state["last_id"], state.get("gaps", [])
+
+
+def _save_state(path: Path | None, verifier: StreamVerifier) -> None:
+    if path is None:
+        return
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(json.dumps({"last_id": verifier.last_id, "gaps": sorted(verifier.gaps)}) + "\n",
+                        encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def run(connection_params: dict, from_id: int | None = None, state_path: Path | None = None,
+        poll_interval: float = 5.0, **verifier_options) -> None:
+    """
+    Esegue il verificatore fino all'interruzione, riconnettendosi in caso di errori di rete.
+
+    Args:
+        connection_params (dict): Parametri di connessione (dbname, user, password, host).
+        from_id (int | None, optional): Ultimo ID già elaborato. Defaults allo stato salvato
+                                        o, in sua assenza, all'ID massimo corrente.
+        state_path (Path | None, optional): File in cui salvare l'ultimo ID elaborato e gli ID
+                                            mancanti ancora attesi.
+        poll_interval (float, optional): Secondi tra due letture in assenza di notifiche,
+                                         per ricontrollare gli ID mancanti. Defaults to 5.
+        **verifier_options: Opzioni di `StreamVerifier`.
+    """
+    verifier = None
+    backoff = 1.0
+
+    while True:
+        conn = None
+        try:
+            with timed(DB_CONNECT_SECONDS):
+                conn = psycopg2.connect(cursor_factory=cursor_factory(), **connection_params)
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                # LISTEN prima della lettura di recupero: nessun commit successivo va perso.
+                cursor.execute(f"LISTEN {CHANNEL}")
+                if verifier is None:
+                    start_id, gaps = (from_id, []) if from_id is not None else _load_state(state_path)
+                    cursor.execute("SELECT min(id), coalesce(max(id), 0) FROM signature_chain")
+                    min_id, max_id = cursor.fetchone()
+                    if start_id is None:
+                        start_id = max_id
+                    elif min_id is not None and start_id < min_id - 1:
+                        # Gli ID sotto il primo blocco presente sono archiviati o cancellati.
+                        start_id = min_id - 1
+                    verifier = StreamVerifier(conn, start_id, gaps=gaps, **verifier_options)
+                else:
+                    verifier.attach(conn)
+            print(f"In ascolto su '{CHANNEL}' dall'ID {verifier.last_id}.")
+            backoff = 1.0
+
+            while True:
+                for alert in verifier.process_new_blocks():
+                    print(f"ALLARME blocco {alert['block_id']} (documento {alert['document_id']}, "
+                          f"firmatario {alert['signer']}): {'; '.join(alert['errors'])}")
+                _save_state(state_path, verifier)
+
+                if select.select([conn], [], [], poll_interval) != ([], [], []):
+                    conn.poll()
+                    conn.notifies.clear()
+        except psycopg2.OperationalError as error:
+            print(f"Connessione persa ({error}); nuovo tentativo tra {backoff:.0f} s.")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verificatore continuo della catena di firme (LISTEN/NOTIFY).")
+    parser.add_argument("--from-id", type=int, default=None,
+                        help="ultimo ID già elaborato (0 = verifica tutta la catena); "
+                             "default: stato salvato o ID massimo corrente")
+    args = parser.parse_args()
+
+    state = os.environ.get("STREAM_VERIFIER_STATE")
+    metrics_port = os.environ.get("STREAM_VERIFIER_METRICS_PORT")
+    if METRICS_ENABLED and metrics_port:
+        start_http_server(int(metrics_port))
+    try:
+        run({"dbname": os.environ.get("DB_NAME", "signature_demo"),
+             "user": os.environ.get("APP_DB_USER", "app_user"),
+             "password": os.environ.get("APP_DB_PASSWORD", "app_password"),
+             "host": os.environ.get("DB_HOST", "localhost")},
+            from_id=args.from_id,
+            state_path=Path(state) if state else None,
+            max_documents=int(os.environ.get("STREAM_VERIFIER_MAX_DOCUMENTS", "100000")),
+            gap_seconds=float(os.environ.get("STREAM_VERIFIER_GAP_SECONDS", "60")),
+            max_gaps=int(os.environ.get("STREAM_VERIFIER_MAX_GAPS", "10000")))
+    except KeyboardInterrupt:
+        print("Verificatore interrotto.")